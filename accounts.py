@@ -0,0 +1,253 @@
+"""Per-account OAuth credentials for triaging many mailboxes.
+
+The default mailbox (``'me'``) keeps using ``token.json``. Every other
+account's authorized-user token is stored in a SQLite file shared by all
+workers, and refreshed tokens are written back there. Each account also
+lists the Google users who own it; the web app only opens an account for a
+session that signed in with Google as one of them. Accounts are managed from
+the command line::
+
+    python accounts.py add alice@example.com                 # runs the OAuth flow; alice owns it
+    python accounts.py add bob@example.com --token bob.json  # imports a token file
+    python accounts.py grant team@example.com alice@example.com
+    python accounts.py list
+    python accounts.py remove bob@example.com
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from gmail_assistant import SCOPES, GmailServicePool, get_gmail_service, get_service_credentials
+
+DEFAULT_PATH = os.environ.get('ACCOUNTS_DB_PATH', 'accounts.sqlite3')
+DEFAULT_ACCOUNT = 'me'
+CREDENTIAL_FILES = ['credentials.json']
+# Only proves who the caller is; mailbox access comes from the stored tokens.
+SIGN_IN_SCOPES = ['openid', 'https://www.googleapis.com/auth/userinfo.email']
+
+
+class AccountStore:
+    """Stores account -> authorized-user token JSON, and account -> owners, in SQLite."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connections must not cross a fork, so reopen in each worker process.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS accounts '
+                         '(account TEXT PRIMARY KEY, token TEXT NOT NULL, added_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS owners '
+                         '(account TEXT NOT NULL, owner TEXT NOT NULL, PRIMARY KEY (account, owner))')
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def add(self, account, token, owners=()):
+        """Registers an account, or replaces its token if it is already registered, and grants it to `owners`."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT INTO accounts VALUES (?, ?, ?) ON CONFLICT (account) '
+                         'DO UPDATE SET token = excluded.token', (account, token, time.time()))
+            conn.executemany('INSERT OR IGNORE INTO owners VALUES (?, ?)',
+                             [(account, owner.lower()) for owner in owners])
+            conn.commit()
+
+    def grant(self, account, owner):
+        """Lets the Google user `owner` open a registered account. Returns False if it is not registered."""
+        with self._lock:
+            conn = self._connect()
+            if conn.execute('SELECT 1 FROM accounts WHERE account = ?', (account,)).fetchone() is None:
+                return False
+            conn.execute('INSERT OR IGNORE INTO owners VALUES (?, ?)', (account, owner.lower()))
+            conn.commit()
+        return True
+
+    def owners(self, account):
+        with self._lock:
+            return [row[0] for row in self._connect().execute(
+                'SELECT owner FROM owners WHERE account = ? ORDER BY owner', (account,))]
+
+    def is_owner(self, account, owner):
+        with self._lock:
+            return self._connect().execute('SELECT 1 FROM owners WHERE account = ? AND owner = ?',
+                                           (account, owner.lower())).fetchone() is not None
+
+    def token(self, account):
+        """Returns an account's token JSON, or None if it is not registered."""
+        with self._lock:
+            row = self._connect().execute('SELECT token FROM accounts WHERE account = ?', (account,)).fetchone()
+        return row[0] if row else None
+
+    def save_token(self, account, token):
+        with self._lock:
+            conn = self._connect()
+            conn.execute('UPDATE accounts SET token = ? WHERE account = ?', (token, account))
+            conn.commit()
+
+    def accounts(self):
+        """Returns the registered accounts in the order they were added."""
+        with self._lock:
+            return [row[0] for row in self._connect().execute('SELECT account FROM accounts ORDER BY added_at')]
+
+    def remove(self, account):
+        with self._lock:
+            conn = self._connect()
+            removed = conn.execute('DELETE FROM accounts WHERE account = ?', (account,)).rowcount == 1
+            conn.execute('DELETE FROM owners WHERE account = ?', (account,))
+            conn.commit()
+        return removed
+
+
+store = AccountStore()
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _loader(account):
+    def load():
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+
+        token = store.token(account)
+        if token is None:
+            raise Exception(f"Account {account} is not registered. Add it with: python accounts.py add {account}")
+        creds = Credentials.from_authorized_user_info(json.loads(token), SCOPES)
+        if not creds.valid:
+            creds.refresh(Request())
+            store.save_token(account, creds.to_json())
+        return creds
+    return load
+
+
+def _saver(account):
+    def save(creds):
+        store.save_token(account, creds.to_json())
+    return save
+
+
+def registered_accounts():
+    """Returns every account added with ``accounts.py add``."""
+    return store.accounts()
+
+
+def is_known_account(account):
+    return account == DEFAULT_ACCOUNT or store.token(account) is not None
+
+
+def is_account_owner(account, user):
+    """True if the signed-in Google user `user` may open a registered account."""
+    return store.is_owner(account, user)
+
+
+def _pool(account):
+    with _pools_lock:
+        if account not in _pools:
+            _pools[account] = GmailServicePool(load=_loader(account), save=_saver(account))
+        return _pools[account]
+
+
+def get_account_service(account=DEFAULT_ACCOUNT):
+    """Returns this process's Gmail API service for an account, building it on first use."""
+    if account == DEFAULT_ACCOUNT:
+        return get_gmail_service()
+    return _pool(account).get()
+
+
+def get_account_credentials(account=DEFAULT_ACCOUNT):
+    """Returns the OAuth credentials behind an account's service, e.g. for ``async_gmail``."""
+    if account == DEFAULT_ACCOUNT:
+        return get_service_credentials()
+    return _pool(account).credentials()
+
+
+def authorize():
+    """Runs the installed-app OAuth flow and returns the new credentials."""
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    for cred_file in CREDENTIAL_FILES:
+        if os.path.exists(cred_file):
+            return InstalledAppFlow.from_client_secrets_file(cred_file, SCOPES).run_local_server(port=0)
+    raise Exception("No valid credentials file found. Please ensure you have a valid Google API credentials file.")
+
+
+def _sign_in_flow(redirect_uri, state=None, code_verifier=None):
+    from google_auth_oauthlib.flow import Flow
+
+    for cred_file in CREDENTIAL_FILES:
+        if os.path.exists(cred_file):
+            return Flow.from_client_secrets_file(cred_file, SIGN_IN_SCOPES, state=state, redirect_uri=redirect_uri,
+                                                 code_verifier=code_verifier)
+    raise Exception("No valid credentials file found. Please ensure you have a valid Google API credentials file.")
+
+
+def sign_in_url(redirect_uri):
+    """Starts a Google sign-in that comes back to `redirect_uri`.
+
+    Returns (URL to send the caller to, state, PKCE code verifier); the
+    state and verifier must be handed back to signed_in_email.
+    """
+    flow = _sign_in_flow(redirect_uri)
+    url, state = flow.authorization_url(prompt='select_account')
+    return url, state, flow.code_verifier
+
+
+def signed_in_email(redirect_uri, state, code_verifier, authorization_response):
+    """Finishes a sign-in started by sign_in_url and returns the caller's verified Google email address."""
+    from google.auth.transport.requests import Request
+    from google.oauth2 import id_token
+
+    flow = _sign_in_flow(redirect_uri, state, code_verifier)
+    token = flow.fetch_token(authorization_response=authorization_response)
+    claims = id_token.verify_oauth2_token(token['id_token'], Request(), flow.client_config['client_id'])
+    if not claims.get('email_verified'):
+        raise Exception("Google has not verified the signed-in email address")
+    return claims['email'].lower()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the mailboxes triaged by this deployment.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help='register an account')
+    add.add_argument('account')
+    add.add_argument('--token', help='import an existing token.json instead of running the OAuth flow')
+    add.add_argument('--owner', action='append',
+                     help='Google user who may open the account in the web app (repeatable; default: the account)')
+    grant = commands.add_parser('grant', help='let another Google user open a registered account')
+    grant.add_argument('account')
+    grant.add_argument('owner')
+    commands.add_parser('list', help='list registered accounts and their owners')
+    remove = commands.add_parser('remove', help='forget an account and its token')
+    remove.add_argument('account')
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        if args.account == DEFAULT_ACCOUNT:
+            parser.error(f"'{DEFAULT_ACCOUNT}' is the token.json mailbox and cannot be added")
+        if args.token:
+            with open(args.token) as f:
+                token = f.read()
+        else:
+            token = authorize().to_json()
+        store.add(args.account, token, owners=args.owner or [args.account])
+        print(f"Added {args.account}")
+    elif args.command == 'grant':
+        if not store.grant(args.account, args.owner):
+            print(f"No such account: {args.account}")
+    elif args.command == 'list':
+        for account in store.accounts():
+            print(account, ' '.join(store.owners(account)))
+    elif not store.remove(args.account):
+        print(f"No such account: {args.account}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,43 @@
-from flask import Flask, render_template, redirect, url_for
+from flask import Flask, render_template, redirect, url_for, request
 # Import the functions from your gmail_assistant.py file
-from gmail_assistant import get_gmail_service, fetch_emails, cluster_emails
+from gmail_assistant import get_gmail_service
+from inbox_sync import sync_emails
+from snapshots import save_snapshot, snapshot_message_ids
+from bulk_modify import archive_messages
 
 app = Flask(__name__)
 
 @app.route('/')
 def index():
+    # Imported here so the app starts without loading scikit-learn
+    from online_clustering import cluster_emails_online
     try:
         print("Attempting to get Gmail service...")
         service = get_gmail_service()
         print("Gmail service obtained successfully")
         
         print("Fetching emails...")
-        emails = fetch_emails(service)
+        emails = sync_emails(service)
         if emails:
             print(f"Fetched {len(emails)} emails")
-            df = cluster_emails(emails)
-            # Convert DataFrame to a list of dictionaries for easy rendering
-            clusters = {i: df[df['cluster'] == i].to_dict('records') for i in range(3)}
-            return render_template('index.html', clusters=clusters)
+            result = cluster_emails_online(emails)
+            clusters = result.groups()
+            # Pin what the user sees so archiving acts on exactly these emails
+            snapshot_id = save_snapshot(result.message_ids())
+            return render_template('index.html', clusters=clusters, names=result.names, snapshot_id=snapshot_id)
         else:
             return "Could not fetch emails."
     except Exception as e:
         print(f"Error in index route: {e}")
         return f"Error: {str(e)}"
 
-@app.route('/archive/<cluster_id>')
+@app.route('/archive/<int:cluster_id>')
 def archive_cluster(cluster_id):
-    service = get_gmail_service()
-    emails = fetch_emails(service)
-    if emails:
-        df = cluster_emails(emails)
-        cluster_emails_df = df[df['cluster'] == int(cluster_id)]
-        email_ids = [email['id'] for email in cluster_emails_df['email']]
-        
+    email_ids = snapshot_message_ids(request.args.get('snapshot', type=int), cluster_id)
+    if email_ids:
+        service = get_gmail_service()
         # The Gmail API uses 'removeLabelIds' with 'INBOX' to archive
-        service.users().messages().batchModify(
-            userId='me',
-            body={'ids': email_ids, 'removeLabelIds': ['INBOX']}
-        ).execute()
+        archive_messages(service, email_ids)
     return redirect(url_for('index'))
 
 if __name__ == '__main__':
@@ -1,22 +1,42 @@
 import os
 import logging
+import time
 from logging.handlers import RotatingFileHandler
-from flask import Flask, render_template, redirect, url_for, request, jsonify, session
+from flask import Flask, render_template, stream_template, redirect, url_for, request, jsonify, session, g, Response, abort
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_talisman import Talisman
+from werkzeug.middleware.proxy_fix import ProxyFix
 import secrets
+import hmac
+import base64
+import binascii
 from datetime import datetime, timedelta
 import json
 
-# Import Gmail functions
+import metrics
+import quota
+from result_cache import cache as result_cache, etag
+
+# Import Gmail functions. These modules are light: the Google client and
+# scikit-learn load on first use or from the background warm-up.
 try:
-    from gmail_assistant import get_gmail_service, fetch_emails, cluster_emails
-    GMAIL_AVAILABLE = True
+    from gmail_assistant import dependencies_available
+    from accounts import (DEFAULT_ACCOUNT, get_account_service, is_account_owner, is_known_account, sign_in_url,
+                          signed_in_email)
+    from snapshots import get_snapshot
+    from bulk_modify import archive_messages
+    from search_index import forget_messages, search_message_ids, search_messages
+    from background import (cluster_page, cluster_summary, latest_version, request_refresh, result_for_snapshot,
+                            start_background_sync)
+    GMAIL_AVAILABLE = dependencies_available()
 except ImportError:
     GMAIL_AVAILABLE = False
 
 app = Flask(__name__)
+# nginx terminates TLS and proxies over http; trust its X-Forwarded-* headers so
+# request.url and external URLs (e.g. the sign-in redirect URI) keep https.
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
 
 # Production configuration
 app.config.update(
@@ -63,16 +83,122 @@ if not app.debug:
 @app.before_request
 def before_request():
     """Log all requests in production"""
+    g.request_started = time.perf_counter()
     if not app.debug:
         app.logger.info(f'{request.remote_addr} - {request.method} {request.url}')
 
+@app.after_request
+def after_request(response):
+    """Record request latency per endpoint"""
+    endpoint = request.endpoint or 'unknown'
+    if 'request_started' in g:
+        metrics.observe('http_request_seconds', time.perf_counter() - g.request_started, endpoint=endpoint)
+    metrics.inc('http_responses_total', endpoint=endpoint, status=response.status_code)
+    return response
+
 @app.errorhandler(404)
 def not_found_error(error):
-    return render_template('404.html'), 404
+    return render_template('404.html', error="Page not found."), 404
 
 @app.errorhandler(500)
 def internal_error(error):
-    return render_template('500.html'), 500
+    return render_template('500.html', error="An internal error occurred."), 500
+
+# Emails listed per cluster on the inbox page; the rest are paged via the API
+INDEX_PREVIEW = 20
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def current_mailbox():
+    """The mailbox this session triages, chosen at /auth?account="""
+    return session.get('mailbox', DEFAULT_ACCOUNT)
+
+class ClusterPreviews:
+    """Cluster id -> first emails, loaded one cluster at a time as the page streams"""
+
+    def __init__(self, snapshot_id, summary, mailbox):
+        self.snapshot_id = snapshot_id
+        self.summary = summary
+        self.mailbox = mailbox
+
+    def items(self):
+        for cluster_id in sorted(self.summary, key=int):
+            yield int(cluster_id), cluster_page(self.snapshot_id, int(cluster_id), 0, INDEX_PREVIEW,
+                                                self.mailbox) or []
+
+def encode_cursor(snapshot_id, position):
+    return base64.urlsafe_b64encode(f'{snapshot_id}:{position}'.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Return (snapshot id, position) from a cursor, or None if it is malformed"""
+    try:
+        snapshot_id, position = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split(':')
+        return int(snapshot_id), int(position)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+def render_summary_json(summary):
+    """Render the /api/clusters?summary=1 body: counts and top terms only"""
+    return app.json.dumps({int(i): cluster for i, cluster in summary.items()})
+
+def render_clusters_json(result):
+    """Render the /api/clusters body for a published result"""
+    clusters = {}
+    for i, emails in result['clusters'].items():
+        clusters[int(i)] = {
+            'name': result.get('summary', {}).get(i, {}).get('name'),
+            'count': sum(email.get('count', 1) for email in emails),
+            'emails': [
+                {
+                    'subject': email['subject'],
+                    'snippet': email['snippet'],
+                    'count': email.get('count', 1)
+                }
+                for email in emails
+            ]
+        }
+    return app.json.dumps(clusters)
+
+def cached_view(view, mimetype, render, load=None):
+    """Serve a view of the latest result from the cache shared by all workers
+
+    `render` gets what `load(snapshot_id, mailbox)` returns, by default the
+    whole result. Responses carry a strong ETag derived from the snapshot, so
+    clients that send it back in If-None-Match get a 304 until the next sync
+    publishes. Returns None if no result has been published yet.
+    """
+    mailbox = current_mailbox()
+    load = load or result_for_snapshot
+
+    def render_snapshot(snapshot_id):
+        result = load(snapshot_id, mailbox)
+        # None if a newer result was published meanwhile; it is not cached
+        if result is None:
+            return None
+        with metrics.timer('pipeline_stage_seconds', stage='render'):
+            return render(result).encode('utf-8')
+
+    # Retry once if a new result is published while we render
+    for _ in range(2):
+        version = latest_version(mailbox)
+        if version is None:
+            return None
+        snapshot_id, updated_at = version
+        tag = etag(view, snapshot_id)
+        if request.if_none_match.contains(tag):
+            response = Response(status=304)
+        else:
+            body = result_cache.get_or_render(f'{view}:{mailbox}:{snapshot_id}',
+                                              lambda: render_snapshot(snapshot_id))
+            if body is None:
+                continue
+            response = Response(body, mimetype=mimetype)
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.headers['X-Snapshot-Id'] = str(snapshot_id)
+        response.headers['X-Updated-At'] = updated_at
+        return response
+    return None
 
 @app.route('/')
 @limiter.limit("30 per minute")
@@ -87,16 +213,28 @@ def index():
         if 'gmail_authenticated' not in session:
             return redirect(url_for('auth'))
         
-        service = get_gmail_service()
-        emails = fetch_emails(service)
+        # Serve the latest result published by the background sync. The page
+        # streams one cluster at a time and lists only the first emails of
+        # each, so it starts arriving at once however big the inbox is.
+        mailbox = current_mailbox()
+        version = latest_version(mailbox)
+        summary = cluster_summary(version[0], mailbox) if version else None
         
-        if emails:
-            df = cluster_emails(emails)
-            clusters = {i: df[df['cluster'] == i].to_dict('records') for i in range(3)}
-            return render_template('index.html', clusters=clusters)
+        if summary is not None:
+            snapshot_id, updated_at = version
+            tag = etag('index', snapshot_id)
+            if request.if_none_match.contains(tag):
+                response = Response(status=304)
+            else:
+                response = Response(stream_template(
+                    'index.html', clusters=ClusterPreviews(snapshot_id, summary, mailbox), summaries=summary,
+                    snapshot_id=snapshot_id, updated_at=updated_at), mimetype='text/html')
+            response.set_etag(tag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
         else:
-            return render_template('error.html', 
-                error="No emails found or unable to fetch emails.")
+            request_refresh(mailbox)
+            return render_template('index.html', clusters={}, pending=True)
             
     except Exception as e:
         app.logger.error(f'Error in index route: {str(e)}')
@@ -106,11 +244,25 @@ def index():
 @app.route('/auth')
 @limiter.limit("10 per minute")
 def auth():
-    """Gmail authentication endpoint"""
+    """Gmail authentication endpoint; ?account= picks a mailbox added with accounts.py"""
     try:
         if GMAIL_AVAILABLE:
-            service = get_gmail_service()
+            mailbox = request.args.get('account', DEFAULT_ACCOUNT)
+            if not is_known_account(mailbox):
+                return render_template('error.html', error="Unknown account."), 404
+            if mailbox != DEFAULT_ACCOUNT:
+                # Registered accounts only open for a Google user listed as their owner.
+                user = session.get('user')
+                if user is None:
+                    url, state, code_verifier = sign_in_url(url_for('auth_callback', _external=True))
+                    session['sign_in'] = {'state': state, 'code_verifier': code_verifier, 'account': mailbox}
+                    return redirect(url)
+                if not is_account_owner(mailbox, user):
+                    app.logger.warning(f'{user} tried to open {mailbox}, which they do not own')
+                    return render_template('error.html', error="You do not own this account."), 403
+            service = get_account_service(mailbox)
             session['gmail_authenticated'] = True
+            session['mailbox'] = mailbox
             return redirect(url_for('index'))
         else:
             return render_template('error.html', 
@@ -120,7 +272,22 @@ def auth():
         return render_template('error.html', 
             error="Authentication failed. Please check your credentials.")
 
-@app.route('/archive/<cluster_id>')
+@app.route('/auth/callback')
+@limiter.limit("10 per minute")
+def auth_callback():
+    """Google sign-in redirect; records who the caller is, then resumes /auth"""
+    try:
+        sign_in = session.pop('sign_in', None)
+        if not GMAIL_AVAILABLE or sign_in is None or request.args.get('state') != sign_in['state']:
+            return render_template('error.html', error="Sign-in expired. Please try again."), 400
+        session['user'] = signed_in_email(url_for('auth_callback', _external=True), sign_in['state'],
+                                          sign_in['code_verifier'], request.url)
+        return redirect(url_for('auth', account=sign_in['account']))
+    except Exception as e:
+        app.logger.error(f'Sign-in error: {str(e)}')
+        return render_template('error.html', error="Sign-in failed. Please try again."), 400
+
+@app.route('/archive/<int:cluster_id>')
 @limiter.limit("20 per minute")
 def archive_cluster(cluster_id):
     """Archive emails in a specific cluster"""
@@ -131,22 +298,36 @@ def archive_cluster(cluster_id):
         if 'gmail_authenticated' not in session:
             return jsonify({'error': 'Not authenticated'}), 401
         
-        service = get_gmail_service()
-        emails = fetch_emails(service)
+        mailbox = current_mailbox()
+        snapshot_id = request.args.get('snapshot', type=int)
+        clusters = get_snapshot(snapshot_id, mailbox)
         
-        if emails:
-            df = cluster_emails(emails)
-            cluster_emails_df = df[df['cluster'] == int(cluster_id)]
-            email_ids = [email['id'] for email in cluster_emails_df['email']]
-            
-            # Archive emails by removing INBOX label
-            service.users().messages().batchModify(
-                userId='me',
-                body={'ids': email_ids, 'removeLabelIds': ['INBOX']}
-            ).execute()
+        if clusters is None:
+            return jsonify({'error': 'Unknown or expired snapshot, please reload clusters'}), 404
+        
+        if cluster_id not in clusters:
+            return jsonify({'error': 'Cluster not found in this snapshot'}), 404
+        
+        email_ids = clusters[cluster_id]
+        if email_ids:
+            service = get_account_service(mailbox)
+            # Archive emails by removing INBOX label, in API-sized chunks
+            with quota.account(mailbox):
+                chunks = archive_messages(service, email_ids)
+            archived = sum(chunk['count'] for chunk in chunks if chunk['success'])
+            success = archived == len(email_ids)
+            if success:
+                forget_messages(email_ids, mailbox)
+            # Republish clusters without the archived emails
+            request_refresh(mailbox)
             
-            app.logger.info(f'Archived {len(email_ids)} emails from cluster {cluster_id}')
-            return jsonify({'success': True, 'archived_count': len(email_ids)})
+            if success:
+                app.logger.info(f'Archived {archived} emails from cluster {cluster_id} of snapshot {snapshot_id} '
+                                f'of {mailbox}')
+            else:
+                app.logger.error(f'Archived {archived} of {len(email_ids)} emails from cluster {cluster_id} '
+                                 f'of snapshot {snapshot_id}')
+            return jsonify({'success': success, 'archived_count': archived, 'chunks': chunks}), 200 if archived else 502
         else:
             return jsonify({'error': 'No emails to archive'}), 400
             
@@ -166,6 +347,20 @@ def api_status():
         'version': '1.0.0'
     })
 
+@app.route('/metrics')
+@limiter.limit("60 per minute")
+def metrics_endpoint():
+    """Prometheus metrics for every worker on this host; scrapers send METRICS_TOKEN as a bearer token"""
+    token = os.environ.get('METRICS_TOKEN')
+    if not token:
+        # Without a token configured the endpoint does not exist.
+        abort(404)
+    scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.encode(), token.encode()):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain',
+                        headers={'WWW-Authenticate': 'Bearer realm="metrics"'})
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/clusters')
 @limiter.limit("30 per minute")
 def api_clusters():
@@ -174,32 +369,155 @@ def api_clusters():
         if not GMAIL_AVAILABLE:
             return jsonify({'error': 'Gmail integration not available'}), 400
         
-        service = get_gmail_service()
-        emails = fetch_emails(service)
-        
-        if emails:
-            df = cluster_emails(emails)
-            clusters = {}
-            for i in range(3):
-                cluster_data = df[df['cluster'] == i]
-                clusters[i] = {
-                    'count': len(cluster_data),
-                    'emails': [
-                        {
-                            'subject': row['subject'],
-                            'snippet': row['email'].get('snippet', '')
-                        }
-                        for _, row in cluster_data.iterrows()
-                    ]
-                }
-            return jsonify(clusters)
+        if 'gmail_authenticated' not in session:
+            return jsonify({'error': 'Not authenticated'}), 401
+        
+        # Serve the latest result published by the background sync
+        # Clients pass X-Snapshot-Id back to /archive/<cluster_id>?snapshot=
+        if request.args.get('summary', type=int):
+            response = cached_view('api_clusters_summary', 'application/json', render_summary_json,
+                                   load=cluster_summary)
         else:
-            return jsonify({'error': 'No emails found'}), 404
+            response = cached_view('api_clusters', 'application/json', render_clusters_json)
+        
+        if response:
+            return response
+        else:
+            request_refresh(current_mailbox())
+            response = jsonify({'status': 'pending', 'message': 'Clusters are being computed'})
+            response.headers['Retry-After'] = '5'
+            return response, 202
             
     except Exception as e:
         app.logger.error(f'API clusters error: {str(e)}')
         return jsonify({'error': 'Failed to fetch clusters'}), 500
 
+@app.route('/api/clusters/<int:cluster_id>')
+@limiter.limit("120 per minute")
+def api_cluster_page(cluster_id):
+    """One page of a cluster's emails; follow next_cursor for the rest"""
+    try:
+        if not GMAIL_AVAILABLE:
+            return jsonify({'error': 'Gmail integration not available'}), 400
+        
+        if 'gmail_authenticated' not in session:
+            return jsonify({'error': 'Not authenticated'}), 401
+        
+        mailbox = current_mailbox()
+        limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        if cursor:
+            position = decode_cursor(cursor)
+            if position is None:
+                return jsonify({'error': 'Invalid cursor'}), 400
+            snapshot_id, start = position
+        else:
+            version = latest_version(mailbox)
+            if version is None:
+                request_refresh(mailbox)
+                return jsonify({'status': 'pending', 'message': 'Clusters are being computed'}), 202
+            snapshot_id, start = version[0], 0
+        
+        tag = etag(f'api_cluster_{cluster_id}_{start}_{limit}', snapshot_id)
+        if request.if_none_match.contains(tag):
+            response = Response(status=304)
+        else:
+            # Pages of a snapshot never change, so fetch one extra email to
+            # learn whether there is a next page
+            emails = cluster_page(snapshot_id, cluster_id, start, limit + 1, mailbox)
+            if emails is None:
+                return jsonify({'error': 'Snapshot expired, start again without a cursor'}), 410
+            if not emails and start == 0:
+                return jsonify({'error': 'Cluster not found'}), 404
+            response = jsonify({
+                'cluster_id': cluster_id,
+                'emails': [{'subject': email['subject'], 'snippet': email['snippet'], 'count': email.get('count', 1)}
+                           for email in emails[:limit]],
+                'next_cursor': encode_cursor(snapshot_id, start + limit) if len(emails) > limit else None,
+            })
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.headers['X-Snapshot-Id'] = str(snapshot_id)
+        return response
+    
+    except Exception as e:
+        app.logger.error(f'API cluster page error: {str(e)}')
+        return jsonify({'error': 'Failed to fetch cluster'}), 500
+
+@app.route('/api/search')
+@limiter.limit("120 per minute")
+def api_search():
+    """Search the subject, snippet and sender of fetched emails, newest first"""
+    try:
+        if not GMAIL_AVAILABLE:
+            return jsonify({'error': 'Gmail integration not available'}), 400
+        
+        if 'gmail_authenticated' not in session:
+            return jsonify({'error': 'Not authenticated'}), 401
+        
+        query = request.args.get('q', '')
+        limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        # Answered from the local index only; it covers what the sync has fetched
+        total, emails = search_messages(query, current_mailbox(), limit)
+        return jsonify({'query': query, 'total': total, 'emails': emails})
+    
+    except Exception as e:
+        app.logger.error(f'Search error: {str(e)}')
+        return jsonify({'error': 'Search failed'}), 500
+
+@app.route('/api/search/archive', methods=['POST'])
+@limiter.limit("20 per minute")
+async def archive_search():
+    """Archive every email matching a search, without listing the mailbox
+
+    An async view: the matches' batchModify chunks are sent concurrently by
+    AsyncGmailClient, under the same quota as the mailbox's other calls.
+    """
+    try:
+        if not GMAIL_AVAILABLE:
+            return jsonify({'error': 'Gmail integration not available'}), 400
+        
+        if 'gmail_authenticated' not in session:
+            return jsonify({'error': 'Not authenticated'}), 401
+        
+        mailbox = current_mailbox()
+        query = request.form.get('q') or (request.get_json(silent=True) or {}).get('q', '')
+        email_ids = search_message_ids(query, mailbox)
+        
+        if not email_ids:
+            return jsonify({'error': 'No emails to archive'}), 400
+        
+        # Imported here so the app starts without loading httpx
+        from async_gmail import AsyncGmailClient
+        async with AsyncGmailClient.for_account(mailbox) as gmail:
+            chunks = await gmail.archive_messages(email_ids)
+        archived = sum(chunk['count'] for chunk in chunks if chunk['success'])
+        success = archived == len(email_ids)
+        if success:
+            forget_messages(email_ids, mailbox)
+            app.logger.info(f'Archived {archived} emails matching a search of {mailbox}')
+        else:
+            app.logger.error(f'Archived {archived} of {len(email_ids)} emails matching a search of {mailbox}')
+        request_refresh(mailbox)
+        return jsonify({'success': success, 'archived_count': archived, 'chunks': chunks}), 200 if archived else 502
+    
+    except Exception as e:
+        app.logger.error(f'Search archive error: {str(e)}')
+        return jsonify({'error': 'Failed to archive emails'}), 500
+
+@app.route('/api/refresh', methods=['POST'])
+@limiter.limit("10 per minute")
+def api_refresh():
+    """Ask the background sync to refresh clusters now"""
+    if not GMAIL_AVAILABLE:
+        return jsonify({'error': 'Gmail integration not available'}), 400
+    
+    if 'gmail_authenticated' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    request_refresh(current_mailbox())
+    return jsonify({'status': 'scheduled'}), 202
+
 @app.route('/logout')
 def logout():
     """Logout and clear session"""
@@ -212,6 +530,8 @@ if __name__ == '__main__':
     
     app.logger.info(f'Starting Inbox Triage Assistant on port {port}')
     app.logger.info(f'Gmail integration available: {GMAIL_AVAILABLE}')
+    if GMAIL_AVAILABLE:
+        start_background_sync()
     
     app.run(
         host='0.0.0.0',
@@ -0,0 +1,154 @@
+"""Asyncio Gmail client with bounded concurrency under the shared quota.
+
+Talks to the Gmail REST API over ``httpx.AsyncClient`` using the same OAuth
+credentials as the synchronous service, so one request can keep many Gmail
+calls in flight while it waits on I/O. A semaphore caps concurrent requests,
+and every call is metered and retried by the account's ``quota`` scheduler,
+so async and synchronous calls spend one budget. The production app's
+``/api/search/archive`` is an async view built on it::
+
+    async with AsyncGmailClient.for_account(mailbox) as gmail:
+        chunks = await gmail.archive_messages(message_ids)
+"""
+import asyncio
+
+import httpx
+
+from accounts import DEFAULT_ACCOUNT, get_account_credentials
+from gmail_assistant import HTTP_TIMEOUT, LIST_PAGE_SIZE, METADATA_HEADERS, project_message
+from quota import scheduler_for
+
+API_BASE = 'https://gmail.googleapis.com/gmail/v1/users/'
+DEFAULT_CONCURRENCY = 10
+MAX_IDS_PER_MODIFY = 1000
+
+
+class AsyncGmailError(Exception):
+    """A Gmail API call failed with an HTTP error status."""
+
+    def __init__(self, status, content):
+        super().__init__(f'{status}: {content.decode("utf-8", "replace")}')
+        # `status` and `content` are what quota reads to decide on retries and backoff.
+        self.status = status
+        self.content = content
+
+
+class AsyncGmailClient:
+    """Async Gmail API client; use as ``async with AsyncGmailClient(creds) as gmail``."""
+
+    def __init__(self, credentials, account=DEFAULT_ACCOUNT, user_id='me', concurrency=DEFAULT_CONCURRENCY,
+                 transport=None):
+        self.credentials = credentials
+        self.user_id = user_id
+        self.scheduler = scheduler_for(account)
+        self._concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._refresh_lock = asyncio.Lock()
+        self._transport = transport
+        self._client = None
+
+    @classmethod
+    def for_account(cls, account=DEFAULT_ACCOUNT, **kwargs):
+        """Builds a client on this process's cached OAuth credentials for an account."""
+        return cls(get_account_credentials(account), account=account, **kwargs)
+
+    async def __aenter__(self):
+        self._client = httpx.AsyncClient(
+            base_url=API_BASE, transport=self._transport, timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=self._concurrency, max_keepalive_connections=self._concurrency))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._client.aclose()
+
+    async def _auth_headers(self):
+        if not self.credentials.valid:
+            async with self._refresh_lock:
+                if not self.credentials.valid:
+                    from google.auth.transport.requests import Request
+                    await asyncio.to_thread(self.credentials.refresh, Request())
+        return {'Authorization': f'Bearer {self.credentials.token}'}
+
+    async def _call(self, method, http_method, path, params=None, body=None):
+        if params:
+            params = {key: value for key, value in params.items() if value is not None}
+
+        async def send():
+            async with self._semaphore:
+                response = await self._client.request(
+                    http_method, f'{self.user_id}/{path}', params=params, json=body,
+                    headers=await self._auth_headers())
+            if response.status_code >= 400:
+                raise AsyncGmailError(response.status_code, response.content)
+            return response.json() if response.content else {}
+
+        return await self.scheduler.execute_async(send, method)
+
+    async def get_profile(self):
+        return await self._call('getProfile', 'GET', 'profile')
+
+    async def list_messages(self, q=None, label_ids=None, page_token=None, max_results=LIST_PAGE_SIZE):
+        return await self._call('messages.list', 'GET', 'messages', params={
+            'q': q, 'labelIds': label_ids, 'pageToken': page_token, 'maxResults': max_results})
+
+    async def get_message(self, message_id, format='metadata', metadata_headers=METADATA_HEADERS):
+        return await self._call('messages.get', 'GET', f'messages/{message_id}', params={
+            'format': format, 'metadataHeaders': metadata_headers if format == 'metadata' else None})
+
+    async def get_messages(self, message_ids):
+        """Fetches projected messages concurrently, skipping those that fail."""
+        results = await asyncio.gather(*(self.get_message(i) for i in message_ids), return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            print(f"Skipped {len(failed)} of {len(results)} messages that could not be fetched")
+        return [project_message(r) for r in results if not isinstance(r, Exception)]
+
+    async def iter_message_ids(self, q=None, label_ids=None, limit=None, page_size=LIST_PAGE_SIZE):
+        """Yields pages of message ids, listing the next page while the caller works."""
+        remaining = limit
+        pending = asyncio.ensure_future(self.list_messages(q, label_ids, None, min(page_size, remaining or page_size)))
+        while pending is not None:
+            response = await pending
+            ids = [message['id'] for message in response.get('messages', [])]
+            if remaining is not None:
+                ids = ids[:remaining]
+                remaining -= len(ids)
+            page_token = response.get('nextPageToken')
+            pending = None
+            if page_token and remaining != 0:
+                pending = asyncio.ensure_future(
+                    self.list_messages(q, label_ids, page_token, min(page_size, remaining or page_size)))
+            if ids:
+                yield ids
+
+    async def fetch_emails(self, max_results=200, q=None, label_ids=None):
+        """Fetches up to `max_results` projected messages (None for all) matching the query."""
+        emails = []
+        async for ids in self.iter_message_ids(q=q, label_ids=label_ids, limit=max_results):
+            emails.extend(await self.get_messages(ids))
+        return emails
+
+    async def batch_modify(self, message_ids, add_label_ids=None, remove_label_ids=None):
+        """Changes labels in concurrent chunks; returns per-chunk results like `bulk_modify.batch_modify`."""
+        message_ids = list(dict.fromkeys(message_ids))
+        body = {}
+        if add_label_ids:
+            body['addLabelIds'] = list(add_label_ids)
+        if remove_label_ids:
+            body['removeLabelIds'] = list(remove_label_ids)
+        if not message_ids or not body:
+            return []
+
+        async def modify(index, ids):
+            try:
+                await self._call('messages.batchModify', 'POST', 'messages/batchModify', body=dict(body, ids=ids))
+                return {'chunk': index, 'count': len(ids), 'success': True}
+            except (AsyncGmailError, httpx.HTTPError) as e:
+                return {'chunk': index, 'count': len(ids), 'success': False, 'error': str(e)}
+
+        chunks = [message_ids[i:i + MAX_IDS_PER_MODIFY] for i in range(0, len(message_ids), MAX_IDS_PER_MODIFY)]
+        return list(await asyncio.gather(*(modify(i, chunk) for i, chunk in enumerate(chunks))))
+
+    async def archive_messages(self, message_ids):
+        """Archives messages by removing the INBOX label."""
+        return await self.batch_modify(message_ids, remove_label_ids=['INBOX'])
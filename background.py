@@ -0,0 +1,314 @@
+"""Background sync and clustering, so web requests never call Gmail.
+
+A single background thread per host runs the triage pipeline
+(fetch -> parse -> cluster -> publish) every ``SYNC_INTERVAL`` seconds and
+whenever a refresh is requested. Every gunicorn worker starts the thread, but
+only the one holding an exclusive file lock does any work; the others wait to
+take over if it exits. Results and refresh requests are shared through a
+SQLite file, so the web routes just read the latest published result.
+
+Besides the ``token.json`` mailbox, every account registered with
+``accounts.py`` is synced. Once there is more than one mailbox, syncs run on
+a ``shards.ShardPool`` of processes instead of the background thread itself.
+"""
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import metrics
+import quota
+from accounts import DEFAULT_ACCOUNT, get_account_service, registered_accounts
+from cluster_result import ClusterResult
+from gmail_assistant import warm_up
+from inbox_sync import sync_emails
+from quota import BACKGROUND, priority
+from shards import ShardPool
+from snapshots import save_snapshot
+
+DEFAULT_PATH = os.environ.get('TRIAGE_DB_PATH', 'triage_results.sqlite3')
+LOCK_PATH = os.environ.get('SYNC_LOCK_PATH', 'background_sync.lock')
+SYNC_INTERVAL = float(os.environ.get('SYNC_INTERVAL', '300'))
+# Published snapshots whose emails stay pageable.
+KEEP_SNAPSHOTS = 2
+TOP_TERMS = 5
+POLL_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class ResultStore:
+    """Latest published triage result and pending refresh requests per mailbox."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connections must not cross a fork, so reopen in each worker process.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            if 'data' in [row[1] for row in conn.execute('PRAGMA table_info(results)')]:
+                # Stores from before the columns below kept the whole result as one JSON blob;
+                # the next sync publishes it again.
+                conn.execute('DROP TABLE results')
+            # Only what requests look up; the emails themselves are in result_emails.
+            conn.execute('CREATE TABLE IF NOT EXISTS results (mailbox TEXT PRIMARY KEY, '
+                         'snapshot_id INTEGER NOT NULL, updated_at TEXT NOT NULL, summary TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS refresh_requests '
+                         '(mailbox TEXT PRIMARY KEY, requested_at REAL NOT NULL)')
+            # One row per email, so a cluster can be paged without loading the whole result.
+            conn.execute('CREATE TABLE IF NOT EXISTS result_emails (mailbox TEXT NOT NULL, '
+                         'snapshot_id INTEGER NOT NULL, cluster INTEGER NOT NULL, position INTEGER NOT NULL, '
+                         'data TEXT NOT NULL, PRIMARY KEY (mailbox, snapshot_id, cluster, position))')
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def publish(self, mailbox, result):
+        snapshot_id = result['snapshot_id']
+        rows = [(mailbox, snapshot_id, int(cluster), position, json.dumps(email))
+                for cluster, emails in result['clusters'].items() for position, email in enumerate(emails)]
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                         (mailbox, snapshot_id, result['updated_at'], json.dumps(result['summary'])))
+            conn.executemany('INSERT OR REPLACE INTO result_emails VALUES (?, ?, ?, ?, ?)', rows)
+            # Keep the previous snapshot's rows so cursors survive one sync.
+            conn.execute('DELETE FROM result_emails WHERE mailbox = ? AND snapshot_id NOT IN '
+                         '(SELECT DISTINCT snapshot_id FROM result_emails WHERE mailbox = ? '
+                         'ORDER BY snapshot_id DESC LIMIT ?)', (mailbox, mailbox, KEEP_SNAPSHOTS))
+            conn.commit()
+
+    def latest_version(self, mailbox):
+        """Returns (snapshot id, updated_at) of the latest result without loading it, or None."""
+        with self._lock:
+            row = self._connect().execute('SELECT snapshot_id, updated_at FROM results WHERE mailbox = ?',
+                                          (mailbox,)).fetchone()
+        return tuple(row) if row else None
+
+    def get(self, mailbox, snapshot_id):
+        """Returns the latest result with every cluster's emails if it is still `snapshot_id`, else None."""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT updated_at, summary FROM results WHERE mailbox = ? AND snapshot_id = ?',
+                               (mailbox, snapshot_id)).fetchone()
+            if not row:
+                return None
+            rows = conn.execute('SELECT cluster, data FROM result_emails WHERE mailbox = ? AND snapshot_id = ? '
+                                'ORDER BY cluster, position', (mailbox, snapshot_id)).fetchall()
+        clusters = {}
+        for cluster, data in rows:
+            clusters.setdefault(str(cluster), []).append(json.loads(data))
+        return {'snapshot_id': snapshot_id, 'updated_at': row[0], 'summary': json.loads(row[1]),
+                'clusters': clusters}
+
+    def summary(self, mailbox, snapshot_id):
+        """Returns {cluster id: {count, top_terms}} if `snapshot_id` is still the latest, else None."""
+        with self._lock:
+            row = self._connect().execute('SELECT summary FROM results WHERE mailbox = ? AND snapshot_id = ?',
+                                          (mailbox, snapshot_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def page(self, mailbox, snapshot_id, cluster, start, limit):
+        """Returns up to `limit` emails of a cluster from position `start`, or None if the snapshot is gone."""
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute('SELECT data FROM result_emails WHERE mailbox = ? AND snapshot_id = ? '
+                                'AND cluster = ? AND position >= ? ORDER BY position LIMIT ?',
+                                (mailbox, snapshot_id, cluster, start, limit)).fetchall()
+            if not rows and not conn.execute('SELECT 1 FROM result_emails WHERE mailbox = ? AND snapshot_id = ? '
+                                             'LIMIT 1', (mailbox, snapshot_id)).fetchone():
+                return None
+        return [json.loads(row[0]) for row in rows]
+
+    def request_refresh(self, mailbox):
+        """Asks the background worker to refresh a mailbox soon; repeated requests coalesce."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR IGNORE INTO refresh_requests VALUES (?, ?)', (mailbox, time.time()))
+            conn.commit()
+
+    def take_refresh_requests(self):
+        """Returns and clears the mailboxes with pending refresh requests."""
+        with self._lock:
+            conn = self._connect()
+            mailboxes = [row[0] for row in conn.execute('SELECT mailbox FROM refresh_requests')]
+            conn.execute('DELETE FROM refresh_requests')
+            conn.commit()
+        return mailboxes
+
+
+store = ResultStore()
+
+
+def fetch_stage(service, mailbox='me'):
+    with metrics.timer('pipeline_stage_seconds', stage='fetch'):
+        return sync_emails(service, mailbox)
+
+
+def cluster_stage(emails, mailbox='me'):
+    # Clustering pulls in scikit-learn; keep it out of web workers' startup.
+    from online_clustering import cluster_emails_online
+    with metrics.timer('pipeline_stage_seconds', stage='cluster'):
+        return cluster_emails_online(emails, mailbox)
+
+
+def publish_stage(mailbox, result):
+    message_count = result.message_count()
+    # Share of messages a rule sorted without clustering.
+    rule_hit_rate = result.named_message_count() / message_count if message_count else 0.0
+    metrics.set_gauge('triage_messages', message_count, mailbox=mailbox)
+    metrics.set_gauge('triage_rule_hit_ratio', rule_hit_rate, mailbox=mailbox)
+    metrics.set_gauge('triage_clusters', len(result.cluster_ids()), mailbox=mailbox)
+    snapshot_id = save_snapshot(result.message_ids(), mailbox)
+    groups = result.groups()
+    top_terms = result.top_terms(TOP_TERMS)
+    published = {
+        'snapshot_id': snapshot_id,
+        'updated_at': datetime.now().isoformat(),
+        'message_count': message_count,
+        'rule_hit_rate': round(rule_hit_rate, 4),
+        # One entry per near-duplicate group; `count` is how many emails it stands for.
+        'clusters': {
+            str(label): [{'id': row.id, 'subject': row.subject, 'snippet': row.snippet, 'count': row.count}
+                         for row in rows]
+            for label, rows in groups.items()
+        },
+        'summary': {
+            str(label): {'name': result.names.get(label), 'count': sum(row.count for row in rows),
+                         'groups': len(rows), 'top_terms': top_terms[label]}
+            for label, rows in groups.items()
+        },
+    }
+    store.publish(mailbox, published)
+    metrics.inc('pipeline_runs_total', mailbox=mailbox)
+    return published
+
+
+def run_pipeline(mailbox='me', service=None):
+    """Fetches, clusters and publishes one mailbox. Returns the published result, or None if the fetch failed."""
+    service = service or get_account_service(mailbox)
+    # Each mailbox spends its own Gmail quota, behind web requests.
+    with quota.account(mailbox), priority(BACKGROUND):
+        emails = fetch_stage(service, mailbox)
+    if emails is None:
+        logger.warning('Background sync of %s could not fetch emails', mailbox)
+        return None
+    # An empty inbox is published too, or the page would keep showing what was archived.
+    result = cluster_stage(emails, mailbox) if emails else ClusterResult([], [], [], [])
+    return publish_stage(mailbox, result)
+
+
+class BackgroundSync:
+    """Runs the pipeline on a schedule and on demand, once per host."""
+
+    def __init__(self, mailboxes=None, interval=SYNC_INTERVAL, lock_path=LOCK_PATH):
+        self.mailboxes = mailboxes
+        self.interval = interval
+        self.lock_path = lock_path
+        self._thread = None
+        self._stop = threading.Event()
+        self._last_run = {}
+        self._pool = None
+
+    def current_mailboxes(self):
+        """The fixed mailboxes if given, else token.json's mailbox plus every registered account."""
+        if self.mailboxes is not None:
+            return list(self.mailboxes)
+        mailboxes = registered_accounts()
+        if os.path.exists('token.json') or not mailboxes:
+            mailboxes.insert(0, DEFAULT_ACCOUNT)
+        return mailboxes
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='background-sync', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        try:
+            warm_up()
+        except Exception as e:
+            logger.error('Warm-up failed: %s', e)
+        with open(self.lock_path, 'w') as lock_file:
+            # Wait to become the one process on this host that syncs.
+            while not self._stop.is_set():
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    self._stop.wait(POLL_INTERVAL * 10)
+            logger.info('Background sync running in process %s', os.getpid())
+            while not self._stop.is_set():
+                self.run_due()
+                self._stop.wait(POLL_INTERVAL)
+            if self._pool is not None:
+                self._pool.shutdown()
+
+    def run_due(self):
+        """Runs the pipeline for mailboxes that are due or have a pending refresh request."""
+        requested = set(store.take_refresh_requests())
+        mailboxes = self.current_mailboxes()
+        if self._pool is None and len(mailboxes) > 1:
+            self._pool = ShardPool()
+        now = time.monotonic()
+        for mailbox in mailboxes:
+            if mailbox in requested or now - self._last_run.get(mailbox, float('-inf')) >= self.interval:
+                self._last_run[mailbox] = now
+                if self._pool is not None:
+                    self._pool.submit(mailbox)
+                    continue
+                try:
+                    run_pipeline(mailbox)
+                except Exception as e:
+                    logger.error('Background sync of %s failed: %s', mailbox, e)
+        if self._pool is not None:
+            for mailbox, _, error in self._pool.collect():
+                if error:
+                    logger.error('Background sync of %s failed: %s', mailbox, error)
+
+
+_worker = BackgroundSync()
+
+
+def start_background_sync():
+    """Starts this process's background sync thread (idempotent)."""
+    return _worker.start()
+
+
+def latest_version(mailbox='me'):
+    """Returns (snapshot id, updated_at) of the latest result for a mailbox, or None."""
+    return store.latest_version(mailbox)
+
+
+def result_for_snapshot(snapshot_id, mailbox='me'):
+    """Returns the latest result if it was published as `snapshot_id`, or None."""
+    return store.get(mailbox, snapshot_id)
+
+
+def cluster_summary(snapshot_id, mailbox='me'):
+    """Returns {cluster id: {count, top_terms}} for a snapshot while it is the latest, or None."""
+    return store.summary(mailbox, snapshot_id)
+
+
+def cluster_page(snapshot_id, cluster_id, start, limit, mailbox='me'):
+    """Returns one page of a cluster's emails, or None once the snapshot is no longer kept."""
+    return store.page(mailbox, snapshot_id, cluster_id, start, limit)
+
+
+def request_refresh(mailbox='me'):
+    """Asks the background worker to refresh a mailbox as soon as possible."""
+    store.request_refresh(mailbox)
@@ -0,0 +1,370 @@
+"""Benchmarks for the request hot paths.
+
+Runs offline against dummy credentials and a synthetic Gmail mailbox
+(``fake_gmail``) and prints results as JSON:
+
+    python benchmark.py                              # all benchmarks
+    python benchmark.py service_setup                # just one
+    python benchmark.py fetch_emails --sizes 200 1000 --latency 0.05
+    python benchmark.py --output bench.json          # save for comparison
+    python benchmark.py cold_start                   # exits 1 if over the import budget
+    python benchmark.py accounts --accounts 200      # multi-account sync throughput
+    python benchmark.py search --sizes 100000        # search index updates and queries
+
+Mailbox-size benchmarks run in a scratch directory, so caches, snapshots and
+model artifacts from a run never touch the working tree.
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+DEFAULT_SIZES = [200, 1000, 10000, 100000]
+DEFAULT_ACCOUNTS = 50
+ACCOUNT_MESSAGES = 200
+UNLIMITED_RATE = 1e12
+# Seconds a fresh interpreter may take to import a web app. Both apps load the
+# Google client and scikit-learn lazily, so importing them must not pull in
+# any of DEFERRED_MODULES.
+IMPORT_BUDGET_SECONDS = float(os.environ.get('IMPORT_BUDGET_SECONDS', '0.75'))
+DEFERRED_MODULES = ('sklearn', 'scipy', 'pandas', 'googleapiclient', 'google_auth_oauthlib', 'httplib2')
+# App module -> health check route timed right after import, if it has one.
+COLD_START_APPS = {'app': None, 'app_production': '/api/status'}
+COLD_START_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter() - started
+status = None
+started = time.perf_counter()
+if {path!r}:
+    status = {module}.app.test_client().get({path!r}, base_url='https://localhost').status_code
+print(json.dumps({{'import_s': imported, 'status_s': time.perf_counter() - started, 'status': status,
+                  'loaded': [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def timed(func, repeat):
+    """Calls `func` `repeat` times and returns timing stats in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        'repeat': repeat,
+        'min_ms': round(samples[0], 4),
+        'median_ms': round(statistics.median(samples), 4),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 4),
+        'mean_ms': round(statistics.fmean(samples), 4),
+    }
+
+
+def bench_service_setup(repeat=200):
+    """Per-request Gmail service setup: rebuilding from token.json vs the per-process pool."""
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+    from gmail_assistant import SCOPES, GmailServicePool
+
+    token = {
+        'token': 'benchmark', 'refresh_token': 'benchmark', 'client_id': 'benchmark',
+        'client_secret': 'benchmark', 'scopes': SCOPES,
+        'expiry': (datetime.now(timezone.utc) + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'token.json')
+        with open(path, 'w') as f:
+            json.dump(token, f)
+
+        def rebuild():
+            creds = Credentials.from_authorized_user_file(path, SCOPES)
+            build('gmail', 'v1', credentials=creds)
+
+        pool = GmailServicePool(load=lambda: Credentials.from_authorized_user_file(path, SCOPES))
+        pool.get()
+        return {'rebuild_per_request': timed(rebuild, repeat), 'pooled': timed(pool.get, repeat)}
+
+
+def repeat_for(size):
+    """Fewer repeats for bigger mailboxes, so the suite finishes in minutes."""
+    return max(1, min(5, 2000 // size))
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silences the app's progress prints while timing."""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def unthrottled():
+    """Lifts the quota scheduler's rate so the fake service is the only limit."""
+    import quota
+    quota.scheduler = quota.QuotaScheduler(max_rate=UNLIMITED_RATE, min_rate=UNLIMITED_RATE)
+
+
+def bench_fetch_emails(sizes, latency):
+    """fetch_emails over a fake mailbox: list pages plus batched metadata gets."""
+    from fake_gmail import FakeGmailService, make_messages
+    from gmail_assistant import fetch_emails
+
+    results = {}
+    for size in sizes:
+        service = FakeGmailService(make_messages(size), latency=latency)
+        with quiet():
+            stats = timed(lambda: fetch_emails(service, max_results=size), repeat_for(size))
+        stats['round_trips'] = service.round_trips // stats['repeat']
+        results[size] = stats
+    return results
+
+
+def bench_cluster_emails(sizes, latency):
+    """cluster_emails, including the choice of cluster count.
+
+    Also timed as the baseline without near-duplicate collapsing and rule
+    buckets, and reports how many rows still reach KMeans and the share of
+    messages the rules sorted.
+    """
+    import rules
+    from dedup import collapse
+    from fake_gmail import make_messages
+    from features import extract_columns
+    from gmail_assistant import cluster_emails, project_message
+
+    results = {}
+    for size in sizes:
+        emails = [project_message(m) for m in make_messages(size)]
+        with quiet():
+            stats = timed(lambda: cluster_emails(emails), repeat_for(size))
+            stats['baseline'] = timed(lambda: cluster_emails(emails, collapse_duplicates=False, use_rules=False),
+                                      repeat_for(size))
+        _, columns, members = collapse(emails, extract_columns(emails))
+        matched = rules.engine.match(columns) != rules.UNMATCHED
+        stats['kmeans_rows'] = int((~matched).sum())
+        stats['rule_hit_rate'] = round(sum(len(m) for m, hit in zip(members, matched) if hit) / size, 4)
+        results[size] = stats
+    return results
+
+
+def bench_routes(sizes, latency):
+    """The web routes: app.py's index (sync + cluster) and app_production's precomputed views."""
+    import app as dev_app
+    import app_production
+    import background
+    import inbox_sync
+    import online_clustering
+    from fake_gmail import FakeGmailService, make_messages
+    from message_cache import MessageCache
+    from model_store import ModelStore
+
+    app_production.limiter.enabled = False
+    results = {}
+    for size in sizes:
+        service = FakeGmailService(make_messages(size), latency=latency)
+        # Fresh per-process state for each mailbox size.
+        inbox_sync._inboxes['me'] = inbox_sync.InboxSync(
+            max_results=size, cache=MessageCache(f'cache-{size}.sqlite3', projection=inbox_sync.PROJECTION))
+        online_clustering._clusterers['me'] = online_clustering.OnlineClusterer(store=ModelStore(f'models-{size}'))
+        dev_app.get_gmail_service = lambda: service
+
+        client = dev_app.app.test_client()
+        with quiet():
+            first = timed(lambda: client.get('/'), 1)
+            warm = timed(lambda: client.get('/'), repeat_for(size))
+            background.run_pipeline(service=service)
+        production = app_production.app.test_client()
+        with production.session_transaction(base_url='https://localhost') as session:
+            session['gmail_authenticated'] = True
+        results[size] = {
+            'index_first': first,
+            'index_warm': warm,
+            'production_index': timed(lambda: production.get('/', base_url='https://localhost'), repeat_for(size)),
+            'api_clusters': timed(lambda: production.get('/api/clusters', base_url='https://localhost'),
+                                  repeat_for(size)),
+        }
+    return results
+
+
+def bench_archive(sizes, latency):
+    """Archiving a whole mailbox with chunked, parallel batchModify calls."""
+    from bulk_modify import archive_messages
+    from fake_gmail import FakeGmailService, make_messages
+
+    results = {}
+    for size in sizes:
+        repeat = repeat_for(size)
+        # Archiving changes labels, so every run gets its own mailbox.
+        services = iter([FakeGmailService(make_messages(size), latency=latency) for _ in range(repeat)])
+        ids = [m['id'] for m in make_messages(size)]
+        results[size] = timed(lambda: archive_messages(next(services), ids), repeat)
+    return results
+
+
+# Search box queries timed by the search benchmark.
+SEARCH_QUERIES = ['invoice', 'from:alice', 'build fail', 'subject:security alert', 'newsl']
+NEW_MESSAGES = 100
+
+
+def bench_search(sizes, latency):
+    """The search index: indexing a mailbox, indexing newly arrived mail, and queries."""
+    from fake_gmail import make_messages
+    from search_index import SearchIndex
+
+    results = {}
+    for size in sizes:
+        messages = make_messages(size + NEW_MESSAGES)
+        index = SearchIndex(f'search-{size}.sqlite3')
+        results[size] = {
+            'index_mailbox': timed(lambda: index.replace('me', messages[NEW_MESSAGES:]), 1),
+            'index_new': timed(lambda: index.add('me', messages[:NEW_MESSAGES]), 1),
+            'queries': {query: dict(timed(lambda: index.search('me', query), 20),
+                                    matches=index.search('me', query)[0])
+                        for query in SEARCH_QUERIES},
+        }
+    return results
+
+
+def bench_accounts(accounts, latency):
+    """Syncing many fake accounts on the shard pool: a cold round, then a warm incremental one."""
+    import functools
+    from fake_gmail import fake_account_service
+    from shards import SYNC_SHARDS, ShardPool
+
+    names = [f'user{n:04d}@example.com' for n in range(accounts)]
+    factory = functools.partial(fake_account_service, size=ACCOUNT_MESSAGES, latency=latency)
+    # Shards are fresh interpreters, so lift their quota through the environment.
+    os.environ['GMAIL_QUOTA_PER_SECOND'] = str(UNLIMITED_RATE)
+    results = {}
+    for shards in sorted({1, SYNC_SHARDS}):
+        pool = ShardPool(shards=shards, service_factory=factory)
+        try:
+            rounds = {}
+            for name in ('cold', 'warm'):
+                started = time.perf_counter()
+                done = pool.run(names)
+                seconds = time.perf_counter() - started
+                rounds[name] = {
+                    'seconds': round(seconds, 3),
+                    'accounts_per_second': round(len(names) / seconds, 2),
+                    'failed': sum(1 for _, error in done.values() if error),
+                    'sync_median_ms': round(statistics.median(
+                        stats['seconds'] for stats, _ in done.values() if stats) * 1000, 2),
+                }
+        finally:
+            pool.shutdown()
+        results[f'{shards}_shards'] = rounds
+    return results
+
+
+def bench_cold_start(repeat=5):
+    """Importing each web app in a fresh interpreter, then its first health check."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [
+        os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')])))
+    results = {}
+    for module, path in COLD_START_APPS.items():
+        script = COLD_START_SCRIPT.format(module=module, path=path, deferred=DEFERRED_MODULES)
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True,
+                                    text=True, check=True).stdout
+            runs.append(json.loads(output.splitlines()[-1]))
+        import_s = statistics.median(run['import_s'] for run in runs)
+        loaded = sorted({name for run in runs for name in run['loaded']})
+        results[module] = {
+            'repeat': repeat,
+            'import_median_ms': round(import_s * 1000, 2),
+            'deferred_modules_loaded': loaded,
+            'budget_ms': IMPORT_BUDGET_SECONDS * 1000,
+            'within_budget': import_s <= IMPORT_BUDGET_SECONDS and not loaded,
+        }
+        if path:
+            results[module]['first_status_median_ms'] = round(
+                statistics.median(run['status_s'] for run in runs) * 1000, 2)
+            results[module]['status_codes'] = sorted({run['status'] for run in runs})
+    return results
+
+
+def over_budget(results):
+    """Names of benchmarks whose results report ``within_budget: false``."""
+    failed = []
+    for name, result in results.items():
+        if isinstance(result, dict):
+            if result.get('within_budget') is False:
+                failed.append(name)
+            failed.extend(f'{name}.{inner}' for inner in over_budget(result))
+    return failed
+
+
+BENCHMARKS = {
+    'service_setup': bench_service_setup,
+    'cold_start': bench_cold_start,
+    'fetch_emails': bench_fetch_emails,
+    'cluster_emails': bench_cluster_emails,
+    'routes': bench_routes,
+    'archive': bench_archive,
+    'accounts': bench_accounts,
+    'search': bench_search,
+}
+# Benchmarks that run once per mailbox size.
+SIZED = {'fetch_emails', 'cluster_emails', 'routes', 'archive', 'search'}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', default=[],
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--sizes', nargs='+', type=int, default=DEFAULT_SIZES,
+                        help='mailbox sizes for the per-size benchmarks (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds of simulated latency per Gmail round trip (default: 0)')
+    parser.add_argument('--accounts', type=int, default=DEFAULT_ACCOUNTS,
+                        help='simulated accounts for the accounts benchmark (default: %(default)s)')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))} (choose from {', '.join(BENCHMARKS)})")
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    unthrottled()
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            for name in args.benchmarks or BENCHMARKS:
+                if name in SIZED:
+                    results[name] = BENCHMARKS[name](args.sizes, args.latency)
+                elif name == 'accounts':
+                    results[name] = bench_accounts(args.accounts, args.latency)
+                else:
+                    results[name] = BENCHMARKS[name]()
+        finally:
+            os.chdir(cwd)
+    report = json.dumps({
+        'python': sys.version.split()[0],
+        'sizes': args.sizes,
+        'latency': args.latency,
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+    failed = over_budget(results)
+    if failed:
+        sys.exit(f"over budget: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Bulk label changes for any number of messages.
+
+``messages.batchModify`` accepts at most 1000 ids per call, so large id lists
+are split into chunks that run concurrently on a small thread pool. Chunks
+that hit rate limits are retried by the quota scheduler with jittered
+exponential backoff, and the outcome of every chunk is reported back to the
+caller.
+"""
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from gmail_assistant import thread_http
+from quota import execute
+
+MAX_IDS_PER_CALL = 1000
+DEFAULT_WORKERS = 4
+
+
+def _modify_chunk(service, index, ids, body, user_id):
+    request = service.users().messages().batchModify(userId=user_id, body=dict(body, ids=ids))
+    try:
+        execute(request, 'messages.batchModify', http=thread_http(service))
+        return {'chunk': index, 'count': len(ids), 'success': True}
+    except Exception as e:
+        return {'chunk': index, 'count': len(ids), 'success': False, 'error': str(e)}
+
+
+def batch_modify(service, message_ids, add_label_ids=None, remove_label_ids=None, user_id='me',
+                 chunk_size=MAX_IDS_PER_CALL, max_workers=DEFAULT_WORKERS):
+    """Adds and removes labels on `message_ids`, chunked and in parallel.
+
+    Returns one result dict per chunk with its size, whether it succeeded and
+    the error if it did not, in chunk order.
+    """
+    message_ids = list(dict.fromkeys(message_ids))
+    body = {}
+    if add_label_ids:
+        body['addLabelIds'] = list(add_label_ids)
+    if remove_label_ids:
+        body['removeLabelIds'] = list(remove_label_ids)
+    if not message_ids or not body:
+        return []
+
+    chunks = [message_ids[i:i + chunk_size] for i in range(0, len(message_ids), chunk_size)]
+    if len(chunks) == 1:
+        return [_modify_chunk(service, 0, chunks[0], body, user_id)]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as pool:
+        # Each chunk runs in a copy of this context to keep the caller's quota priority.
+        futures = [pool.submit(contextvars.copy_context().run, _modify_chunk, service, i, chunk, body, user_id)
+                   for i, chunk in enumerate(chunks)]
+        return [future.result() for future in futures]
+
+
+def archive_messages(service, message_ids, user_id='me'):
+    """Archives messages by removing the INBOX label."""
+    return batch_modify(service, message_ids, remove_label_ids=['INBOX'], user_id=user_id)
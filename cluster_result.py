@@ -0,0 +1,141 @@
+"""Compact result type for clustered emails.
+
+``ClusterResult`` keeps ids, subjects, labels and references to the message
+dicts as aligned NumPy arrays. Grouping by cluster is a single radix sort of
+the labels, and rows are exposed through lightweight ``__slots__`` views
+instead of copied records, so rendering a page does not duplicate payloads.
+A row may stand for a group of near-duplicate messages (see ``dedup``); its
+member ids are what archiving acts on. Labels of rule buckets (see ``rules``)
+carry a name.
+"""
+import re
+from collections import Counter
+
+import numpy as np
+
+_WORD = re.compile(r"[a-z][a-z0-9']+")
+_REPLY_PREFIXES = {'re', 'fw', 'fwd'}
+
+
+class ClusterRow:
+    """View of one clustered email; supports both ``row.subject`` and ``row['subject']``."""
+
+    __slots__ = ('_result', '_index')
+
+    def __init__(self, result, index):
+        self._result = result
+        self._index = index
+
+    @property
+    def id(self):
+        return self._result.ids[self._index]
+
+    @property
+    def email(self):
+        return self._result.emails[self._index]
+
+    @property
+    def subject(self):
+        return self._result.subjects[self._index]
+
+    @property
+    def cluster(self):
+        return int(self._result.labels[self._index])
+
+    @property
+    def snippet(self):
+        return self.email.get('snippet', '')
+
+    @property
+    def member_ids(self):
+        return self._result.members[self._index]
+
+    @property
+    def count(self):
+        return len(self.member_ids)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f'ClusterRow(id={self.id!r}, cluster={self.cluster})'
+
+
+class ClusterResult:
+    """Aligned arrays of emails, ids, subjects, cluster labels and member ids.
+
+    `members` lists the message ids each row stands for; by default every
+    row is just its own message. `names` maps the labels of named buckets
+    to their names.
+    """
+
+    __slots__ = ('emails', 'ids', 'subjects', 'labels', 'members', 'names', '_groups')
+
+    def __init__(self, emails, ids, subjects, labels, members=None, names=None):
+        self.emails = np.empty(len(emails), dtype=object)
+        self.emails[:] = emails
+        self.ids = np.asarray(ids, dtype=object)
+        self.subjects = np.asarray(subjects, dtype=object)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.members = np.empty(len(emails), dtype=object)
+        self.members[:] = members if members is not None else [[message_id] for message_id in self.ids]
+        self.names = dict(names or {})
+        self._groups = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def message_count(self):
+        """Number of messages, counting every member of a collapsed row."""
+        return sum(len(ids) for ids in self.members)
+
+    def named_message_count(self):
+        """Number of messages sorted into named buckets rather than clustered."""
+        return sum(len(self.members[i]) for label, index in self.group_indices().items()
+                   if label in self.names for i in index)
+
+    def __iter__(self):
+        return (ClusterRow(self, i) for i in range(len(self)))
+
+    def cluster_ids(self):
+        """Returns the cluster labels present, in ascending order."""
+        return list(self.group_indices())
+
+    def group_indices(self):
+        """Returns {cluster label: array of row indices}, computed once."""
+        if self._groups is None:
+            if not len(self):
+                self._groups = {}
+                return self._groups
+            # A stable sort of 16-bit keys is a radix sort, i.e. linear time.
+            keys = self.labels.astype(np.int16) if self.labels.max() < 2 ** 15 else self.labels
+            order = np.argsort(keys, kind='stable')
+            ordered = self.labels[order]
+            starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+            self._groups = dict(zip(ordered[starts].tolist(), np.split(order, starts[1:])))
+        return self._groups
+
+    def groups(self):
+        """Returns {cluster label: [ClusterRow, ...]} in original row order."""
+        return {label: [ClusterRow(self, i) for i in index] for label, index in self.group_indices().items()}
+
+    def message_ids(self):
+        """Returns {cluster label: [message id, ...]}, with collapsed rows expanded to all their members."""
+        return {label: [message_id for i in index for message_id in self.members[i]]
+                for label, index in self.group_indices().items()}
+
+    def top_terms(self, n=5):
+        """Returns {cluster label: the `n` most common subject words}, skipping stop words."""
+        from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+        terms = {}
+        for label, index in self.group_indices().items():
+            counts = Counter(word for subject in self.subjects[index] for word in _WORD.findall(subject.lower())
+                             if word not in ENGLISH_STOP_WORDS and word not in _REPLY_PREFIXES)
+            terms[label] = [word for word, _ in counts.most_common(n)]
+        return terms
+
+    def to_dataframe(self):
+        """Returns the result as a pandas DataFrame (requires pandas)."""
+        import pandas as pd
+        return pd.DataFrame({'email': self.emails, 'subject': self.subjects, 'cluster': self.labels,
+                             'count': [len(ids) for ids in self.members]})
@@ -0,0 +1,204 @@
+"""Near-duplicate collapsing with MinHash signatures and an LSH index.
+
+Newsletters, CI notifications and alert storms send runs of messages whose
+subject and snippet differ only in a number or a date. Each message's subject
+and snippet are cut into word shingles (digits folded together) and
+summarized by a MinHash signature. The signatures are split into bands, and
+only messages from the same sender domain that share a band are compared.
+Pairs whose signatures agree on at least ``THRESHOLD`` of their positions
+(an estimate of shingle Jaccard similarity) are joined. Each connected group
+is clustered as one row, represented by its first (newest) member, and
+archiving a group expands back to every member id. A ``SignatureCache``
+keeps signatures by message id between calls, so an incremental sync only
+shingles and signs the messages that are new.
+"""
+import re
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import metrics
+from features import take
+
+NUM_PERM = 64
+BANDS = 16
+THRESHOLD = 0.7
+# The start of a snippet is enough to tell near-duplicates apart.
+SNIPPET_CHARS = 100
+# One multiply-shift hash function (a * x + b mod 2**64) >> 32 per permutation.
+_rng = np.random.default_rng(1)
+_A = _rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_B = _rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64)
+_CHUNK = 2 ** 15
+
+# A token of its own marks where one text ends and the next begins.
+_TOKEN = re.compile(r'[a-z0-9]+|\n')
+_DIGITS = re.compile(r'[0-9]+')
+_WORD = re.compile(r'[a-z0-9]')
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix32(values):
+    """Scrambles 64-bit values into 32-bit hashes."""
+    return (values.astype(np.uint64) * _MIX) >> np.uint64(32)
+
+
+def shingle_hashes(texts):
+    """Returns (row, hash) arrays of the word bigrams of each text, digits folded to 0.
+
+    A text of one word is its own shingle, and a text without words gets a
+    shingle of its own so it matches nothing.
+    """
+    # One pass of the regex and of hash() over all texts together; the
+    # hashes are only compared within this process, so hash()'s per-process
+    # salt does not matter.
+    joined = '\n'.join(text.replace('\n', ' ') for text in texts)
+    tokens = _TOKEN.findall(_DIGITS.sub('0', joined.lower()))
+    words = np.fromiter(map(hash, tokens), dtype=np.int64, count=len(tokens)).view(np.uint64)
+    breaks = words == np.int64(hash('\n')).view(np.uint64)
+    rows = np.cumsum(breaks)
+    words, rows = words[~breaks], rows[~breaks]
+    same_row = rows[1:] == rows[:-1]
+    hashes = _mix32(words[:-1][same_row] * np.uint64(31) + words[1:][same_row])
+    hash_rows = rows[:-1][same_row]
+    # Texts with fewer than two words.
+    counts = np.bincount(rows, minlength=len(texts))
+    single = np.flatnonzero(counts == 1)
+    empty = np.flatnonzero(counts == 0)
+    hashes = np.concatenate([hashes, _mix32(words[np.searchsorted(rows, single)]),
+                             _mix32(empty + (1 << 40))])
+    hash_rows = np.concatenate([hash_rows, single, empty])
+    order = np.argsort(hash_rows, kind='stable')
+    return hash_rows[order], hashes[order]
+
+
+def signatures(texts):
+    """Returns the (len(texts), NUM_PERM) MinHash signature matrix."""
+    rows, hashes = shingle_hashes(texts)
+    offsets = np.r_[0, np.cumsum(np.bincount(rows, minlength=len(texts)))]
+    result = np.empty((len(texts), NUM_PERM), dtype=np.uint32)
+    # Hash a bounded number of rows at a time to keep the (shingles, perms) block small.
+    row = 0
+    while row < len(texts):
+        end = int(np.searchsorted(offsets, offsets[row] + _CHUNK, side='right')) - 1
+        end = min(max(end, row + 1), len(texts))
+        block = ((hashes[offsets[row]:offsets[end], None] * _A + _B) >> np.uint64(32)).astype(np.uint32)
+        result[row:end] = np.minimum.reduceat(block, offsets[row:end] - offsets[row], axis=0)
+        row = end
+    return result
+
+
+def text_signatures(texts):
+    """Returns (signatures, alone): each text's MinHash signature, and which texts have no words.
+
+    Texts without words match nothing, not even each other.
+    """
+    if not texts:
+        return np.empty((0, NUM_PERM), dtype=np.uint32), np.empty(0, dtype=bool)
+    # Storms repeat the same text up to its numbers; sign each distinct text once.
+    folded = _DIGITS.sub('0', '\n'.join(text.replace('\n', ' ') for text in texts).lower()).split('\n')
+    keys, distinct = {}, []
+    inverse = np.empty(len(folded), dtype=np.int64)
+    for i, text in enumerate(folded):
+        if text not in keys:
+            keys[text] = len(distinct)
+            distinct.append(text)
+        inverse[i] = keys[text]
+    alone = np.array([_WORD.search(text) is None for text in folded], dtype=bool)
+    return signatures(distinct)[inverse], alone
+
+
+def group_signatures(sig, alone, domains):
+    """Returns a list of row index arrays, one per group, in order of their first row."""
+    n = len(sig)
+    if n < 2:
+        return [np.arange(n)] if n else []
+    codes = {}
+    domain_codes = np.fromiter((codes.setdefault(domain, len(codes)) for domain in domains),
+                               dtype=np.uint32, count=n)
+    # A domain code of its own keeps each text without words out of every bucket.
+    domain_codes[alone] = domain_codes.max() + 1 + np.arange(np.count_nonzero(alone), dtype=np.uint32)
+    rows = NUM_PERM // BANDS
+    pairs_i, pairs_j = [], []
+    for band in range(BANDS):
+        # Hash the band and domain into one integer; a collision only costs
+        # a comparison, since candidates are checked on the whole signature.
+        keys = domain_codes.astype(np.uint64)
+        for column in range(band * rows, (band + 1) * rows):
+            keys = keys * _MIX + sig[:, column]
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        # Compare each row with the first row of its bucket.
+        heads = first[inverse.ravel()]
+        candidates = np.flatnonzero(heads != np.arange(n))
+        similar = (sig[candidates] == sig[heads[candidates]]).mean(axis=1) >= THRESHOLD
+        pairs_i.append(candidates[similar])
+        pairs_j.append(heads[candidates[similar]])
+    pairs_i, pairs_j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    graph = coo_matrix((np.ones(len(pairs_i), dtype=np.int8), (pairs_i, pairs_j)), shape=(n, n))
+    _, components = connected_components(graph, directed=False)
+    # Number the groups in order of their first row, then list each group's rows.
+    _, first, components = np.unique(components, return_index=True, return_inverse=True)
+    components = np.argsort(np.argsort(first))[components.ravel()]
+    order = np.argsort(components, kind='stable')
+    bounds = np.r_[np.flatnonzero(np.diff(components[order])) + 1, n]
+    return [order[start:end] for start, end in zip(np.r_[0, bounds[:-1]], bounds)]
+
+
+def near_duplicate_groups(texts, domains):
+    """Returns a list of row index arrays, one per group, in order of their first row."""
+    return group_signatures(*text_signatures(texts), domains)
+
+
+def _texts(columns, index):
+    subjects, snippets = columns['subject'], columns['snippet']
+    return [f'{subjects[i]} {snippets[i][:SNIPPET_CHARS]}' for i in index]
+
+
+class SignatureCache:
+    """MinHash signatures by message id; a message's text never changes, so each is signed once."""
+
+    def __init__(self):
+        self._rows = {}
+        self._signatures = np.empty((0, NUM_PERM), dtype=np.uint32)
+        self._alone = np.empty(0, dtype=bool)
+
+    def signatures(self, columns):
+        """Returns (signatures, alone) for the rows of `columns`, signing only unseen messages."""
+        ids = columns['id']
+        missing = [i for i, message_id in enumerate(ids) if message_id not in self._rows]
+        if missing:
+            sig, alone = text_signatures(_texts(columns, missing))
+            start = len(self._signatures)
+            self._signatures = np.concatenate([self._signatures, sig])
+            self._alone = np.concatenate([self._alone, alone])
+            self._rows.update((ids[i], start + n) for n, i in enumerate(missing))
+        metrics.inc('dedup_signatures_total', len(missing), result='signed')
+        metrics.inc('dedup_signatures_total', len(ids) - len(missing), result='cached')
+        rows = np.fromiter((self._rows[message_id] for message_id in ids), dtype=np.int64, count=len(ids))
+        sig, alone = self._signatures[rows], self._alone[rows]
+        # Forget messages that left the inbox once they are most of the cache.
+        if len(self._signatures) > 2 * len(ids):
+            self._rows = {message_id: n for n, message_id in enumerate(ids)}
+            self._signatures, self._alone = sig, alone
+        return sig, alone
+
+
+def collapse(emails, columns, cache=None):
+    """Collapses near-duplicates to one row each.
+
+    Takes the emails and their ``features.extract_columns`` columns and
+    returns (emails, columns, member ids) with one row per group, where
+    member ids lists every message id the row stands for. Signatures are
+    looked up in `cache`, a ``SignatureCache``, if one is given.
+    """
+    with metrics.timer('pipeline_stage_seconds', stage='dedup'):
+        if cache is None:
+            sig, alone = text_signatures(_texts(columns, range(len(emails))))
+        else:
+            sig, alone = cache.signatures(columns)
+        groups = group_signatures(sig, alone, columns['domain'])
+    keep = np.array([group[0] for group in groups], dtype=np.int64)
+    members = [columns['id'][group].tolist() for group in groups]
+    metrics.inc('dedup_messages_collapsed_total', len(emails) - len(keep))
+    return [emails[i] for i in keep], take(columns, keep), members
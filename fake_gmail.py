@@ -0,0 +1,407 @@
+"""In-memory stand-in for the Gmail API service object.
+
+Mimics the small slice of ``googleapiclient`` that the app uses
+(``users().messages().list/get/batchModify``, ``users().history().list``,
+``users().getProfile`` and batch HTTP requests) so the fetch code can be
+exercised without network access. Every HTTP round trip is counted and can be
+delayed by a configurable latency, and calls can be made to fail with random
+or quota-driven 429s. ``mock_transport`` serves the same fake
+mailbox over the REST API for ``httpx`` based clients.
+"""
+import asyncio
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from urllib.parse import parse_qs
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from quota import QUOTA_UNITS
+
+# Gmail rejects batch requests with more than this many calls.
+MAX_BATCH_CALLS = 100
+
+SUBJECTS = [
+    'Your weekly newsletter', 'Build failed on main', 'Invoice #{n} is due',
+    'Team standup notes', 'Special offer: {n}% off', 'Re: Q{n} planning',
+    'Your order has shipped', 'Security alert for your account',
+    'Lunch on Friday?', 'Pull request #{n} merged',
+]
+SENDERS = [
+    'news@updates.example.com', 'ci@builds.example.org', 'billing@shop.example.com',
+    'alice@team.example.com', 'deals@promo.example.net', 'bob@team.example.com',
+]
+PEOPLE = ['carol', 'dave', 'erin', 'frank', 'grace', 'heidi', 'ivan', 'judy', 'mallory', 'oscar']
+PERSONAL_DOMAINS = ['team.example.com', 'partner.example.org', 'mail.example.net']
+SNIPPET_WORDS = (
+    'please review the attached update for this week thanks let me know if you have any questions '
+    'your account order invoice payment meeting schedule project release build deploy report '
+    'discount offer sale limited time newsletter digest summary reminder follow up notes agenda'
+).split()
+
+# Mail volume per sender is heavy-tailed: a few automated senders send most
+# of it, so sender ranks are weighted Zipf-style.
+SENDER_POOL = SENDERS + [f'{name}@{domain}' for domain in PERSONAL_DOMAINS for name in PEOPLE]
+SENDER_CUM_WEIGHTS = list(itertools.accumulate(1 / rank for rank in range(1, len(SENDER_POOL) + 1)))
+CATEGORY_LABELS = {
+    'news': 'CATEGORY_UPDATES', 'ci': 'CATEGORY_UPDATES', 'billing': 'CATEGORY_UPDATES',
+    'deals': 'CATEGORY_PROMOTIONS',
+}
+
+
+def make_http_error(status, reason='error'):
+    """Builds an ``HttpError`` like the one googleapiclient raises."""
+    resp = httplib2.Response({'status': status})
+    resp.reason = reason
+    content = json.dumps({'error': {'code': status, 'message': reason,
+                                    'errors': [{'reason': reason}]}}).encode('utf-8')
+    return HttpError(resp, content)
+
+
+def make_message(n, rng=random):
+    """Builds a synthetic full-format Gmail message.
+
+    Senders follow a heavy-tailed distribution, about a third of subjects are
+    replies or forwards, and snippet and body lengths vary per message.
+    Automated senders reuse one snippet per subject template, like
+    notification mail, so their messages are near-duplicates.
+    """
+    sender = rng.choices(SENDER_POOL, cum_weights=SENDER_CUM_WEIGHTS)[0]
+    template = rng.randrange(len(SUBJECTS))
+    subject = SUBJECTS[template].format(n=n % 100)
+    if rng.random() < 0.3:
+        subject = rng.choice(('Re: ', 'Fwd: ', 'Re: Re: ')) + subject
+    headers = [
+        {'name': 'Subject', 'value': subject},
+        {'name': 'From', 'value': sender},
+        {'name': 'To', 'value': 'me@example.com'},
+    ]
+    if sender.startswith(('news@', 'deals@')):
+        headers.append({'name': 'List-Id', 'value': f'<{sender.split("@")[1]}>'})
+    labels = ['INBOX']
+    if rng.random() < 0.4:
+        labels.append('UNREAD')
+    if sender.split('@')[0] in CATEGORY_LABELS:
+        labels.append(CATEGORY_LABELS[sender.split('@')[0]])
+    size = int(rng.lognormvariate(8, 1))
+    if sender.split('@')[0] in CATEGORY_LABELS:
+        snippet = ' '.join(SNIPPET_WORDS[template * 3:template * 3 + 20])
+    else:
+        snippet = ' '.join(rng.choices(SNIPPET_WORDS, k=rng.randint(4, 30)))
+    return {
+        'id': f'msg{n:08d}',
+        'threadId': f'thr{n:08d}',
+        'labelIds': labels,
+        'snippet': f'{subject} - ' + snippet,
+        'internalDate': str(1700000000000 + n * 1000 + rng.randrange(1000)),
+        'sizeEstimate': size,
+        'payload': {
+            'mimeType': 'text/plain',
+            'headers': headers,
+            # Only the size is realistic, so large mailboxes stay small in memory.
+            'body': {'size': size, 'data': 'x' * min(size, 512)},
+        },
+    }
+
+
+def make_messages(count, seed=42):
+    """Builds ``count`` synthetic messages, newest first."""
+    rng = random.Random(seed)
+    return [make_message(n, rng) for n in range(count, 0, -1)]
+
+
+_account_services = {}
+
+
+def fake_account_service(account, size=200, latency=0.0):
+    """One fake mailbox per account, kept for the life of the process.
+
+    Picklable as a ``functools.partial``, so it can stand in for stored
+    credentials as the ``service_factory`` of a ``shards.ShardPool``.
+    """
+    if account not in _account_services:
+        seed = zlib.crc32(account.encode('utf-8'))
+        _account_services[account] = FakeGmailService(make_messages(size, seed=seed), latency=latency, seed=seed)
+    return _account_services[account]
+
+
+class FakeRequest:
+    """A deferred API call; ``execute()`` costs one round trip."""
+
+    def __init__(self, service, func):
+        self._service = service
+        self._func = func
+
+    def execute(self, http=None, num_retries=0):
+        self._service._round_trip()
+        return self._func()
+
+
+class FakeBatchHttpRequest:
+    """Runs queued requests in a single round trip, like ``BatchHttpRequest``."""
+
+    def __init__(self, service, callback=None):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if len(self._requests) >= MAX_BATCH_CALLS:
+            raise ValueError(f'Exceeded the maximum calls({MAX_BATCH_CALLS}) in a single batch request.')
+        if request_id is None:
+            request_id = str(len(self._requests) + 1)
+        self._requests.append((request_id, request, callback))
+
+    def execute(self, http=None):
+        self._service._round_trip()
+        for request_id, request, callback in self._requests:
+            callback = callback or self._callback
+            try:
+                response, exception = request._func(), None
+            except HttpError as e:
+                response, exception = None, e
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class _Messages:
+    def __init__(self, service):
+        self._service = service
+
+    def list(self, userId='me', maxResults=100, pageToken=None, q=None, labelIds=None):
+        return FakeRequest(self._service, lambda: self._service._list(maxResults, pageToken, labelIds))
+
+    def get(self, userId='me', id=None, format='full', metadataHeaders=None):
+        return FakeRequest(self._service, lambda: self._service._get(id, format, metadataHeaders))
+
+    def batchModify(self, userId='me', body=None):
+        return FakeRequest(self._service, lambda: self._service._batch_modify(body or {}))
+
+
+class _History:
+    def __init__(self, service):
+        self._service = service
+
+    def list(self, userId='me', startHistoryId=None, pageToken=None, maxResults=100,
+             historyTypes=None, labelId=None):
+        return FakeRequest(self._service,
+                           lambda: self._service._history(startHistoryId, pageToken, maxResults))
+
+
+class _Users:
+    def __init__(self, service):
+        self._service = service
+
+    def messages(self):
+        return _Messages(self._service)
+
+    def history(self):
+        return _History(self._service)
+
+    def getProfile(self, userId='me'):
+        return FakeRequest(self._service, self._service._profile)
+
+
+class FakeGmailService:
+    """Local Gmail service double with round-trip accounting.
+
+    ``latency`` is slept once per HTTP round trip (a single ``execute()`` or a
+    whole batch). ``failures`` maps a message id to a list of HTTP statuses
+    that ``get`` raises on successive calls before succeeding, and
+    ``modify_failures`` is a list of statuses raised by successive
+    ``batchModify`` calls. ``error_rate`` is the chance that any call fails
+    with a 429, and ``quota_per_second`` makes calls fail with a 429 once more
+    than that many quota units were spent in the last second. Mailbox changes
+    made through ``add_message``, ``delete_message`` and ``batchModify`` are
+    recorded in a history log served by ``users().history().list``.
+    """
+
+    def __init__(self, messages=None, latency=0.0, failures=None, modify_failures=None,
+                 error_rate=0.0, quota_per_second=None, seed=0):
+        self.messages = {m['id']: m for m in (messages or [])}
+        self.order = [m['id'] for m in (messages or [])]
+        self.latency = latency
+        self.failures = {k: list(v) for k, v in (failures or {}).items()}
+        self.modify_failures = list(modify_failures or [])
+        self.error_rate = error_rate
+        self.quota_per_second = quota_per_second
+        self.rate_limited = 0
+        self.round_trips = 0
+        self.calls = {}
+        self.history_id = 1000
+        self.history = []
+        self.oldest_history_id = self.history_id
+        self._spent = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def users(self):
+        return _Users(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchHttpRequest(self, callback=callback)
+
+    def add_message(self, message):
+        """Delivers a new message, newest first."""
+        self.messages[message['id']] = message
+        self.order.insert(0, message['id'])
+        self._record('messagesAdded', message)
+
+    def delete_message(self, message_id):
+        """Permanently deletes a message."""
+        message = self.messages.pop(message_id)
+        self.order.remove(message_id)
+        self._record('messagesDeleted', message)
+
+    def expire_history(self):
+        """Drops the history log, so older ``startHistoryId`` values get a 404."""
+        self.history = []
+        self.oldest_history_id = self.history_id
+
+    def _record(self, kind, message, label_ids=None):
+        self.history_id += 1
+        ref = {'id': message['id'], 'threadId': message.get('threadId'),
+               'labelIds': list(message.get('labelIds', []))}
+        change = {'message': ref}
+        if label_ids is not None:
+            change['labelIds'] = label_ids
+        self.history.append({'id': str(self.history_id), 'messages': [ref], kind: [change]})
+
+    def _round_trip(self, sleep=True):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency and sleep:
+            time.sleep(self.latency)
+
+    def _count(self, method):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            throttled = self.error_rate and self._rng.random() < self.error_rate
+            if self.quota_per_second is not None:
+                now = time.monotonic()
+                self._spent = [(t, units) for t, units in self._spent if now - t < 1.0]
+                if sum(units for _, units in self._spent) + QUOTA_UNITS[method] > self.quota_per_second:
+                    throttled = True
+                else:
+                    self._spent.append((now, QUOTA_UNITS[method]))
+            if throttled:
+                self.rate_limited += 1
+        if throttled:
+            raise make_http_error(429, 'rateLimitExceeded')
+
+    def _list(self, max_results, page_token, label_ids=None):
+        self._count('messages.list')
+        matching = [i for i in self.order
+                    if all(l in self.messages[i].get('labelIds', []) for l in (label_ids or []))]
+        start = int(page_token or 0)
+        page = matching[start:start + max_results]
+        response = {'resultSizeEstimate': len(matching)}
+        if page:
+            response['messages'] = [{'id': i, 'threadId': self.messages[i]['threadId']} for i in page]
+        if start + max_results < len(matching):
+            response['nextPageToken'] = str(start + max_results)
+        return response
+
+    def _profile(self):
+        self._count('getProfile')
+        return {'emailAddress': 'me@example.com', 'messagesTotal': len(self.messages),
+                'historyId': str(self.history_id)}
+
+    def _history(self, start_history_id, page_token, max_results):
+        self._count('history.list')
+        if start_history_id is None or int(start_history_id) < self.oldest_history_id:
+            raise make_http_error(404, 'notFound')
+        records = [h for h in self.history if int(h['id']) > int(start_history_id)]
+        start = int(page_token or 0)
+        response = {'historyId': str(self.history_id)}
+        if records[start:start + max_results]:
+            response['history'] = records[start:start + max_results]
+        if start + max_results < len(records):
+            response['nextPageToken'] = str(start + max_results)
+        return response
+
+    def _get(self, message_id, format='full', metadata_headers=None):
+        self._count('messages.get')
+        pending = self.failures.get(message_id)
+        if pending:
+            raise make_http_error(pending.pop(0))
+        if message_id not in self.messages:
+            raise make_http_error(404, 'notFound')
+        message = self.messages[message_id]
+        if format == 'full':
+            return message
+        # metadata and minimal responses carry no body; metadata keeps headers.
+        response = {k: v for k, v in message.items() if k != 'payload'}
+        if format == 'metadata':
+            headers = message['payload']['headers']
+            if metadata_headers:
+                headers = [h for h in headers if h['name'] in metadata_headers]
+            response['payload'] = {'mimeType': message['payload']['mimeType'], 'headers': headers}
+        return response
+
+    def _batch_modify(self, body):
+        self._count('messages.batchModify')
+        with self._lock:
+            status = self.modify_failures.pop(0) if self.modify_failures else None
+        if status:
+            raise make_http_error(status, 'rateLimitExceeded' if status == 429 else 'error')
+        ids = body.get('ids', [])
+        if len(ids) > 1000:
+            raise make_http_error(400, 'invalidArgument')
+        for message_id in ids:
+            message = self.messages.get(message_id)
+            if message is None:
+                continue
+            current = message.get('labelIds', [])
+            removed = [l for l in body.get('removeLabelIds', []) if l in current]
+            added = [l for l in body.get('addLabelIds', []) if l not in current]
+            message['labelIds'] = [l for l in current if l not in removed] + added
+            if removed:
+                self._record('labelsRemoved', message, removed)
+            if added:
+                self._record('labelsAdded', message, added)
+        return {}
+
+
+def mock_transport(service):
+    """Returns an ``httpx.MockTransport`` serving `service` as the Gmail REST API.
+
+    Latency is awaited rather than slept, so concurrent async requests overlap
+    the way they would against the real API.
+    """
+    import httpx
+
+    routes = [
+        ('GET', re.compile(r'/users/[^/]+/profile$'), lambda m, q, b: service._profile()),
+        ('GET', re.compile(r'/users/[^/]+/messages$'),
+         lambda m, q, b: service._list(int(q.get('maxResults', ['100'])[0]), q.get('pageToken', [None])[0],
+                                       q.get('labelIds'))),
+        ('POST', re.compile(r'/users/[^/]+/messages/batchModify$'), lambda m, q, b: service._batch_modify(b)),
+        ('GET', re.compile(r'/users/[^/]+/messages/([^/]+)$'),
+         lambda m, q, b: service._get(m.group(1), q.get('format', ['full'])[0], q.get('metadataHeaders'))),
+        ('GET', re.compile(r'/users/[^/]+/history$'),
+         lambda m, q, b: service._history(q.get('startHistoryId', [None])[0], q.get('pageToken', [None])[0],
+                                          int(q.get('maxResults', ['100'])[0]))),
+    ]
+
+    async def handler(request):
+        service._round_trip(sleep=False)
+        if service.latency:
+            await asyncio.sleep(service.latency)
+        query = parse_qs(request.url.query.decode())
+        body = json.loads(request.content) if request.content else {}
+        for method, pattern, call in routes:
+            match = pattern.search(request.url.path)
+            if method == request.method and match:
+                try:
+                    return httpx.Response(200, json=call(match, query, body))
+                except HttpError as e:
+                    return httpx.Response(e.resp.status, content=e.content)
+        return httpx.Response(404, json={'error': {'code': 404, 'message': 'notFound'}})
+
+    return httpx.MockTransport(handler)
@@ -1,19 +1,53 @@
+import contextvars
+import importlib
+import importlib.util
 import os.path
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
-import pandas as pd
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# The Google client and scikit-learn take seconds to import, so they are
+# imported where first used (or by warm_up) to keep web workers' cold start fast.
+import metrics
+from quota import MAX_RETRIES, backoff_delay, execute, is_rate_limited, is_retryable, report_throttled
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
-def get_gmail_service():
-    """Shows basic usage of the Gmail API.
-    Lists the user's Gmail labels.
-    """
+# Gmail accepts up to 100 calls per batch but starts rate limiting above ~50.
+BATCH_SIZE = 50
+HTTP_TIMEOUT = 60
+# messages.list returns at most 500 ids per page.
+LIST_PAGE_SIZE = 500
+
+# Only these headers are requested (format=metadata) and kept per message.
+METADATA_HEADERS = ['Subject', 'From', 'List-Id']
+MESSAGE_FIELDS = ('id', 'threadId', 'snippet', 'labelIds', 'internalDate')
+# Identifies the projection, so caches written with a different one are dropped.
+PROJECTION = ','.join(MESSAGE_FIELDS + tuple(METADATA_HEADERS))
+
+# Imported lazily; warm_up() loads them ahead of the first request.
+HEAVY_MODULES = (
+    'httplib2', 'google_auth_httplib2', 'google.oauth2.credentials', 'google_auth_oauthlib.flow',
+    'googleapiclient.discovery', 'sklearn.cluster', 'online_clustering',
+)
+
+def dependencies_available():
+    """True if the Google client and scikit-learn are installed, without importing them."""
+    return all(importlib.util.find_spec(name.split('.')[0]) for name in HEAVY_MODULES)
+
+def warm_up():
+    """Imports the heavy modules so the first Gmail or clustering call doesn't pay for it."""
+    with metrics.timer('pipeline_stage_seconds', stage='warm_up'):
+        for name in HEAVY_MODULES:
+            importlib.import_module(name)
+
+def load_credentials():
+    """Loads credentials from token.json, refreshing or running the OAuth flow if needed."""
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -44,46 +78,247 @@ def get_gmail_service():
             
             if not creds:
                 raise Exception("No valid credentials file found. Please ensure you have a valid Google API credentials file.")
-        # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+        save_credentials(creds)
+    return creds
 
-    service = build('gmail', 'v1', credentials=creds)
-    return service
+def save_credentials(creds):
+    """Saves the credentials for the next run."""
+    with open('token.json', 'w') as token:
+        token.write(creds.to_json())
 
-def fetch_emails(service, user_id='me', max_results=200):
-    """Fetches the last `max_results` emails from the user's inbox."""
-    try:
-        response = service.users().messages().list(userId=user_id, maxResults=max_results).execute()
-        messages = []
-        if 'messages' in response:
-            messages.extend(response['messages'])
+class GmailServicePool:
+    """Per-process Gmail service with cached credentials.
+
+    The service is built once per worker from the discovery document bundled
+    with googleapiclient (no discovery fetch) on top of a keep-alive
+    connection. Expired access tokens are refreshed under a lock so only one
+    thread refreshes and the new token is written back to token.json.
+    """
+
+    def __init__(self, load=load_credentials, save=save_credentials):
+        self._load = load
+        self._save = save
+        self._lock = threading.Lock()
+        self._service = None
+        self._credentials = None
+        self._pid = None
+
+    def get(self):
+        import httplib2
+        from google.auth.transport.requests import Request
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build
+
+        with self._lock:
+            # Connections must not be shared across a fork.
+            if self._service is None or self._pid != os.getpid():
+                with metrics.timer('pipeline_stage_seconds', stage='auth'):
+                    self._credentials = self._load()
+                    http = AuthorizedHttp(self._credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+                    self._service = build('gmail', 'v1', http=http, static_discovery=True, cache_discovery=False)
+                self._pid = os.getpid()
+            elif not self._credentials.valid:
+                with metrics.timer('pipeline_stage_seconds', stage='auth'):
+                    self._credentials.refresh(Request())
+                    self._save(self._credentials)
+            return self._service
+
+    def credentials(self):
+        """Returns the process's credentials, loading them on first use."""
+        self.get()
+        return self._credentials
+
+    def reset(self):
+        """Drops the cached service, e.g. after the token was revoked."""
+        with self._lock:
+            self._service = None
+
+_service_pool = GmailServicePool()
+_thread_local = threading.local()
+
+def get_gmail_service():
+    """Returns this process's Gmail API service, building it on first use."""
+    return _service_pool.get()
+
+def get_service_credentials():
+    """Returns the OAuth credentials behind this process's Gmail service."""
+    return _service_pool.credentials()
+
+def thread_http(service):
+    """Returns an HTTP client private to this thread, or None for the default.
+
+    httplib2 connections are not thread-safe, so requests executed from
+    helper threads each use their own authorized connection built from the
+    service's credentials.
+    """
+    credentials = getattr(getattr(service, '_http', None), 'credentials', None)
+    if credentials is None:
+        return None
+    if getattr(_thread_local, 'credentials', None) is not credentials:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        _thread_local.http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        _thread_local.credentials = credentials
+    return _thread_local.http
+
+def project_message(message):
+    """Keeps only the message fields and headers the app uses."""
+    projected = {key: message[key] for key in MESSAGE_FIELDS if key in message}
+    headers = message.get('payload', {}).get('headers', [])
+    projected['payload'] = {'headers': [h for h in headers if h['name'] in METADATA_HEADERS]}
+    return projected
+
+def fetch_messages(service, message_ids, user_id='me', cache=None, batch_size=BATCH_SIZE, max_retries=MAX_RETRIES):
+    """Fetches projected messages by id using batched HTTP requests.
+
+    Messages found in `cache` are not requested; the rest are fetched with
+    format=metadata and stored in it. Items that fail with a retryable error
+    are retried in later batches with backoff; items that fail permanently
+    (e.g. deleted messages) are skipped. Returns the messages in the order of
+    `message_ids`.
+    """
+    message_ids = list(dict.fromkeys(message_ids))
+    fetched = cache.get_many(message_ids) if cache is not None else {}
+    misses = [i for i in message_ids if i not in fetched]
+    failed = {}
+    pending = misses
+    attempt = 0
+    while pending:
+        retry = []
+        limited = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = project_message(response)
+            elif is_retryable(exception):
+                retry.append(request_id)
+                if is_rate_limited(exception):
+                    limited.append(request_id)
+            else:
+                failed[request_id] = exception
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in chunk:
+                request = service.users().messages().get(
+                    userId=user_id, id=message_id, format='metadata', metadataHeaders=METADATA_HEADERS)
+                batch.add(request, request_id=message_id)
+            throttled = len(limited)
+            try:
+                execute(batch, 'messages.get', calls=len(chunk))
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                retry.extend(i for i in chunk if i not in fetched and i not in failed and i not in retry)
+            # Server errors are retried too, but only rate limits slow the scheduler down.
+            if len(limited) > throttled:
+                report_throttled()
+
+        if not retry:
+            break
+        attempt += 1
+        if attempt > max_retries:
+            for message_id in retry:
+                failed[message_id] = 'retries exhausted'
+            break
+        time.sleep(backoff_delay(attempt - 1))
+        pending = retry
+
+    if cache is not None:
+        cache.put_many(fetched[i] for i in misses if i in fetched)
+    metrics.inc('messages_fetched_total', len(fetched))
+    if failed:
+        metrics.inc('messages_failed_total', len(failed))
+        print(f"Skipped {len(failed)} of {len(message_ids)} messages that could not be fetched")
+    return [fetched[i] for i in message_ids if i in fetched]
+
+def iter_message_ids(service, user_id='me', q=None, label_ids=None, limit=None, page_size=LIST_PAGE_SIZE):
+    """Yields pages of message ids, following nextPageToken across the mailbox.
+
+    The next page is listed on a helper thread while the caller works on the
+    current one. Stops after `limit` ids if given.
+    """
+    def list_page(page_token, size):
+        request = service.users().messages().list(
+            userId=user_id, maxResults=size, pageToken=page_token, q=q, labelIds=label_ids)
+        return execute(request, 'messages.list', http=thread_http(service))
 
+    remaining = limit
+    # Run prefetches in this context so they keep the caller's quota priority.
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        pending = prefetcher.submit(context.run, list_page, None, min(page_size, remaining or page_size))
+        while pending is not None:
+            response = pending.result()
+            ids = [message['id'] for message in response.get('messages', [])]
+            if remaining is not None:
+                ids = ids[:remaining]
+                remaining -= len(ids)
+            page_token = response.get('nextPageToken')
+            pending = None
+            if page_token and remaining != 0:
+                pending = prefetcher.submit(context.run, list_page, page_token, min(page_size, remaining or page_size))
+            if ids:
+                yield ids
+
+def iter_emails(service, user_id='me', q=None, label_ids=None, limit=None, batch_size=LIST_PAGE_SIZE, cache=None):
+    """Yields lists of at most `batch_size` projected messages matching `q` and `label_ids`.
+
+    Only one batch is in flight at a time; memory stays bounded only if the
+    caller drops each batch before taking the next.
+    """
+    for ids in iter_message_ids(service, user_id=user_id, q=q, label_ids=label_ids, limit=limit,
+                                page_size=batch_size):
+        yield fetch_messages(service, ids, user_id=user_id, cache=cache)
+
+def fetch_emails(service, user_id='me', max_results=200, cache=None, q=None, label_ids=None):
+    """Fetches the last `max_results` emails from the user's inbox.
+
+    Pass `max_results=None` to fetch every message matching `q` and `label_ids`;
+    they are all returned in one list.
+    """
+    try:
         email_data = []
-        for message in messages:
-            msg = service.users().messages().get(userId=user_id, id=message['id']).execute()
-            email_data.append(msg)
+        for batch in iter_emails(service, user_id=user_id, q=q, label_ids=label_ids, limit=max_results,
+                                 cache=cache):
+            email_data.extend(batch)
         return email_data
     except Exception as e:
         print(f"An error occurred: {e}")
         return None
 
-def cluster_emails(emails):
-    """Clusters emails based on their subject lines."""
-    subjects = []
-    for email in emails:
-        headers = email['payload']['headers']
-        subject = next((header['value'] for header in headers if header['name'] == 'Subject'), None)
-        if subject:
-            subjects.append(subject)
-
-    vectorizer = TfidfVectorizer(stop_words='english')
-    X = vectorizer.fit_transform(subjects)
-
-    # You can adjust the number of clusters
-    kmeans = KMeans(n_clusters=3, random_state=42)
-    kmeans.fit(X)
-
-    # Create a DataFrame for easier manipulation
-    df = pd.DataFrame({'email': emails, 'subject': subjects, 'cluster': kmeans.labels_})
-    return df
+def cluster_emails(emails, n_clusters=None, collapse_duplicates=True, use_rules=True):
+    """Clusters emails on their subject, snippet, sender domain and List-Id.
+
+    If `n_clusters` is None the number of clusters is chosen automatically.
+    Near-duplicates are collapsed into one row first unless
+    `collapse_duplicates` is False, and unless `use_rules` is False, rows
+    that match a triage rule go to its named bucket instead of KMeans.
+    """
+    import numpy as np
+    from sklearn.cluster import KMeans
+    import rules
+    from cluster_result import ClusterResult
+    from dedup import collapse
+    from features import extract_columns, take, vectorize
+    from k_selection import choose_k
+
+    columns = extract_columns(emails)
+    members = None
+    if collapse_duplicates:
+        emails, columns, members = collapse(emails, columns)
+    labels = rules.engine.match(columns) if use_rules else np.full(len(emails), rules.UNMATCHED)
+    rest = np.flatnonzero(labels == rules.UNMATCHED)
+
+    if len(rest):
+        X = vectorize(take(columns, rest))
+        if n_clusters is None:
+            n_clusters = choose_k(X)
+        kmeans = KMeans(n_clusters=min(n_clusters, X.shape[0]), random_state=42)
+        with metrics.timer('pipeline_stage_seconds', stage='kmeans'):
+            kmeans.fit(X)
+        labels[rest] = kmeans.labels_
+
+    names = rules.engine.names() if use_rules else None
+    return ClusterResult(emails, columns['id'], columns['subject'], labels, members, names)
@@ -44,3 +44,10 @@ limit_request_field_size = 8190
 # Performance
 preload_app = True
 reload = False
+
+# Background sync: every worker starts the thread, one per host does the work
+def post_fork(server, worker):
+    from app_production import GMAIL_AVAILABLE
+    if GMAIL_AVAILABLE:
+        from background import start_background_sync
+        start_background_sync()
@@ -0,0 +1,187 @@
+"""Incremental inbox sync using Gmail history.
+
+The first sync lists and fetches the latest messages as before and records the
+mailbox ``historyId``. Later syncs only ask ``users.history.list`` for what
+changed since then, so a page refresh costs a few calls instead of hundreds.
+Messages are looked up in the on-disk message cache first, so a worker that
+starts cold only downloads what no other worker has seen. Each mailbox keeps
+its own store; only the default mailbox shares the message cache, since
+message ids are only unique within one mailbox. Every mailbox's changes
+are also applied to the search index. When archived or deleted messages leave
+the newest ``max_results`` short, the next older messages are listed and
+fetched to fill it again. The store and the clustering that follows hold the
+whole window in memory, so with ``INBOX_MAX_MESSAGES=0`` memory grows with the
+inbox.
+"""
+import os
+import threading
+
+from gmail_assistant import PROJECTION, fetch_messages, iter_emails, iter_message_ids
+import metrics
+from message_cache import MessageCache
+from quota import execute
+from search_index import index as search_index
+
+HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+# How many of the newest inbox messages to keep; 0 keeps the whole inbox.
+MAX_MESSAGES = int(os.environ.get('INBOX_MAX_MESSAGES', '200'))
+
+
+class InboxSync:
+    """Local store of the messages carrying `label_ids`, kept up to date from Gmail history records."""
+
+    def __init__(self, user_id='me', max_results=200, cache=None, label_ids=('INBOX',), index=None, mailbox='me'):
+        self.user_id = user_id
+        self.max_results = max_results
+        self.cache = cache
+        self.index = index
+        self.mailbox = mailbox
+        self.label_ids = list(label_ids)
+        self.messages = {}
+        self.history_id = None
+        # True while the store holds every message carrying label_ids, so there is nothing to backfill.
+        self.complete = False
+        self._lock = threading.Lock()
+
+    def sync(self, service):
+        """Brings the store up to date and returns the latest messages, newest first."""
+        with self._lock:
+            before = set(self.messages)
+            full = self.history_id is None or not self._incremental_sync(service)
+            if full and not self._full_sync(service):
+                return None
+            if self.index is not None:
+                self._update_index(before, full)
+            return self.emails()
+
+    def _update_index(self, before, full):
+        with metrics.timer('pipeline_stage_seconds', stage='index'):
+            if full:
+                # The index may hold messages that left while this process was not syncing.
+                self.index.replace(self.mailbox, self.messages.values())
+            else:
+                self.index.remove(self.mailbox, before - self.messages.keys())
+                self.index.add(self.mailbox, [m for i, m in self.messages.items() if i not in before])
+
+    def emails(self):
+        """Returns the stored messages, newest first."""
+        return sorted(self.messages.values(), key=lambda m: int(m.get('internalDate', 0)), reverse=True)
+
+    def _full_sync(self, service):
+        # Read the history id before listing so nothing that arrives while we
+        # fetch is missed by the next incremental sync.
+        profile = execute(service.users().getProfile(userId=self.user_id), 'getProfile')
+        messages = {}
+        try:
+            # Store each batch as it arrives rather than building a second list of the whole window.
+            for batch in iter_emails(service, user_id=self.user_id, label_ids=self.label_ids,
+                                     limit=self.max_results, cache=self.cache):
+                messages.update((m['id'], m) for m in batch)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return False
+        self.messages = messages
+        self.complete = not self.max_results or len(messages) < self.max_results
+        self.history_id = profile['historyId']
+        return True
+
+    def _incremental_sync(self, service):
+        """Applies history since the last sync. Returns False if a full sync is needed."""
+        records = []
+        page_token = None
+        try:
+            while True:
+                request = service.users().history().list(
+                    userId=self.user_id, startHistoryId=self.history_id,
+                    historyTypes=HISTORY_TYPES, pageToken=page_token)
+                response = execute(request, 'history.list')
+                records.extend(response.get('history', []))
+                page_token = response.get('nextPageToken')
+                if not page_token:
+                    break
+        except Exception as e:
+            # A 404 means the start history id is too old; anything else we
+            # also recover from by re-listing.
+            print(f"History sync failed, falling back to a full sync: {e}")
+            return False
+
+        to_fetch = {}
+        for record in records:
+            for change in record.get('messagesAdded', []):
+                if self._matches(change['message']):
+                    to_fetch[change['message']['id']] = True
+            for change in record.get('messagesDeleted', []):
+                message_id = change['message']['id']
+                self.messages.pop(message_id, None)
+                to_fetch.pop(message_id, None)
+                if self.cache is not None:
+                    self.cache.delete(message_id)
+            for kind in ('labelsAdded', 'labelsRemoved'):
+                for change in record.get(kind, []):
+                    message_id = change['message']['id']
+                    label_ids = change['message'].get('labelIds', [])
+                    if self.cache is not None:
+                        self.cache.update_labels(message_id, label_ids)
+                    if not self._matches(change['message']):
+                        # e.g. archived: no longer in the inbox view
+                        self.messages.pop(message_id, None)
+                        to_fetch.pop(message_id, None)
+                    elif message_id in self.messages:
+                        self.messages[message_id]['labelIds'] = label_ids
+                    else:
+                        to_fetch[message_id] = True
+
+        if to_fetch:
+            for message in fetch_messages(service, list(to_fetch), user_id=self.user_id, cache=self.cache):
+                self.messages[message['id']] = message
+        self._backfill(service)
+        self._trim()
+        self.history_id = response.get('historyId', self.history_id)
+        return True
+
+    def _matches(self, message):
+        labels = message.get('labelIds', [])
+        return all(label in labels for label in self.label_ids)
+
+    def _backfill(self, service):
+        """Refills the store up to max_results with the newest messages it does not hold."""
+        missing = (self.max_results or 0) - len(self.messages)
+        if self.complete or missing <= 0:
+            return
+        message_ids = []
+        try:
+            # Listed newest first, so the first ids not held are the ones that now fall in the window.
+            for page in iter_message_ids(service, user_id=self.user_id, label_ids=self.label_ids):
+                message_ids.extend(i for i in page if i not in self.messages)
+                if len(message_ids) >= missing:
+                    break
+            else:
+                self.complete = True
+            messages = fetch_messages(service, message_ids[:missing], user_id=self.user_id, cache=self.cache)
+        except Exception as e:
+            # The window stays short until the next sync tries again.
+            print(f"Backfilling the inbox failed: {e}")
+            return
+        for message in messages:
+            self.messages[message['id']] = message
+        metrics.inc('inbox_backfilled_total', len(messages))
+
+    def _trim(self):
+        if self.max_results and len(self.messages) > self.max_results:
+            self.messages = {m['id']: m for m in self.emails()[:self.max_results]}
+            # Older messages carrying label_ids are no longer held.
+            self.complete = False
+
+
+_inboxes = {'me': InboxSync(max_results=MAX_MESSAGES or None, cache=MessageCache(projection=PROJECTION),
+                            index=search_index)}
+_inboxes_lock = threading.Lock()
+
+
+def sync_emails(service, mailbox='me'):
+    """Returns the latest emails of a mailbox for this process, syncing incrementally."""
+    with _inboxes_lock:
+        if mailbox not in _inboxes:
+            _inboxes[mailbox] = InboxSync(max_results=MAX_MESSAGES or None, index=search_index, mailbox=mailbox)
+        inbox = _inboxes[mailbox]
+    return inbox.sync(service)
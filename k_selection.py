@@ -0,0 +1,51 @@
+"""Picks the number of clusters for an inbox within a wall-clock budget.
+
+Candidate values of k are scored by silhouette on a random subsample of the
+feature matrix. Pairwise distances for the subsample are computed once (with
+sparse-aware ``euclidean_distances``) and reused for every candidate, and the
+search stops early when the next candidate would not fit in the budget.
+"""
+import os
+import time
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+from sklearn.metrics.pairwise import euclidean_distances
+
+import metrics
+
+K_MIN = int(os.environ.get('CLUSTER_K_MIN', '2'))
+K_MAX = int(os.environ.get('CLUSTER_K_MAX', '10'))
+SAMPLE_SIZE = int(os.environ.get('CLUSTER_K_SAMPLE', '1000'))
+BUDGET_SECONDS = float(os.environ.get('CLUSTER_K_BUDGET', '0.5'))
+
+
+def choose_k(X, k_min=K_MIN, k_max=K_MAX, sample_size=SAMPLE_SIZE, budget_seconds=BUDGET_SECONDS,
+             random_state=42):
+    """Returns the k in [k_min, k_max] with the best silhouette on a subsample of X."""
+    started = time.perf_counter()
+    n_samples = X.shape[0]
+    k_max = min(k_max, n_samples - 1)
+    if k_max <= k_min:
+        return max(1, min(k_min, n_samples))
+
+    rng = np.random.default_rng(random_state)
+    if n_samples > sample_size:
+        X = X[np.sort(rng.choice(n_samples, sample_size, replace=False))]
+    distances = euclidean_distances(X)
+
+    best_k, best_score = k_min, -1.0
+    slowest = 0.0
+    for k in range(k_min, k_max + 1):
+        if time.perf_counter() - started + slowest > budget_seconds:
+            break
+        step_started = time.perf_counter()
+        labels = MiniBatchKMeans(n_clusters=k, random_state=random_state, n_init=1).fit_predict(X)
+        if len(np.unique(labels)) > 1:
+            score = silhouette_score(distances, labels, metric='precomputed')
+            if score > best_score:
+                best_k, best_score = k, score
+        slowest = max(slowest, time.perf_counter() - step_started)
+    metrics.observe('pipeline_stage_seconds', time.perf_counter() - started, stage='choose_k')
+    return best_k
@@ -0,0 +1,115 @@
+"""Persistent, size-bounded cache of projected Gmail messages.
+
+Messages are stored in SQLite keyed by message id, holding only the fields
+the app reads (see ``gmail_assistant.project_message``). When the cache
+grows past ``max_entries`` the least recently used rows are evicted. The
+database is shared safely by all gunicorn workers on a host.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+DEFAULT_PATH = os.environ.get('MESSAGE_CACHE_PATH', 'message_cache.sqlite3')
+DEFAULT_MAX_ENTRIES = int(os.environ.get('MESSAGE_CACHE_SIZE', '5000'))
+
+
+class MessageCache:
+    """LRU message cache backed by a SQLite file."""
+
+    def __init__(self, path=DEFAULT_PATH, max_entries=DEFAULT_MAX_ENTRIES, projection=''):
+        self.path = path
+        self.max_entries = max_entries
+        self.projection = projection
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connections must not cross a fork, so reopen in each worker process.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS messages '
+                         '(id TEXT PRIMARY KEY, data TEXT NOT NULL, accessed INTEGER NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS messages_accessed ON messages (accessed)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            row = conn.execute("SELECT value FROM meta WHERE key = 'projection'").fetchone()
+            if row is None or row[0] != self.projection:
+                # Entries written with a different projection lack fields we need.
+                conn.execute('DELETE FROM messages')
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('projection', ?)", (self.projection,))
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get_many(self, message_ids):
+        """Returns a dict of cached messages for the given ids and marks them as used."""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            # Stay well below SQLite's bound-parameter limit.
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for message_id, data in conn.execute(
+                        f'SELECT id, data FROM messages WHERE id IN ({placeholders})', chunk):
+                    found[message_id] = json.loads(data)
+            if found:
+                now = time.time_ns()
+                conn.executemany('UPDATE messages SET accessed = ? WHERE id = ?',
+                                 [(now, message_id) for message_id in found])
+                conn.commit()
+        self.hits += len(found)
+        self.misses += len(message_ids) - len(found)
+        metrics.inc('message_cache_requests_total', len(found), result='hit')
+        metrics.inc('message_cache_requests_total', len(message_ids) - len(found), result='miss')
+        return found
+
+    def put_many(self, messages):
+        """Stores messages and evicts the least recently used beyond the size bound."""
+        messages = list(messages)
+        if not messages:
+            return
+        now = time.time_ns()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany('INSERT OR REPLACE INTO messages VALUES (?, ?, ?)',
+                             [(m['id'], json.dumps(m, separators=(',', ':')), now) for m in messages])
+            (count,) = conn.execute('SELECT COUNT(*) FROM messages').fetchone()
+            if count > self.max_entries:
+                conn.execute('DELETE FROM messages WHERE id IN '
+                             '(SELECT id FROM messages ORDER BY accessed LIMIT ?)',
+                             (count - self.max_entries,))
+            conn.commit()
+
+    def update_labels(self, message_id, label_ids):
+        """Updates the cached labels of a message, if it is cached."""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT data FROM messages WHERE id = ?', (message_id,)).fetchone()
+            if row is not None:
+                message = json.loads(row[0])
+                message['labelIds'] = label_ids
+                conn.execute('UPDATE messages SET data = ? WHERE id = ?',
+                             (json.dumps(message, separators=(',', ':')), message_id))
+                conn.commit()
+
+    def delete(self, message_id):
+        """Removes a message from the cache."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM messages WHERE id = ?', (message_id,))
+            conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute('SELECT COUNT(*) FROM messages').fetchone()[0]
@@ -0,0 +1,207 @@
+"""Counters, gauges and latency histograms shared by all worker processes.
+
+Each process records into memory and periodically flushes its own totals to
+a SQLite file, one row per process and sample. ``render`` sums the rows of
+every process (gauges take the most recent value) into the Prometheus text
+format, so any gunicorn worker can answer a scrape of ``/metrics`` for the
+whole host. Rows of processes that have exited are folded into one
+``exited`` row per sample, so the file stays as big as the live workers'.
+"""
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = os.environ.get('METRICS_DB_PATH', 'metrics.sqlite3')
+FLUSH_INTERVAL = 1.0
+FOLD_INTERVAL = 60.0
+EXITED = 'exited'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(labels, **extra):
+    items = sorted({**labels, **extra}.items())
+    return ','.join(f'{key}="{value}"' for key, value in items)
+
+
+def _alive(process):
+    """True unless the process that wrote rows under `process` has exited."""
+    # A reused pid keeps the rows of the process that had it until it exits too.
+    try:
+        os.kill(int(process.partition('-')[0]), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metrics:
+    """Process-local metric samples that flush to a store shared across processes."""
+
+    def __init__(self, path=DEFAULT_PATH, flush_interval=FLUSH_INTERVAL, fold_interval=FOLD_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.fold_interval = fold_interval
+        self._samples = {}
+        self._owner = os.getpid()
+        self._conn = None
+        self._pid = None
+        self._process = None
+        self._flushed = 0.0
+        self._folded = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connections must not cross a fork, so reopen in each worker process.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS samples (family TEXT NOT NULL, kind TEXT NOT NULL, '
+                         'name TEXT NOT NULL, labels TEXT NOT NULL, process TEXT NOT NULL, '
+                         'value REAL NOT NULL, updated_at REAL NOT NULL, '
+                         'PRIMARY KEY (name, labels, process))')
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+            # Pids get reused, so tell processes apart by start time too.
+            self._process = f'{os.getpid()}-{time.time()}'
+        return self._conn
+
+    def _add(self, family, kind, name, labels, value, replace=False):
+        if self._owner != os.getpid():
+            # A forked child starts its own totals; the parent still reports its own.
+            self._samples, self._owner = {}, os.getpid()
+        key = (name, labels)
+        if replace:
+            self._samples[key] = [family, kind, value, time.time()]
+        elif key in self._samples:
+            self._samples[key][2] += value
+        else:
+            self._samples[key] = [family, kind, value, 0.0]
+
+    def inc(self, name, value=1, **labels):
+        """Adds `value` to a counter."""
+        with self._lock:
+            self._add(name, 'counter', name, _labels(labels), value)
+        self.maybe_flush()
+
+    def set_gauge(self, name, value, **labels):
+        """Sets a gauge; across processes the most recently set value wins."""
+        with self._lock:
+            self._add(name, 'gauge', name, _labels(labels), value, replace=True)
+        self.maybe_flush()
+
+    def observe(self, name, seconds, **labels):
+        """Records a duration in a histogram."""
+        with self._lock:
+            for bound in BUCKETS:
+                if seconds <= bound:
+                    self._add(name, 'histogram', f'{name}_bucket', _labels(labels, le=bound), 1)
+            self._add(name, 'histogram', f'{name}_bucket', _labels(labels, le='+Inf'), 1)
+            self._add(name, 'histogram', f'{name}_sum', _labels(labels), seconds)
+            self._add(name, 'histogram', f'{name}_count', _labels(labels), 1)
+        self.maybe_flush()
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Times the enclosed block into the histogram `name`."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def maybe_flush(self):
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes this process's totals to the shared store."""
+        with self._lock:
+            self._flushed = time.monotonic()
+            conn = self._connect()
+            if self._owner != os.getpid():
+                self._samples, self._owner = {}, os.getpid()
+            rows = [(family, kind, name, labels, self._process, value, updated_at or time.time())
+                    for (name, labels), (family, kind, value, updated_at) in self._samples.items()]
+            conn.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.commit()
+            if self._folded is None or self._flushed - self._folded >= self.fold_interval:
+                self._folded = self._flushed
+                self._fold(conn)
+
+    def _fold(self, conn):
+        """Merges the rows of exited processes into the `exited` rows, keeping every total."""
+        processes = [row[0] for row in conn.execute('SELECT DISTINCT process FROM samples')]
+        dead = [(process,) for process in processes if process != EXITED and not _alive(process)]
+        if not dead:
+            return
+        # Other processes fold too; take the write lock first so rows are only counted once.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._fold_rows(conn, dead)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def _fold_rows(self, conn, dead):
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS dead (process TEXT PRIMARY KEY)')
+        conn.execute('DELETE FROM dead')
+        conn.executemany('INSERT OR IGNORE INTO dead VALUES (?)', dead)
+        conn.execute("INSERT INTO samples SELECT family, kind, name, labels, ?, SUM(value), MAX(updated_at) "
+                     "FROM samples WHERE kind != 'gauge' AND process IN (SELECT process FROM dead) "
+                     'GROUP BY family, kind, name, labels ON CONFLICT (name, labels, process) '
+                     'DO UPDATE SET value = value + excluded.value', (EXITED,))
+        # A gauge only matters while it holds the latest value.
+        conn.execute("INSERT INTO samples SELECT family, kind, name, labels, ?, value, updated_at FROM samples s "
+                     "WHERE kind = 'gauge' AND process IN (SELECT process FROM dead) "
+                     'AND updated_at = (SELECT MAX(updated_at) FROM samples WHERE name = s.name AND labels = s.labels) '
+                     'ON CONFLICT (name, labels, process) '
+                     'DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at', (EXITED,))
+        conn.execute('DELETE FROM samples WHERE process IN (SELECT process FROM dead)')
+
+    def render(self):
+        """Returns every process's metrics in the Prometheus text format."""
+        self.flush()
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT family, kind, name, labels, SUM(value) FROM samples WHERE kind != 'gauge' "
+                'GROUP BY family, kind, name, labels '
+                "UNION ALL SELECT family, kind, name, labels, value FROM samples s WHERE kind = 'gauge' "
+                'AND updated_at = (SELECT MAX(updated_at) FROM samples '
+                'WHERE name = s.name AND labels = s.labels) '
+                'ORDER BY 1, 3, 4').fetchall()
+        lines = []
+        family_seen = None
+        for family, kind, name, labels, value in rows:
+            if family != family_seen:
+                lines.append(f'# TYPE {family} {kind}')
+                family_seen = family
+            lines.append(f'{name}{{{labels}}} {value:.15g}' if labels else f'{name} {value:.15g}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Metrics()
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    registry.set_gauge(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    registry.observe(name, seconds, **labels)
+
+
+def timer(name, **labels):
+    return registry.timer(name, **labels)
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,68 @@
+"""Fitted model artifacts shared by all worker processes on a host.
+
+Artifacts are sets of NumPy arrays saved as ``.npy`` files in a directory
+named after the mailbox and a hash of the inputs they were fitted on. Loading
+memory-maps the files read-only, so every gunicorn worker shares the same
+pages instead of holding (or refitting) its own copy.
+"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+DEFAULT_DIR = os.environ.get('MODEL_STORE_DIR', 'model_artifacts')
+DEFAULT_KEEP = int(os.environ.get('MODEL_STORE_KEEP', '5'))
+
+
+def content_hash(parts):
+    """Stable hash of an iterable of strings."""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ModelStore:
+    """Directory of memory-mapped artifacts keyed by mailbox and content hash."""
+
+    def __init__(self, directory=DEFAULT_DIR, keep=DEFAULT_KEEP):
+        self.directory = directory
+        self.keep = keep
+
+    def _path(self, mailbox, key):
+        mailbox = re.sub(r'[^A-Za-z0-9_.@-]', '_', mailbox)
+        return os.path.join(self.directory, mailbox, key)
+
+    def load(self, mailbox, key):
+        """Returns {name: read-only memmapped array} or None if there is no artifact."""
+        path = self._path(mailbox, key)
+        try:
+            names = [name for name in os.listdir(path) if name.endswith('.npy')]
+            return {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r') for name in names}
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, mailbox, key, arrays):
+        """Atomically writes an artifact and prunes the mailbox's oldest ones."""
+        path = self._path(mailbox, key)
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, f'{name}.npy'), np.asarray(array))
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another worker saved the same artifact first.
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._prune(parent)
+
+    def _prune(self, parent):
+        entries = [os.path.join(parent, name) for name in os.listdir(parent) if not name.startswith('.')]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in entries[self.keep:]:
+            shutil.rmtree(path, ignore_errors=True)
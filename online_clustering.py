@@ -0,0 +1,171 @@
+"""Incremental clustering that keeps cluster ids stable across requests.
+
+Instead of refitting TF-IDF and KMeans on every request, messages are hashed
+into a fixed feature space (see ``features``) and clustered with
+``MiniBatchKMeans``. Near-duplicates are first collapsed into one row each
+(see ``dedup``), so a burst of alerts costs one row, and rows that a rule
+sorts into a named bucket (see ``rules``) skip the model entirely. Dedup
+signatures and rule buckets are kept by message id, so a sync only signs and
+matches the messages that are new. Messages that were already assigned keep
+their cluster; only new messages are vectorized and assigned, and they nudge
+the centroids with a mini-batch update. When new messages sit much further
+from the centroids than the fitted data did, the model is refit and the new
+clusters are matched to the old ones so their ids stay put.
+
+Centroids are published to the shared model store keyed by mailbox and a hash
+of the clustered messages, so a worker that sees an inbox another worker has
+already clustered maps the centroids from disk and only predicts.
+"""
+import threading
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.metrics.pairwise import euclidean_distances
+
+import metrics
+import rules
+from cluster_result import ClusterResult
+from dedup import SignatureCache, collapse
+from features import FEATURES_VERSION, extract_columns, take, vectorize
+from k_selection import choose_k
+from model_store import ModelStore, content_hash
+
+
+class OnlineClusterer:
+    """Assigns emails to persistent clusters, refitting only on drift.
+
+    With `n_clusters` None the number of clusters is chosen by `choose_k`
+    each time the model is (re)fit.
+    """
+
+    def __init__(self, n_clusters=None, drift_threshold=2.0, random_state=42, mailbox='me', store=None,
+                 collapse_duplicates=True, use_rules=True):
+        self.n_clusters = n_clusters
+        self.collapse_duplicates = collapse_duplicates
+        self.use_rules = use_rules
+        self.drift_threshold = drift_threshold
+        self.random_state = random_state
+        self.mailbox = mailbox
+        self.store = store
+        self.centers = None
+        self.counts = None
+        self.baseline = None
+        self.labels = {}
+        self.signatures = SignatureCache()
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def cluster(self, emails):
+        """Returns a `ClusterResult`, like `cluster_emails`."""
+        columns = extract_columns(emails)
+        members = None
+        with self._lock:
+            if self.collapse_duplicates:
+                emails, columns, members = collapse(emails, columns, self.signatures)
+            if self.use_rules:
+                labels = rules.engine.match(columns, self.buckets)
+            else:
+                labels = np.full(len(emails), rules.UNMATCHED)
+        rest = np.flatnonzero(labels == rules.UNMATCHED)
+        if len(rest):
+            labels[rest] = self._assign(take(columns, rest))
+        names = rules.engine.names() if self.use_rules else None
+        return ClusterResult(emails, columns['id'], columns['subject'], labels, members, names)
+
+    def _assign(self, columns):
+        """Returns model cluster ids for rows no rule matched."""
+        ids = columns['id']
+        # Message contents never change, so ids identify the inputs.
+        key = content_hash([f'v{FEATURES_VERSION}', *ids])
+        with self._lock:
+            if self.centers is None and not self._load(key, columns):
+                self._refit(columns)
+                self._save(key)
+            new = [i for i, message_id in enumerate(ids) if message_id not in self.labels]
+            if new:
+                X = vectorize(take(columns, new))
+                if self._drift(X) > self.drift_threshold:
+                    self._refit(columns)
+                else:
+                    for i, label in zip(new, self._partial_fit(X)):
+                        self.labels[ids[i]] = label
+                self._save(key)
+            # Forget messages that are no longer in the inbox view.
+            self.labels = {message_id: self.labels[message_id] for message_id in ids}
+            return [self.labels[message_id] for message_id in ids]
+
+    def _predict(self, X):
+        return euclidean_distances(X, self.centers, squared=True).argmin(axis=1)
+
+    def _drift(self, X):
+        """Ratio of the new messages' mean squared distance to the fitted baseline."""
+        distances = euclidean_distances(X, self.centers, squared=True).min(axis=1)
+        return distances.mean() / max(self.baseline, 1e-6)
+
+    def _partial_fit(self, X):
+        """Assigns X and moves each centroid towards the running mean of its members."""
+        metrics.inc('clustering_assigned_total', X.shape[0])
+        labels = self._predict(X)
+        # Centroids may be a read-only mapping of a shared artifact.
+        centers = np.array(self.centers)
+        for label in np.unique(labels):
+            members = X[labels == label]
+            total = self.counts[label] + members.shape[0]
+            centers[label] = (centers[label] * self.counts[label] + np.asarray(members.sum(axis=0)).ravel()) / total
+            self.counts[label] = total
+        self.centers = centers
+        return labels
+
+    def _refit(self, columns):
+        X = vectorize(columns)
+        n_clusters = self.n_clusters or choose_k(X, random_state=self.random_state)
+        n_clusters = min(n_clusters, X.shape[0])
+        model = MiniBatchKMeans(n_clusters=n_clusters, random_state=self.random_state, n_init=3)
+        with metrics.timer('pipeline_stage_seconds', stage='kmeans'):
+            model.fit(X)
+        metrics.inc('clustering_refits_total')
+        # stable[i] is the cluster id given to the model's cluster i.
+        stable = np.full(n_clusters, -1)
+        if self.centers is not None:
+            # Match new centroids to the old ones so cluster ids stay stable.
+            rows, cols = linear_sum_assignment(euclidean_distances(self.centers, model.cluster_centers_))
+            keep = rows < n_clusters
+            stable[cols[keep]] = rows[keep]
+        stable[stable == -1] = np.setdiff1d(np.arange(n_clusters), stable)
+        self.centers = np.empty_like(model.cluster_centers_, dtype=np.float32)
+        self.centers[stable] = model.cluster_centers_
+        self.counts = np.zeros(n_clusters, dtype=np.int64)
+        self.counts[stable] = np.bincount(model.labels_, minlength=n_clusters)
+        self.baseline = model.inertia_ / X.shape[0]
+        self.labels = dict(zip(columns['id'], stable[model.labels_]))
+
+    def _load(self, key, columns):
+        """Adopts centroids another worker fitted on the same messages; predicts only."""
+        arrays = self.store.load(self.mailbox, key) if self.store is not None else None
+        if arrays is None:
+            return False
+        self.centers = arrays['centers']
+        self.counts = np.array(arrays['counts'])
+        self.baseline = float(arrays['baseline'])
+        self.labels = dict(zip(columns['id'], self._predict(vectorize(columns))))
+        return True
+
+    def _save(self, key):
+        if self.store is not None:
+            self.store.save(self.mailbox, key, {'centers': self.centers, 'counts': self.counts,
+                                                'baseline': np.float64(self.baseline)})
+
+
+_store = ModelStore()
+_clusterers = {}
+_clusterers_lock = threading.Lock()
+
+
+def cluster_emails_online(emails, mailbox='me'):
+    """Clusters a mailbox's emails incrementally using this process's persistent model for it."""
+    with _clusterers_lock:
+        if mailbox not in _clusterers:
+            _clusterers[mailbox] = OnlineClusterer(mailbox=mailbox, store=_store)
+        clusterer = _clusterers[mailbox]
+    return clusterer.cluster(emails)
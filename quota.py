@@ -0,0 +1,320 @@
+"""Quota-aware scheduler that every Gmail call goes through.
+
+Gmail charges each method a number of quota units and limits how many a user
+may spend per second. The scheduler meters calls with a token bucket whose
+rate adapts AIMD-style: it creeps up while calls succeed and halves when Gmail
+answers with a rate-limit error (429, or 403 rateLimitExceeded). Those and
+transient server errors are retried with jittered backoff. Interactive calls
+(web requests) are served before background sync whenever both are waiting.
+Gmail meters each mailbox separately, so every account gets its own budget.
+
+The budget belongs to the mailbox, not the process, so each account's bucket
+lives in a SQLite file shared by every web worker and sync process on the
+host, and an interactive caller waiting in one process holds back background
+calls in all of them. Asyncio clients (see ``async_gmail``) await the same
+buckets through ``execute_async``.
+"""
+import asyncio
+import contextlib
+import contextvars
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import metrics
+
+MAX_RETRIES = 5
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.batchModify': 50,
+    'history.list': 2,
+    'getProfile': 1,
+}
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+DEFAULT_PATH = os.environ.get('QUOTA_DB_PATH', 'quota.sqlite3')
+
+# Gmail allows 250 quota units per user per second.
+MAX_UNITS_PER_SECOND = float(os.environ.get('GMAIL_QUOTA_PER_SECOND', '250'))
+MIN_UNITS_PER_SECOND = 10.0
+# Additive increase per successful call, multiplicative decrease on throttling.
+RATE_INCREASE = 2.0
+RATE_DECREASE = 0.5
+# How long a waiting interactive call keeps background calls out after its expected wait.
+INTERACTIVE_LEASE = 0.05
+
+
+def _http_status(error):
+    """Returns the HTTP status of an API error, if it has one."""
+    resp = getattr(error, 'resp', None)
+    return getattr(resp, 'status', getattr(error, 'status', None))
+
+
+def is_rate_limited(error):
+    """True when Gmail says the quota was exceeded, the only answer that should slow the scheduler."""
+    status = _http_status(error)
+    if status == 429:
+        return True
+    # Gmail reports per-user rate limits as 403 with a rateLimitExceeded reason.
+    return status == 403 and 'ratelimitexceeded' in str(getattr(error, 'content', b'')).lower()
+
+
+def is_retryable(error):
+    """True for errors worth retrying: rate limits and transient server errors."""
+    return _http_status(error) in RETRYABLE_STATUSES or is_rate_limited(error)
+
+
+def backoff_delay(attempt, base=0.5, cap=32.0):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+_priority = contextvars.ContextVar('gmail_priority', default=INTERACTIVE)
+_account = contextvars.ContextVar('gmail_account', default=None)
+
+
+@contextlib.contextmanager
+def priority(level):
+    """Runs the enclosed Gmail calls at `level` (INTERACTIVE or BACKGROUND)."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+@contextlib.contextmanager
+def account(name):
+    """Charges the enclosed Gmail calls to `name`'s quota budget."""
+    token = _account.set(name)
+    try:
+        yield
+    finally:
+        _account.reset(token)
+
+
+class BucketStore:
+    """Stores account -> token bucket (rate, tokens, last refill, interactive hold) in SQLite."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connections must not cross a fork, so reopen in each worker process.
+        if self._conn is None or self._pid != os.getpid():
+            # Autocommit, so update() can take the write lock before it reads.
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (account TEXT PRIMARY KEY, rate REAL NOT NULL, '
+                         'tokens REAL NOT NULL, updated REAL NOT NULL, interactive_until REAL NOT NULL)')
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def update(self, account, change, rate):
+        """Applies `change` to an account's bucket atomically across processes and returns its result.
+
+        `change` gets the bucket as a dict it may modify; a new bucket starts full at `rate`.
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT rate, tokens, updated, interactive_until FROM buckets WHERE account = ?',
+                                   (account,)).fetchone()
+                bucket = dict(zip(('rate', 'tokens', 'updated', 'interactive_until'),
+                                  row or (rate, rate, time.time(), 0.0)))
+                result = change(bucket)
+                conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)',
+                             (account, bucket['rate'], bucket['tokens'], bucket['updated'],
+                              bucket['interactive_until']))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return result
+
+
+class QuotaScheduler:
+    """Token bucket over an account's quota units with an adaptive rate and two priorities.
+
+    The bucket is kept in `store`, so every process scheduling calls for the
+    account shares it; call counts in stats() are this process's own.
+    """
+
+    def __init__(self, account='me', store=None, max_rate=MAX_UNITS_PER_SECOND, min_rate=MIN_UNITS_PER_SECOND,
+                 increase=RATE_INCREASE, decrease=RATE_DECREASE, max_retries=MAX_RETRIES):
+        self.account = account
+        self.store = store if store is not None else BucketStore()
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.units = {}
+        self.calls = {}
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def _update(self, change):
+        def clamped(bucket):
+            # GMAIL_QUOTA_PER_SECOND may have been lowered since the bucket was stored.
+            bucket['rate'] = min(max(bucket['rate'], self.min_rate), self.max_rate)
+            return change(bucket)
+        return self.store.update(self.account, clamped, self.max_rate)
+
+    def _take(self, cost, level):
+        """Spends `cost` units if the bucket allows; returns 0 or how long to wait before trying again."""
+        def take(bucket):
+            now = time.time()
+            rate = bucket['rate']
+            bucket['tokens'] = min(rate, bucket['tokens'] + max(now - bucket['updated'], 0) * rate)
+            bucket['updated'] = now
+            # The bucket never holds more than a second of tokens, so a
+            # bigger call waits for a full bucket and empties it.
+            needed = min(cost, rate)
+            held = bucket['interactive_until'] - now
+            if level != INTERACTIVE and held > 0:
+                return min(held, INTERACTIVE_LEASE)
+            if bucket['tokens'] >= needed:
+                bucket['tokens'] -= needed
+                return 0
+            wait = max((needed - bucket['tokens']) / rate, 0.001)
+            if level == INTERACTIVE:
+                # Keep background calls in every process out until this one has been served.
+                bucket['interactive_until'] = max(bucket['interactive_until'], now + wait + INTERACTIVE_LEASE)
+            return wait
+        return self._update(take)
+
+    def acquire(self, cost, level=None):
+        """Blocks until `cost` units may be spent at the given priority."""
+        level = _priority.get() if level is None else level
+        while True:
+            wait = self._take(cost, level)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, cost, level=None):
+        """Like acquire, but waits without blocking the event loop."""
+        level = _priority.get() if level is None else level
+        while True:
+            wait = self._take(cost, level)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def record(self, method, calls=1):
+        with self._lock:
+            self.units[method] = self.units.get(method, 0) + QUOTA_UNITS[method] * calls
+            self.calls[method] = self.calls.get(method, 0) + calls
+        metrics.inc('gmail_api_calls_total', calls, method=method)
+        metrics.inc('gmail_api_quota_units_total', QUOTA_UNITS[method] * calls, method=method)
+
+    def on_success(self):
+        def increase(bucket):
+            bucket['rate'] = min(self.max_rate, bucket['rate'] + self.increase)
+        self._update(increase)
+
+    def on_throttled(self):
+        def decrease(bucket):
+            bucket['rate'] = max(self.min_rate, bucket['rate'] * self.decrease)
+            bucket['tokens'] = min(bucket['tokens'], bucket['rate'])
+        self._update(decrease)
+        with self._lock:
+            self.throttled += 1
+        metrics.inc('gmail_api_throttled_total')
+
+    def execute(self, request, method, http=None, calls=1):
+        """Executes a request (or a batch of `calls` requests of `method`) under the quota.
+
+        Rate-limited and transient failures are retried with jittered
+        backoff, and only rate limits lower the rate; other errors propagate.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            self.acquire(QUOTA_UNITS[method] * calls)
+            self.record(method, calls)
+            try:
+                with metrics.timer('gmail_api_request_seconds', method=method):
+                    response = request.execute() if http is None else request.execute(http=http)
+            except Exception as e:
+                metrics.inc('gmail_api_errors_total', method=method, status=_http_status(e) or 'none')
+                if not is_retryable(e) or attempt > self.max_retries:
+                    raise
+                if is_rate_limited(e):
+                    self.on_throttled()
+                time.sleep(backoff_delay(attempt - 1))
+                continue
+            self.on_success()
+            return response
+
+    async def execute_async(self, call, method, calls=1):
+        """Awaits `call()`, a coroutine function making one `method` request, under the quota like execute."""
+        attempt = 0
+        while True:
+            attempt += 1
+            await self.acquire_async(QUOTA_UNITS[method] * calls)
+            self.record(method, calls)
+            try:
+                with metrics.timer('gmail_api_request_seconds', method=method):
+                    response = await call()
+            except Exception as e:
+                metrics.inc('gmail_api_errors_total', method=method, status=_http_status(e) or 'none')
+                if not is_retryable(e) or attempt > self.max_retries:
+                    raise
+                if is_rate_limited(e):
+                    self.on_throttled()
+                await asyncio.sleep(backoff_delay(attempt - 1))
+                continue
+            self.on_success()
+            return response
+
+    def stats(self):
+        rate = self._update(lambda bucket: bucket['rate'])
+        with self._lock:
+            return {'rate': round(rate, 2), 'throttled': self.throttled,
+                    'units': dict(self.units), 'calls': dict(self.calls)}
+
+
+# The default mailbox's scheduler; other accounts get one each from scheduler_for.
+scheduler = QuotaScheduler()
+_account_schedulers = {}
+_account_lock = threading.Lock()
+
+
+def scheduler_for(name):
+    """Returns the scheduler holding an account's budget, made like the default one on first use."""
+    # 'me' is the token.json mailbox, whatever context it is called from.
+    if name is None or name == 'me':
+        return scheduler
+    with _account_lock:
+        if name not in _account_schedulers:
+            _account_schedulers[name] = QuotaScheduler(name, store=scheduler.store, max_rate=scheduler.max_rate,
+                                                       min_rate=scheduler.min_rate)
+        return _account_schedulers[name]
+
+
+def execute(request, method, http=None, calls=1):
+    """Executes a Gmail request under the current account's quota scheduler."""
+    return scheduler_for(_account.get()).execute(request, method, http=http, calls=calls)
+
+
+async def execute_async(call, method, calls=1):
+    """Awaits a Gmail request under the current account's quota scheduler."""
+    return await scheduler_for(_account.get()).execute_async(call, method, calls=calls)
+
+
+def report_throttled():
+    """Slows the current account's scheduler down after a call inside a batch was rate limited."""
+    scheduler_for(_account.get()).on_throttled()
@@ -0,0 +1,184 @@
+"""Rendered responses shared by all workers, with single-flight fills.
+
+Responses are cached under a key that includes the snapshot id of the result
+they were rendered from, so a new background sync publishes under new keys
+and stale entries simply expire. The cache lives in Redis when ``REDIS_URL``
+is set and the client is installed, and otherwise in a SQLite file shared by
+the workers on one host. On a miss only one caller renders; concurrent callers
+for the same key wait for its result instead of rendering it again.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import metrics
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+DEFAULT_PATH = os.environ.get('RESULT_CACHE_PATH', 'result_cache.sqlite3')
+REDIS_URL = os.environ.get('REDIS_URL')
+DEFAULT_TTL = 3600
+LOCK_TTL = 30
+POLL_INTERVAL = 0.05
+# Bump when the rendered output changes so old ETags stop matching.
+RESPONSE_VERSION = 3
+
+
+def etag(view, snapshot_id):
+    """Strong ETag for a view rendered from a snapshot."""
+    return f'{view}-v{RESPONSE_VERSION}-s{snapshot_id}'
+
+
+class SQLiteBackend:
+    """Expiring key/value store in a SQLite file shared by the workers on a host."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connections must not cross a fork, so reopen in each worker process.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                         '(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)')
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            row = self._connect().execute('SELECT value FROM entries WHERE key = ? AND expires_at > ?',
+                                          (key, time.time())).fetchone()
+        return bytes(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute('DELETE FROM entries WHERE expires_at <= ?', (now,))
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', (key, value, now + ttl))
+            conn.commit()
+
+    def add(self, key, value, ttl):
+        """Sets `key` only if it is absent or expired. Returns True if it was set."""
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute('DELETE FROM entries WHERE key = ? AND expires_at <= ?', (key, now))
+            added = conn.execute('INSERT OR IGNORE INTO entries VALUES (?, ?, ?)',
+                                 (key, value, now + ttl)).rowcount == 1
+            conn.commit()
+        return added
+
+    def delete(self, key, value=None):
+        """Deletes `key`, or only while it still holds `value` if one is given."""
+        with self._lock:
+            conn = self._connect()
+            if value is None:
+                conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            else:
+                conn.execute('DELETE FROM entries WHERE key = ? AND value = ?', (key, value))
+            conn.commit()
+
+
+class RedisBackend:
+    """The same interface on a Redis server shared by every host."""
+
+    # Deletes a lock only while it is still ours.
+    _RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url=REDIS_URL, prefix='inbox-triage:'):
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(self.prefix + key, value, ex=ttl, nx=True))
+
+    def delete(self, key, value=None):
+        if value is None:
+            self.client.delete(self.prefix + key)
+        else:
+            self.client.eval(self._RELEASE, 1, self.prefix + key, value)
+
+
+class ResultCache:
+    """Read-through cache of rendered responses that renders each key once."""
+
+    def __init__(self, backend=None, ttl=DEFAULT_TTL, lock_ttl=LOCK_TTL):
+        self.backend = backend or default_backend()
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self._local_locks = {}
+        self._local_lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        """Returns the cached bytes for `key`, calling `render()` on a miss.
+
+        Threads in this process queue on a local lock and workers elsewhere
+        on a lock entry in the backend, so a burst of misses renders once.
+        If `render` returns None nothing is cached.
+        """
+        value = self.backend.get(key)
+        if value is not None:
+            metrics.inc('result_cache_requests_total', result='hit')
+            return value
+        with self._local_lock:
+            local = self._local_locks.setdefault(key, threading.Lock())
+        with local:
+            value = self.backend.get(key)
+            if value is not None:
+                metrics.inc('result_cache_requests_total', result='coalesced')
+                return value
+            token = uuid.uuid4().hex.encode()
+            deadline = time.monotonic() + self.lock_ttl
+            while not self.backend.add(f'lock:{key}', token, self.lock_ttl):
+                # Another worker is rendering; wait for it, or take over once
+                # its lock would have expired.
+                time.sleep(POLL_INTERVAL)
+                value = self.backend.get(key)
+                if value is not None:
+                    metrics.inc('result_cache_requests_total', result='coalesced')
+                    return value
+                if time.monotonic() > deadline:
+                    break
+            try:
+                # The worker whose lock we just took over may have stored the value already.
+                value = self.backend.get(key)
+                if value is not None:
+                    metrics.inc('result_cache_requests_total', result='coalesced')
+                    return value
+                metrics.inc('result_cache_requests_total', result='miss')
+                value = render()
+                if value is not None:
+                    self.backend.set(key, value, self.ttl)
+                return value
+            finally:
+                self.backend.delete(f'lock:{key}', token)
+                with self._local_lock:
+                    self._local_locks.pop(key, None)
+
+
+def default_backend():
+    """Redis when configured and installed, else the host-local SQLite file."""
+    if REDIS_URL and REDIS_AVAILABLE:
+        return RedisBackend(REDIS_URL)
+    return SQLiteBackend()
+
+
+cache = ResultCache()
@@ -0,0 +1,127 @@
+"""Rule-based fast path that sorts obvious bulk mail into named buckets.
+
+Much of an inbox can be triaged from headers alone: a known sender domain, a
+mailing list's List-Id or one of Gmail's category labels. Rules are kept in
+hash indexes keyed on exactly those values, so each message costs a few dict
+lookups. Only messages that match no rule are vectorized and clustered. By
+default, Gmail's Promotions, Social, Updates and Forums categories each get a
+bucket, and any other mailing list goes to "Mailing lists". A JSON file named
+by ``TRIAGE_RULES_PATH`` adds or overrides rules::
+
+    {"domains": {"github.com": "GitHub"},
+     "list_ids": {"dev.lists.example.com": "Dev list"},
+     "labels": {"CATEGORY_UPDATES": null},
+     "mailing_lists": "Mailing lists"}
+
+A null bucket name switches a default rule off. A message takes the first
+match in the order List-Id, sender domain (or a parent domain), label, and
+then the catch-all for mailing lists.
+"""
+import json
+import os
+
+import numpy as np
+
+import metrics
+
+DEFAULT_PATH = os.environ.get('TRIAGE_RULES_PATH')
+# Bucket labels start here, so they never collide with ML cluster ids.
+BUCKET_BASE = 1000
+DEFAULT_LABELS = {
+    'CATEGORY_PROMOTIONS': 'Promotions',
+    'CATEGORY_SOCIAL': 'Social',
+    'CATEGORY_UPDATES': 'Updates',
+    'CATEGORY_FORUMS': 'Forums',
+}
+DEFAULT_MAILING_LISTS = 'Mailing lists'
+UNMATCHED = -1
+
+
+class RuleEngine:
+    """Hash indexes from List-Id, sender domain and label to bucket names."""
+
+    def __init__(self, domains=None, list_ids=None, labels=None, mailing_lists=DEFAULT_MAILING_LISTS):
+        self.domains = {k.lower(): v for k, v in (domains or {}).items() if v}
+        self.list_ids = {k.lower(): v for k, v in (list_ids or {}).items() if v}
+        self.labels = {k: v for k, v in (labels or {}).items() if v}
+        self.mailing_lists = mailing_lists
+        names = {*self.domains.values(), *self.list_ids.values(), *self.labels.values()}
+        if mailing_lists:
+            names.add(mailing_lists)
+        # Sorted, so a bucket keeps its label as long as the rules don't change.
+        self.bucket_labels = {name: BUCKET_BASE + i for i, name in enumerate(sorted(names))}
+
+    @classmethod
+    def from_file(cls, path):
+        """Default rules, with those in the JSON file at `path` added or overridden."""
+        with open(path) as f:
+            config = json.load(f)
+        return cls(domains=config.get('domains'), list_ids=config.get('list_ids'),
+                   labels={**DEFAULT_LABELS, **config.get('labels', {})},
+                   mailing_lists=config.get('mailing_lists', DEFAULT_MAILING_LISTS))
+
+    def names(self):
+        """Returns {bucket label: bucket name}."""
+        return {label: name for name, label in self.bucket_labels.items()}
+
+    def bucket(self, domain, list_id, labels):
+        """Returns the bucket name for one message, or None if no rule matches."""
+        if list_id:
+            # "Name <id>" headers keep only the id.
+            name = self.list_ids.get(list_id.rpartition('<')[2])
+            if name:
+                return name
+        while domain:
+            name = self.domains.get(domain)
+            if name:
+                return name
+            domain = domain.partition('.')[2]
+        for label in labels:
+            name = self.labels.get(label)
+            if name:
+                return name
+        if list_id and self.mailing_lists:
+            return self.mailing_lists
+        return None
+
+    def match(self, columns, cache=None):
+        """Returns each row's bucket label, or UNMATCHED for rows left to clustering.
+
+        `cache` is a dict kept by the caller between calls. It maps message id
+        to (Gmail labels, bucket label), so a message is only looked up again
+        when its labels change; rows taken from it are not counted in
+        ``rule_rows_total``.
+        """
+        result = np.full(len(columns['id']), UNMATCHED, dtype=np.int64)
+        checked = hits = 0
+        for i, (message_id, domain, list_id, labels) in enumerate(
+                zip(columns['id'], columns['domain'], columns['list_id'], columns['labels'])):
+            cached = cache.get(message_id) if cache is not None else None
+            if cached is not None and cached[0] == labels:
+                result[i] = cached[1]
+                continue
+            name = self.bucket(domain, list_id, labels)
+            checked += 1
+            if name:
+                result[i] = self.bucket_labels[name]
+                hits += 1
+            if cache is not None:
+                cache[message_id] = (labels, result[i])
+        if cache is not None and len(cache) > 2 * len(result):
+            # Forget messages that left the inbox.
+            kept = {message_id: cache[message_id] for message_id in columns['id']}
+            cache.clear()
+            cache.update(kept)
+        metrics.inc('rule_rows_total', hits, result='hit')
+        metrics.inc('rule_rows_total', checked - hits, result='miss')
+        return result
+
+
+def default_engine():
+    """The rules in TRIAGE_RULES_PATH if set, else the built-in category rules."""
+    if DEFAULT_PATH:
+        return RuleEngine.from_file(DEFAULT_PATH)
+    return RuleEngine(labels=DEFAULT_LABELS)
+
+
+engine = default_engine()
@@ -0,0 +1,165 @@
+"""Full-text search over the messages already fetched, shared by all workers.
+
+Each message's subject, snippet and sender go into a SQLite FTS5 index as
+soon as the inbox sync fetches it, and leave it when the message leaves the
+inbox, so a search never calls Gmail. Queries are words, each matched as a
+prefix; ``from:``, ``subject:`` and ``snippet:`` limit a word to one field::
+
+    from:github failed build
+
+Matches come newest first by the date Gmail received them, so older
+messages that a backfill indexes later still sort by their age. Every mailbox is indexed in the same file under a tag of its own,
+so a search only sees its own mailbox.
+"""
+import os
+import re
+import sqlite3
+import threading
+
+import metrics
+
+DEFAULT_PATH = os.environ.get('SEARCH_INDEX_PATH', 'search_index.sqlite3')
+FIELDS = {'from': 'sender', 'subject': 'subject', 'snippet': 'snippet'}
+_WORD = re.compile(r'\w')
+
+
+def _tag(mailbox):
+    # One alphanumeric token per mailbox, so the tokenizer keeps it whole.
+    return 'x' + mailbox.encode('utf-8').hex()
+
+
+def _row(mailbox, message):
+    headers = {h['name'].lower(): h['value'] for h in message.get('payload', {}).get('headers', [])}
+    return (mailbox, message['id'], _tag(mailbox), headers.get('subject', ''), message.get('snippet', ''),
+            headers.get('from', ''), int(message.get('internalDate', 0)))
+
+
+def parse_query(query):
+    """Turns a search box query into an FTS5 expression, or None if it has no words."""
+    terms = []
+    for term in query.split():
+        field, _, value = term.partition(':')
+        column = FIELDS.get(field.lower()) if value else None
+        if column:
+            term = value
+        if not _WORD.search(term):
+            continue
+        # Quoted, so FTS5 operators and punctuation are taken literally.
+        phrase = '"' + term.replace('"', '""') + '"*'
+        terms.append(f'{column} : {phrase}' if column else phrase)
+    return ' '.join(terms) or None
+
+
+def _match(mailbox, query):
+    expression = parse_query(query)
+    if expression is None:
+        return None
+    return f'tag : "{_tag(mailbox)}" AND ({expression})'
+
+
+class SearchIndex:
+    """FTS5 index of (mailbox, message id) -> subject, snippet and sender."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connections must not cross a fork, so reopen in each worker process.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS messages '
+                         '(rowid INTEGER PRIMARY KEY, mailbox TEXT NOT NULL, id TEXT NOT NULL, tag TEXT NOT NULL, '
+                         'subject TEXT NOT NULL, snippet TEXT NOT NULL, sender TEXT NOT NULL, '
+                         'date INTEGER NOT NULL, UNIQUE (mailbox, id))')
+            # The FTS table stores only the index; the text stays in `messages`.
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 "
+                         "(tag, subject, snippet, sender, content='messages', content_rowid='rowid')")
+            conn.execute('CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN '
+                         'INSERT INTO messages_fts (rowid, tag, subject, snippet, sender) '
+                         'VALUES (new.rowid, new.tag, new.subject, new.snippet, new.sender); END')
+            conn.execute('CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN '
+                         "INSERT INTO messages_fts (messages_fts, rowid, tag, subject, snippet, sender) "
+                         "VALUES ('delete', old.rowid, old.tag, old.subject, old.snippet, old.sender); END")
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS keep (id TEXT PRIMARY KEY)')
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def add(self, mailbox, messages):
+        """Indexes messages; those already indexed are left alone, since a message's text never changes."""
+        rows = [_row(mailbox, m) for m in messages]
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany('INSERT OR IGNORE INTO messages (mailbox, id, tag, subject, snippet, sender, date) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.commit()
+
+    def remove(self, mailbox, message_ids):
+        """Drops messages from the index."""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany('DELETE FROM messages WHERE mailbox = ? AND id = ?',
+                             [(mailbox, message_id) for message_id in message_ids])
+            conn.commit()
+
+    def replace(self, mailbox, messages):
+        """Makes `messages` the whole of a mailbox's index, keeping rows that are still there."""
+        messages = list(messages)
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM keep')
+            conn.executemany('INSERT OR IGNORE INTO keep VALUES (?)', [(m['id'],) for m in messages])
+            conn.execute('DELETE FROM messages WHERE mailbox = ? AND id NOT IN (SELECT id FROM keep)', (mailbox,))
+            conn.execute('DELETE FROM keep')
+            conn.commit()
+        self.add(mailbox, messages)
+
+    def search(self, mailbox, query, limit=50):
+        """Returns (total matches, the `limit` most recent matches as dicts)."""
+        match = _match(mailbox, query)
+        if match is None:
+            return 0, []
+        with metrics.timer('search_seconds'), self._lock:
+            conn = self._connect()
+            (total,) = conn.execute('SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH ?',
+                                    (match,)).fetchone()
+            # Rowids follow indexing order, not message dates, so sort the matches by date.
+            rows = conn.execute('SELECT id, subject, snippet, sender, date FROM messages WHERE rowid IN '
+                                '(SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?) '
+                                'ORDER BY date DESC, rowid DESC LIMIT ?', (match, limit)).fetchall()
+        return total, [{'id': row[0], 'subject': row[1], 'snippet': row[2], 'sender': row[3], 'date': row[4]}
+                       for row in rows]
+
+    def message_ids(self, mailbox, query):
+        """Returns the ids of every match, most recent first."""
+        match = _match(mailbox, query)
+        if match is None:
+            return []
+        with self._lock:
+            return [row[0] for row in self._connect().execute(
+                'SELECT id FROM messages WHERE rowid IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?) '
+                'ORDER BY date DESC, rowid DESC', (match,))]
+
+
+index = SearchIndex()
+
+
+def search_messages(query, mailbox='me', limit=50):
+    return index.search(mailbox, query, limit)
+
+
+def search_message_ids(query, mailbox='me'):
+    return index.message_ids(mailbox, query)
+
+
+def forget_messages(message_ids, mailbox='me'):
+    index.remove(mailbox, message_ids)
@@ -0,0 +1,164 @@
+"""Multi-account sync spread over a pool of shard processes.
+
+Each account is hashed to one shard, a long-lived process that keeps the
+account's incremental sync state, clustering model and Gmail quota budget
+between runs, so clustering for different accounts runs on different cores.
+A shard runs up to ``slots`` accounts at a time on threads, which overlap
+their Gmail round trips. Accounts waiting for a shard are served
+round-robin: an account is queued at most once, and asking for it again
+while it is queued or running does not move it ahead of the others.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+SYNC_SHARDS = int(os.environ.get('SYNC_SHARDS', '0')) or os.cpu_count() or 1
+SHARD_SLOTS = int(os.environ.get('SYNC_SHARD_SLOTS', '4'))
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for(account, shards):
+    """Stable shard index for an account, the same in every process and run."""
+    return zlib.crc32(account.encode('utf-8')) % shards
+
+
+def _run_account(account, service_factory):
+    from background import run_pipeline
+
+    started = time.perf_counter()
+    result = run_pipeline(account, service=service_factory(account) if service_factory else None)
+    return {
+        'snapshot_id': result['snapshot_id'] if result else None,
+        'messages': result['message_count'] if result else 0,
+        'seconds': round(time.perf_counter() - started, 4),
+    }
+
+
+def _shard_main(tasks, results, slots, service_factory):
+    import metrics
+    from gmail_assistant import warm_up
+
+    def run(account):
+        try:
+            results.put((account, _run_account(account, service_factory), None))
+        except Exception as e:
+            results.put((account, None, str(e)))
+        metrics.registry.flush()
+
+    warm_up()
+    with ThreadPoolExecutor(max_workers=slots) as pool:
+        while True:
+            account = tasks.get()
+            if account is None:
+                break
+            pool.submit(run, account)
+
+
+class ShardPool:
+    """Runs the triage pipeline for many accounts on `shards` processes.
+
+    ``service_factory(account)`` builds the Gmail service inside a shard; it
+    must be picklable. By default each account's stored credentials are used.
+    """
+
+    def __init__(self, shards=SYNC_SHARDS, slots=SHARD_SLOTS, service_factory=None):
+        self.shards = shards
+        self.slots = slots
+        self.service_factory = service_factory
+        # Shards start from a fresh interpreter: forking a process that runs
+        # threads (web workers, the sync thread) is not safe.
+        self._context = multiprocessing.get_context('spawn')
+        self._results = self._context.Queue()
+        self._processes = [None] * shards
+        self._tasks = [None] * shards
+        self._waiting = [deque() for _ in range(shards)]
+        self._running = [set() for _ in range(shards)]
+
+    def _start(self, index):
+        tasks = self._context.Queue()
+        process = self._context.Process(target=_shard_main, name=f'sync-shard-{index}', daemon=True,
+                                        args=(tasks, self._results, self.slots, self.service_factory))
+        process.start()
+        self._processes[index], self._tasks[index] = process, tasks
+
+    def submit(self, account):
+        """Queues a sync of `account`. Returns False if it is already queued or running."""
+        index = shard_for(account, self.shards)
+        if account in self._running[index] or account in self._waiting[index]:
+            return False
+        self._waiting[index].append(account)
+        self.pump()
+        return True
+
+    def pump(self):
+        """Hands queued accounts to shards with a free slot, oldest first."""
+        for index in range(self.shards):
+            waiting, running = self._waiting[index], self._running[index]
+            while waiting and len(running) < self.slots:
+                if self._processes[index] is None:
+                    self._start(index)
+                account = waiting.popleft()
+                running.add(account)
+                self._tasks[index].put(account)
+
+    def pending(self):
+        """Number of accounts queued or running."""
+        return sum(len(w) + len(r) for w, r in zip(self._waiting, self._running))
+
+    def collect(self, timeout=0):
+        """Returns [(account, stats, error)] for syncs finished since the last call.
+
+        Waits up to `timeout` seconds for the first one. Accounts whose shard
+        died are reported with an error and the shard is restarted.
+        """
+        finished = []
+        try:
+            finished.append(self._results.get(timeout=timeout) if timeout else self._results.get_nowait())
+            while True:
+                finished.append(self._results.get_nowait())
+        except queue.Empty:
+            pass
+        for account, _, _ in finished:
+            self._running[shard_for(account, self.shards)].discard(account)
+        for index, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                logger.error('Sync shard %s exited with code %s', index, process.exitcode)
+                finished.extend((account, None, 'shard exited') for account in self._running[index])
+                self._running[index].clear()
+                self._processes[index] = self._tasks[index] = None
+        self.pump()
+        return finished
+
+    def run(self, accounts):
+        """Syncs every account once and returns {account: (stats, error)}."""
+        for account in accounts:
+            self.submit(account)
+        done = {}
+        while self.pending():
+            for account, stats, error in self.collect(timeout=1.0):
+                done[account] = (stats, error)
+        return done
+
+    def shutdown(self):
+        """Stops the shards once their running syncs finish."""
+        for index, process in enumerate(self._processes):
+            if process is not None:
+                self._tasks[index].put(None)
+        for process in filter(None, self._processes):
+            while process.is_alive():
+                # A shard can't exit until the results it queued were read.
+                try:
+                    self._results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+                process.join(0.1)
+        self._processes = [None] * self.shards
+        self._tasks = [None] * self.shards
+        self._waiting = [deque() for _ in range(self.shards)]
+        self._running = [set() for _ in range(self.shards)]
@@ -0,0 +1,90 @@
+"""Versioned clustering snapshots shared by all workers.
+
+Each time clusters are rendered, the message ids of every cluster are saved
+under a new snapshot id. Archiving then acts on exactly the messages the user
+saw, without fetching or clustering again. Snapshot ids are global, but each
+snapshot belongs to one mailbox and is only found by that mailbox.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+DEFAULT_PATH = os.environ.get('SNAPSHOT_DB_PATH', 'snapshots.sqlite3')
+DEFAULT_KEEP = int(os.environ.get('SNAPSHOT_KEEP', '100'))
+
+
+class SnapshotStore:
+    """Stores snapshot id -> cluster id -> message ids in SQLite."""
+
+    def __init__(self, path=DEFAULT_PATH, keep=DEFAULT_KEEP):
+        self.path = path
+        self.keep = keep
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connections must not cross a fork, so reopen in each worker process.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS snapshots '
+                         "(id INTEGER PRIMARY KEY AUTOINCREMENT, clusters TEXT NOT NULL, "
+                         "mailbox TEXT NOT NULL DEFAULT 'me')")
+            try:
+                # Stores created before multi-account support lack the column.
+                conn.execute("ALTER TABLE snapshots ADD COLUMN mailbox TEXT NOT NULL DEFAULT 'me'")
+            except sqlite3.OperationalError:
+                pass
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def save(self, clusters, mailbox='me'):
+        """Saves a mailbox's {cluster id: [message ids]} and returns the new snapshot id."""
+        data = json.dumps({str(k): list(v) for k, v in clusters.items()}, separators=(',', ':'))
+        with self._lock:
+            conn = self._connect()
+            snapshot_id = conn.execute('INSERT INTO snapshots (clusters, mailbox) VALUES (?, ?)',
+                                       (data, mailbox)).lastrowid
+            # Keep the newest `keep` snapshots of each mailbox.
+            conn.execute('DELETE FROM snapshots WHERE mailbox = ? AND id NOT IN '
+                         '(SELECT id FROM snapshots WHERE mailbox = ? ORDER BY id DESC LIMIT ?)',
+                         (mailbox, mailbox, self.keep))
+            conn.commit()
+        return snapshot_id
+
+    def get(self, snapshot_id, mailbox='me'):
+        """Returns {cluster id: [message ids]} for a mailbox's snapshot, or None if it is unknown or expired."""
+        with self._lock:
+            row = self._connect().execute('SELECT clusters FROM snapshots WHERE id = ? AND mailbox = ?',
+                                          (snapshot_id, mailbox)).fetchone()
+        if row is None:
+            return None
+        return {int(k): v for k, v in json.loads(row[0]).items()}
+
+    def message_ids(self, snapshot_id, cluster_id, mailbox='me'):
+        """Returns the message ids of one cluster in a snapshot, or None if either is unknown."""
+        clusters = self.get(snapshot_id, mailbox)
+        if clusters is None:
+            return None
+        return clusters.get(cluster_id)
+
+
+_store = SnapshotStore()
+
+
+def save_snapshot(clusters, mailbox='me'):
+    """Saves a clustering snapshot of a mailbox and returns its id."""
+    return _store.save(clusters, mailbox)
+
+
+def get_snapshot(snapshot_id, mailbox='me'):
+    """Returns {cluster id: [message ids]} of a mailbox's saved snapshot, or None."""
+    return _store.get(snapshot_id, mailbox)
+
+
+def snapshot_message_ids(snapshot_id, cluster_id, mailbox='me'):
+    """Returns the message ids of a cluster in a mailbox's saved snapshot, or None."""
+    return _store.message_ids(snapshot_id, cluster_id, mailbox)
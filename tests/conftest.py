@@ -0,0 +1,90 @@
+import os
+import sys
+
+import pytest
+
+# The app is a set of top-level modules; make them importable from here.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import quota  # noqa: E402
+from flask.testing import FlaskClient  # noqa: E402
+
+
+class HTTPSClient(FlaskClient):
+    """Sends requests over https, which Talisman and the secure session cookie require."""
+
+    base_url = 'https://localhost'
+
+    def open(self, *args, **kwargs):
+        kwargs.setdefault('base_url', self.base_url)
+        return super().open(*args, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def scratch_dir(tmp_path, monkeypatch):
+    """Runs each test in its own directory, so SQLite stores never touch the tree."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def unthrottled(scratch_dir, monkeypatch):
+    """Lifts the quota rate and skips backoff sleeps, so the fake service is the only limit."""
+    monkeypatch.setattr(quota, 'scheduler', quota.QuotaScheduler(max_rate=1e12, min_rate=1e12))
+    monkeypatch.setattr(quota, '_account_schedulers', {})
+    monkeypatch.setattr(quota, 'backoff_delay', lambda attempt: 0)
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    """Fresh module-level stores in the scratch directory, so tests don't share state."""
+    import accounts
+    import background
+    import inbox_sync
+    import online_clustering
+    import result_cache
+    import search_index
+    import snapshots
+    from message_cache import MessageCache
+    from model_store import ModelStore
+
+    index = search_index.SearchIndex()
+    monkeypatch.setattr(search_index, 'index', index)
+    monkeypatch.setattr(inbox_sync, 'search_index', index)
+    monkeypatch.setattr(inbox_sync, '_inboxes', {'me': inbox_sync.InboxSync(
+        max_results=inbox_sync.MAX_MESSAGES, cache=MessageCache(projection=inbox_sync.PROJECTION), index=index)})
+    monkeypatch.setattr(online_clustering, '_store', ModelStore())
+    monkeypatch.setattr(online_clustering, '_clusterers', {})
+    monkeypatch.setattr(background, 'store', background.ResultStore())
+    monkeypatch.setattr(snapshots, '_store', snapshots.SnapshotStore())
+    monkeypatch.setattr(accounts, 'store', accounts.AccountStore())
+    monkeypatch.setattr(result_cache, 'cache', result_cache.ResultCache(result_cache.SQLiteBackend()))
+
+
+@pytest.fixture
+def production(stores, monkeypatch):
+    """A test client for app_production with rate limits off."""
+    import app_production
+    import result_cache
+
+    monkeypatch.setattr(app_production, 'result_cache', result_cache.cache)
+    monkeypatch.setattr(app_production.limiter, 'enabled', False)
+    app_production.app.test_client_class = HTTPSClient
+    return app_production.app.test_client()
+
+
+@pytest.fixture
+def login(production):
+    """Marks the production client's session as signed in to `mailbox` (default: token.json's).
+
+    With `user` the session is only signed in to Google as that user, as /auth/callback leaves it.
+    """
+    def login(mailbox=None, user=None):
+        with production.session_transaction(base_url=HTTPSClient.base_url) as session:
+            if user:
+                session['user'] = user
+                return
+            session['gmail_authenticated'] = True
+            if mailbox:
+                session['mailbox'] = mailbox
+    return login
@@ -0,0 +1,59 @@
+import pytest
+from fake_gmail import FakeGmailService, make_messages
+from snapshots import save_snapshot
+
+
+@pytest.fixture
+def service(production, monkeypatch):
+    import app_production
+
+    service = FakeGmailService(make_messages(10))
+    monkeypatch.setattr(app_production, 'get_account_service', lambda mailbox: service)
+    return service
+
+
+def inbox(service):
+    return [i for i in service.order if 'INBOX' in service.messages[i]['labelIds']]
+
+
+def test_archives_a_cluster_of_the_snapshot(production, login, service):
+    login()
+    snapshot_id = save_snapshot({0: service.order[:3], 1: service.order[3:]})
+    response = production.get(f'/archive/0?snapshot={snapshot_id}')
+    assert response.status_code == 200
+    assert response.json['archived_count'] == 3
+    assert inbox(service) == service.order[3:]
+
+
+def test_requires_authentication(production, service):
+    snapshot_id = save_snapshot({0: service.order})
+    assert production.get(f'/archive/0?snapshot={snapshot_id}').status_code == 401
+    assert len(inbox(service)) == 10
+
+
+def test_unknown_snapshot(production, login, service):
+    login()
+    response = production.get('/archive/0?snapshot=12345')
+    assert response.status_code == 404
+    assert 'snapshot' in response.json['error']
+
+
+def test_unknown_cluster_of_a_valid_snapshot(production, login, service):
+    login()
+    snapshot_id = save_snapshot({0: service.order})
+    response = production.get(f'/archive/7?snapshot={snapshot_id}')
+    assert response.status_code == 404
+    assert response.json['error'] == 'Cluster not found in this snapshot'
+    assert len(inbox(service)) == 10
+
+
+def test_non_numeric_cluster_id_is_not_found(production, login, service):
+    login()
+    snapshot_id = save_snapshot({0: service.order})
+    assert production.get(f'/archive/abc?snapshot={snapshot_id}').status_code == 404
+
+
+def test_snapshot_of_another_mailbox_is_not_found(production, login, service):
+    login()
+    snapshot_id = save_snapshot({0: service.order}, mailbox='alice@example.com')
+    assert production.get(f'/archive/0?snapshot={snapshot_id}').status_code == 404
@@ -0,0 +1,83 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+import quota
+from async_gmail import AsyncGmailClient
+from fake_gmail import FakeGmailService, make_messages, mock_transport
+
+CREDENTIALS = SimpleNamespace(valid=True, token='token')
+
+
+class InFlight(httpx.AsyncBaseTransport):
+    """Counts the most requests a transport ever had open at once."""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.current = self.most = 0
+
+    async def handle_async_request(self, request):
+        self.current += 1
+        self.most = max(self.most, self.current)
+        try:
+            return await self.transport.handle_async_request(request)
+        finally:
+            self.current -= 1
+
+
+def run(service, call, transport=None, **kwargs):
+    async def main():
+        async with AsyncGmailClient(CREDENTIALS, transport=transport or mock_transport(service), **kwargs) as gmail:
+            return await call(gmail)
+    return asyncio.run(main())
+
+
+def test_fetches_under_the_shared_quota():
+    messages = make_messages(30)
+    service = FakeGmailService(messages)
+    emails = run(service, lambda gmail: gmail.fetch_emails(max_results=None))
+    assert [m['id'] for m in emails] == [m['id'] for m in messages]
+    assert quota.scheduler.stats()['calls'] == {'messages.list': 1, 'messages.get': 30}
+
+
+def test_caps_requests_in_flight():
+    service = FakeGmailService(make_messages(20), latency=0.01)
+    transport = InFlight(mock_transport(service))
+    run(service, lambda gmail: gmail.get_messages(list(service.order)), transport=transport, concurrency=3)
+    assert transport.most == 3
+
+
+@pytest.mark.parametrize('status, throttled', [(429, 1), (503, 0)])
+def test_retries_and_only_slows_down_on_rate_limits(status, throttled):
+    service = FakeGmailService(make_messages(5), modify_failures=[status])
+    chunks = run(service, lambda gmail: gmail.archive_messages(service.order))
+    assert chunks == [{'chunk': 0, 'count': 5, 'success': True}]
+    assert quota.scheduler.throttled == throttled
+
+
+def test_archives_in_chunks_of_a_thousand():
+    service = FakeGmailService(make_messages(2500))
+    chunks = run(service, lambda gmail: gmail.archive_messages(service.order))
+    assert [(chunk['chunk'], chunk['count'], chunk['success']) for chunk in chunks] == \
+        [(0, 1000, True), (1, 1000, True), (2, 500, True)]
+    assert not any('INBOX' in m['labelIds'] for m in service.messages.values())
+
+
+def test_search_archive_route_uses_the_async_client(production, login, monkeypatch):
+    import search_index
+
+    messages = make_messages(40)
+    service = FakeGmailService(messages)
+    search_index.index.add('me', messages)
+    monkeypatch.setattr(AsyncGmailClient, 'for_account', classmethod(
+        lambda cls, account: cls(CREDENTIALS, account=account, transport=mock_transport(service))))
+    login()
+    matches = search_index.index.message_ids('me', 'subject:invoice')
+    assert matches
+
+    response = production.post('/api/search/archive', data={'q': 'subject:invoice'})
+    assert response.status_code == 200
+    assert response.get_json()['archived_count'] == len(matches)
+    assert all('INBOX' not in service.messages[i]['labelIds'] for i in matches)
+    assert quota.scheduler.stats()['calls'] == {'messages.batchModify': 1}
@@ -0,0 +1,120 @@
+import hashlib
+import json
+from base64 import urlsafe_b64encode
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+from google.oauth2 import id_token
+
+CLIENT = {'web': {'client_id': 'triage.apps.googleusercontent.com', 'client_secret': 'secret',
+                  'auth_uri': 'https://accounts.google.com/o/oauth2/auth',
+                  'token_uri': 'https://oauth2.googleapis.com/token',
+                  'redirect_uris': ['https://localhost/auth/callback']}}
+
+
+@pytest.mark.parametrize('method, path', [
+    ('POST', '/api/refresh'),
+    ('GET', '/api/clusters'),
+    ('GET', '/api/clusters?summary=1'),
+    ('GET', '/api/clusters/0'),
+])
+def test_requires_authentication(production, method, path):
+    assert production.open(path, method=method).status_code == 401
+
+
+def test_refresh_is_scheduled_for_the_session_mailbox(production, login):
+    import background
+
+    login()
+    assert production.post('/api/refresh').status_code == 202
+    assert 'me' in background.store.take_refresh_requests()
+
+
+@pytest.fixture
+def google(monkeypatch):
+    """A web OAuth client in credentials.json and a stub Google token endpoint; returns the token requests."""
+    with open('credentials.json', 'w') as f:
+        json.dump(CLIENT, f)
+    exchanges = []
+
+    def send(adapter, request, **kwargs):
+        assert request.url == CLIENT['web']['token_uri']
+        exchanges.append(parse_qs(request.body if isinstance(request.body, str) else request.body.decode()))
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response._content = json.dumps({'access_token': 'access', 'token_type': 'Bearer', 'expires_in': 3600,
+                                        'id_token': 'alice-id-token'}).encode()
+        response.url, response.request = request.url, request
+        return response
+
+    def verify(token, request, audience):
+        assert (token, audience) == ('alice-id-token', CLIENT['web']['client_id'])
+        return {'email': 'Alice@example.com', 'email_verified': True}
+
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, 'send', send)
+    monkeypatch.setattr(id_token, 'verify_oauth2_token', verify)
+    return exchanges
+
+
+@pytest.fixture
+def alice(production, google, monkeypatch):
+    import accounts
+    import app_production
+
+    accounts.store.add('alice@example.com', '{}', owners=['Alice@example.com'])
+    monkeypatch.setattr(app_production, 'get_account_service', lambda account: object())
+    return 'alice@example.com'
+
+
+def session_of(production):
+    with production.session_transaction() as session:
+        return dict(session)
+
+
+def sign_in_query(response):
+    assert response.status_code == 302
+    assert response.location.startswith(CLIENT['web']['auth_uri'])
+    return {key: values[0] for key, values in parse_qs(urlsplit(response.location).query).items()}
+
+
+def test_opening_an_account_requires_signing_in_first(production, alice):
+    query = sign_in_query(production.get(f'/auth?account={alice}'))
+    assert query['redirect_uri'] == 'https://localhost/auth/callback'
+    assert 'mailbox' not in session_of(production)
+
+
+def test_sign_in_round_trip_opens_the_account(production, alice, google):
+    query = sign_in_query(production.get(f'/auth?account={alice}'))
+    response = production.get(f"/auth/callback?state={query['state']}&code=auth-code")
+    assert response.location == f'/auth?account={alice}'
+    # The token exchange proves PKCE: its verifier hashes to the challenge sent to Google.
+    (exchange,) = google
+    assert exchange['code'] == ['auth-code']
+    challenge = urlsafe_b64encode(hashlib.sha256(exchange['code_verifier'][0].encode()).digest()).rstrip(b'=')
+    assert challenge.decode() == query['code_challenge']
+    production.get(response.location)
+    assert session_of(production)['mailbox'] == alice
+
+
+def test_sign_in_behind_the_proxy_keeps_https(production, alice):
+    response = production.get(f'/auth?account={alice}', base_url='http://triage.example.com',
+                              headers={'X-Forwarded-Proto': 'https'})
+    assert sign_in_query(response)['redirect_uri'] == 'https://triage.example.com/auth/callback'
+
+
+def test_sign_in_with_a_stale_state_fails(production, alice, google):
+    production.get(f'/auth?account={alice}')
+    assert production.get('/auth/callback?state=other&code=c').status_code == 400
+    assert 'user' not in session_of(production)
+    assert google == []
+
+
+def test_only_owners_open_an_account(production, login, alice):
+    login(user='mallory@example.com')
+    assert production.get(f'/auth?account={alice}').status_code == 403
+    assert 'mailbox' not in session_of(production)
+    login(user=alice)
+    assert production.get(f'/auth?account={alice}').status_code == 302
+    assert session_of(production)['mailbox'] == alice
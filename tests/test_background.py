@@ -0,0 +1,54 @@
+import sqlite3
+
+import background
+from fake_gmail import FakeGmailService, make_messages
+
+
+def archive_everything(service):
+    service.users().messages().batchModify(userId='me', body={'ids': list(service.order),
+                                                              'removeLabelIds': ['INBOX']}).execute()
+
+
+def test_an_emptied_inbox_is_published(production, login, stores):
+    service = FakeGmailService(make_messages(30))
+    assert background.run_pipeline('me', service)['message_count'] == 30
+    archive_everything(service)
+
+    published = background.run_pipeline('me', service)
+    assert published['message_count'] == 0
+    login()
+    assert production.get('/api/clusters').get_json() == {}
+    assert production.get('/api/clusters?summary=1').get_json() == {}
+    assert production.get('/').status_code == 200
+
+
+def test_a_failed_fetch_keeps_the_last_result(stores, monkeypatch):
+    service = FakeGmailService(make_messages(30))
+    first = background.run_pipeline('me', service)
+    monkeypatch.setattr(background, 'sync_emails', lambda service, mailbox: None)
+    assert background.run_pipeline('me', service) is None
+    assert background.latest_version('me')[0] == first['snapshot_id']
+
+
+def test_results_hold_the_summary_and_not_the_emails(stores):
+    published = background.run_pipeline('me', FakeGmailService(make_messages(30)))
+    columns = [row[1] for row in background.store._connect().execute('PRAGMA table_info(results)')]
+    assert columns == ['mailbox', 'snapshot_id', 'updated_at', 'summary']
+
+    result = background.result_for_snapshot(published['snapshot_id'], 'me')
+    assert result['clusters'] == published['clusters']
+    assert result['summary'] == published['summary']
+    assert background.result_for_snapshot(published['snapshot_id'] + 1, 'me') is None
+
+
+def test_a_store_with_blob_results_is_replaced(scratch_dir):
+    conn = sqlite3.connect('old.sqlite3')
+    conn.execute('CREATE TABLE results (mailbox TEXT PRIMARY KEY, data TEXT NOT NULL)')
+    conn.execute('INSERT INTO results VALUES (?, ?)', ('me', '{"snapshot_id": 1}'))
+    conn.commit()
+    conn.close()
+
+    store = background.ResultStore('old.sqlite3')
+    assert store.latest_version('me') is None
+    store.publish('me', {'snapshot_id': 2, 'updated_at': 'now', 'summary': {}, 'clusters': {}})
+    assert store.latest_version('me') == (2, 'now')
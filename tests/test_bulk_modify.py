@@ -0,0 +1,65 @@
+import time
+
+import pytest
+from bulk_modify import archive_messages, batch_modify
+from fake_gmail import FakeGmailService, make_messages
+
+
+def outcome(chunks):
+    return [(chunk['chunk'], chunk['count'], chunk['success']) for chunk in chunks]
+
+
+@pytest.fixture
+def service():
+    return FakeGmailService(make_messages(2500))
+
+
+def test_more_than_1000_ids_are_split_into_chunks(service):
+    chunks = archive_messages(service, service.order)
+    assert outcome(chunks) == [(0, 1000, True), (1, 1000, True), (2, 500, True)]
+    assert service.calls['messages.batchModify'] == 3
+    assert not any('INBOX' in m['labelIds'] for m in service.messages.values())
+
+
+def test_rate_limited_chunks_are_retried(service):
+    service.modify_failures = [429, 429]
+    chunks = archive_messages(service, service.order)
+    assert outcome(chunks) == [(0, 1000, True), (1, 1000, True), (2, 500, True)]
+    assert service.calls['messages.batchModify'] == 5
+    assert not any('INBOX' in m['labelIds'] for m in service.messages.values())
+
+
+def test_a_failed_chunk_is_reported_and_the_rest_still_run(service):
+    service.modify_failures = [400]
+    chunks = batch_modify(service, service.order, remove_label_ids=['INBOX'], max_workers=1)
+    assert outcome(chunks) == [(0, 1000, False), (1, 1000, True), (2, 500, True)]
+    assert 'error' in chunks[0]
+    assert all('INBOX' in service.messages[i]['labelIds'] for i in service.order[:1000])
+    assert not any('INBOX' in service.messages[i]['labelIds'] for i in service.order[1000:])
+
+
+def test_results_come_back_in_chunk_order(service, monkeypatch):
+    modify = service._batch_modify
+    first = service.order[0]
+
+    def first_chunk_last(body):
+        # The first chunk finishes after all the others.
+        if first in body['ids']:
+            time.sleep(0.2)
+        return modify(body)
+
+    monkeypatch.setattr(service, '_batch_modify', first_chunk_last)
+    chunks = batch_modify(service, service.order[:50], add_label_ids=['STARRED'], chunk_size=10)
+    assert outcome(chunks) == [(i, 10, True) for i in range(5)]
+
+
+def test_duplicate_ids_are_modified_once(service):
+    ids = service.order[:600]
+    chunks = archive_messages(service, ids + ids)
+    assert outcome(chunks) == [(0, 600, True)]
+
+
+def test_nothing_to_do_makes_no_calls(service):
+    assert archive_messages(service, []) == []
+    assert batch_modify(service, service.order[:5]) == []
+    assert 'messages.batchModify' not in service.calls
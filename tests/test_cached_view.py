@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+import background
+import result_cache
+
+
+def publish(mailbox, snapshot_id, subject):
+    background.store.publish(mailbox, {
+        'snapshot_id': snapshot_id, 'updated_at': '2026-01-01T00:00:00',
+        'summary': {'0': {'name': None, 'count': 1, 'groups': 1, 'top_terms': []}},
+        'clusters': {'0': [{'id': f'{mailbox}-1', 'subject': subject, 'snippet': '', 'count': 1}]},
+    })
+
+
+def signed_in_client(app, mailbox='me'):
+    client = app.test_client()
+    with client.session_transaction(base_url='https://localhost') as session:
+        session['gmail_authenticated'] = True
+        session['mailbox'] = mailbox
+    return client
+
+
+@pytest.fixture
+def renders(production, monkeypatch):
+    """Counts calls to the /api/clusters renderer, which takes a moment so misses overlap."""
+    import app_production
+
+    calls = []
+    render = app_production.render_clusters_json
+
+    def slow_render(result):
+        calls.append(result['snapshot_id'])
+        time.sleep(0.2)
+        return render(result)
+
+    monkeypatch.setattr(app_production, 'render_clusters_json', slow_render)
+    return calls
+
+
+def test_if_none_match_gets_304_until_the_next_publish(production, login):
+    publish('me', 1, 'First')
+    login()
+    first = production.get('/api/clusters')
+    assert first.status_code == 200
+    tag = first.headers['ETag']
+
+    again = production.get('/api/clusters', headers={'If-None-Match': tag})
+    assert again.status_code == 304
+    assert again.data == b''
+    assert again.headers['ETag'] == tag
+
+    publish('me', 2, 'Second')
+    fresh = production.get('/api/clusters', headers={'If-None-Match': tag})
+    assert fresh.status_code == 200
+    assert fresh.headers['ETag'] != tag
+    assert fresh.get_json()['0']['emails'][0]['subject'] == 'Second'
+
+
+def test_cache_keys_include_the_mailbox(production, renders):
+    import app_production
+
+    # The same snapshot id in two mailboxes must not share a cached body.
+    publish('me', 7, 'Mine')
+    publish('alice@example.com', 7, 'Alices')
+    mine = signed_in_client(app_production.app).get('/api/clusters').get_json()
+    alices = signed_in_client(app_production.app, 'alice@example.com').get('/api/clusters').get_json()
+
+    assert mine['0']['emails'][0]['subject'] == 'Mine'
+    assert alices['0']['emails'][0]['subject'] == 'Alices'
+    assert len(renders) == 2
+
+
+def test_concurrent_misses_render_once(production, renders):
+    import app_production
+
+    publish('me', 1, 'First')
+    clients = [signed_in_client(app_production.app) for _ in range(8)]
+    responses = []
+    barrier = threading.Barrier(len(clients))
+
+    def get(client):
+        barrier.wait()
+        responses.append(client.get('/api/clusters'))
+
+    threads = [threading.Thread(target=get, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [response.status_code for response in responses] == [200] * len(clients)
+    assert len({response.data for response in responses}) == 1
+    assert renders == [1]
+
+
+def test_workers_sharing_a_backend_render_once(scratch_dir):
+    # Two caches on one SQLite file stand in for two gunicorn workers.
+    workers = [result_cache.ResultCache(result_cache.SQLiteBackend()) for _ in range(2)]
+    calls = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.2)
+        return b'body'
+
+    results = []
+    threads = [threading.Thread(target=lambda cache=cache: results.append(cache.get_or_render('view:me:1', render)))
+               for cache in workers for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [b'body'] * len(threads)
+    assert len(calls) == 1
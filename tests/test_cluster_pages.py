@@ -0,0 +1,56 @@
+import background
+
+
+def publish(snapshot_id, size=7, mailbox='me'):
+    background.store.publish(mailbox, {
+        'snapshot_id': snapshot_id, 'updated_at': '2026-01-01T00:00:00',
+        'summary': {'0': {'name': None, 'count': size, 'groups': size, 'top_terms': []}},
+        'clusters': {'0': [{'id': f'm{n}', 'subject': f'Email {n}', 'snippet': '', 'count': 1}
+                           for n in range(size)]},
+    })
+
+
+def test_following_next_cursor_pages_through_the_cluster(production, login):
+    publish(1)
+    login()
+    subjects, url = [], '/api/clusters/0?limit=3'
+    while url:
+        body = production.get(url).get_json()
+        subjects.extend(email['subject'] for email in body['emails'])
+        url = body['next_cursor'] and f"/api/clusters/0?limit=3&cursor={body['next_cursor']}"
+    assert subjects == [f'Email {n}' for n in range(7)]
+
+
+def test_pages_keep_their_snapshot_across_one_sync(production, login):
+    publish(1)
+    login()
+    cursor = production.get('/api/clusters/0?limit=3').get_json()['next_cursor']
+    publish(2, size=2)
+    body = production.get(f'/api/clusters/0?limit=3&cursor={cursor}').get_json()
+    assert [email['subject'] for email in body['emails']] == ['Email 3', 'Email 4', 'Email 5']
+
+
+def test_a_malformed_cursor_is_rejected(production, login):
+    publish(1)
+    login()
+    for cursor in ('not-base64!', 'bm9jb2xvbg', 'YTpi'):
+        response = production.get(f'/api/clusters/0?cursor={cursor}')
+        assert response.status_code == 400
+        assert response.get_json() == {'error': 'Invalid cursor'}
+
+
+def test_a_cursor_into_an_expired_snapshot_is_gone(production, login):
+    publish(1)
+    login()
+    cursor = production.get('/api/clusters/0?limit=3').get_json()['next_cursor']
+    # Only the last KEEP_SNAPSHOTS snapshots stay pageable.
+    for snapshot_id in range(2, background.KEEP_SNAPSHOTS + 2):
+        publish(snapshot_id)
+    response = production.get(f'/api/clusters/0?limit=3&cursor={cursor}')
+    assert response.status_code == 410
+
+
+def test_an_unknown_cluster_is_not_found(production, login):
+    publish(1)
+    login()
+    assert production.get('/api/clusters/5').status_code == 404
@@ -0,0 +1,24 @@
+import pytest
+from benchmark import COLD_START_APPS, IMPORT_BUDGET_SECONDS, bench_cold_start
+
+
+@pytest.fixture(scope='module')
+def cold_start(tmp_path_factory):
+    # Importing app_production creates logs/ and the stores in the working directory.
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(tmp_path_factory.mktemp('cold_start'))
+        return bench_cold_start(repeat=3)
+
+
+@pytest.mark.parametrize('module', COLD_START_APPS)
+def test_app_imports_without_deferred_modules(cold_start, module):
+    assert cold_start[module]['deferred_modules_loaded'] == []
+
+
+@pytest.mark.parametrize('module', COLD_START_APPS)
+def test_app_imports_within_budget(cold_start, module):
+    assert cold_start[module]['import_median_ms'] <= IMPORT_BUDGET_SECONDS * 1000
+
+
+def test_health_check_answers_right_after_import(cold_start):
+    assert cold_start['app_production']['status_codes'] == [200]
@@ -0,0 +1,100 @@
+import gmail_assistant
+import pytest
+import quota
+from fake_gmail import FakeGmailService, make_http_error, make_messages
+from gmail_assistant import BATCH_SIZE, fetch_messages
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(gmail_assistant, 'backoff_delay', lambda attempt: 0)
+
+
+def ids(messages):
+    return [m['id'] for m in messages]
+
+
+def test_fetches_in_batches():
+    messages = make_messages(2 * BATCH_SIZE + 10)
+    service = FakeGmailService(messages)
+    fetched = fetch_messages(service, ids(messages))
+    assert ids(fetched) == ids(messages)
+    assert service.round_trips == 3
+    assert service.calls == {'messages.get': len(messages)}
+
+
+def test_projects_metadata_only():
+    messages = make_messages(1)
+    fetched = fetch_messages(FakeGmailService(messages), ids(messages))[0]
+    assert {h['name'] for h in fetched['payload']['headers']} <= set(gmail_assistant.METADATA_HEADERS)
+    assert 'body' not in fetched['payload']
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_retries_throttled_and_server_errors(status):
+    messages = make_messages(10)
+    flaky = messages[3]['id']
+    service = FakeGmailService(messages, failures={flaky: [status, status]})
+    fetched = fetch_messages(service, ids(messages))
+    assert ids(fetched) == ids(messages)
+    # One batch for everything, then one retry batch per failure.
+    assert service.round_trips == 3
+    assert service.calls['messages.get'] == len(messages) + 2
+    # Only rate limits slow the scheduler down.
+    assert quota.scheduler.throttled == (2 if status == 429 else 0)
+
+
+def test_skips_missing_and_permanently_failing_messages():
+    messages = make_messages(10)
+    broken = messages[5]['id']
+    service = FakeGmailService(messages, failures={broken: [400]})
+    fetched = fetch_messages(service, ids(messages) + ['deleted-message'])
+    assert ids(fetched) == [i for i in ids(messages) if i != broken]
+    assert service.round_trips == 1
+
+
+def test_gives_up_after_max_retries():
+    messages = make_messages(5)
+    stuck = messages[0]['id']
+    service = FakeGmailService(messages, failures={stuck: [503] * 10})
+    fetched = fetch_messages(service, ids(messages), max_retries=2)
+    assert ids(fetched) == ids(messages)[1:]
+    assert service.round_trips == 3
+
+
+def test_retries_a_whole_batch_that_fails():
+    messages = make_messages(BATCH_SIZE + 5)
+    service = FakeGmailService(messages)
+    new_batch = service.new_batch_http_request
+    failures = [503]
+
+    def flaky_batch(callback=None):
+        batch = new_batch(callback=callback)
+        execute = batch.execute
+
+        # The first batch HTTP request fails as a whole; quota.execute retries it.
+        def flaky_execute(http=None):
+            if failures:
+                service._round_trip()
+                raise make_http_error(failures.pop())
+            return execute(http)
+
+        batch.execute = flaky_execute
+        return batch
+
+    service.new_batch_http_request = flaky_batch
+    fetched = fetch_messages(service, ids(messages))
+    assert ids(fetched) == ids(messages)
+    assert service.round_trips == 3
+
+
+def test_cached_messages_are_not_requested():
+    from message_cache import MessageCache
+
+    messages = make_messages(20)
+    cache = MessageCache('cache.sqlite3', projection=gmail_assistant.PROJECTION)
+    fetch_messages(FakeGmailService(messages), ids(messages[:15]), cache=cache)
+    service = FakeGmailService(messages)
+    fetched = fetch_messages(service, ids(messages), cache=cache)
+    assert ids(fetched) == ids(messages)
+    assert service.calls == {'messages.get': 5}
@@ -0,0 +1,38 @@
+import pytest
+from fake_gmail import FakeGmailService, make_messages
+from inbox_sync import InboxSync
+from search_index import SearchIndex
+
+
+def inbox_ids(service, count):
+    return [i for i in service.order if 'INBOX' in service.messages[i]['labelIds']][:count]
+
+
+@pytest.fixture
+def service():
+    return FakeGmailService(make_messages(1000))
+
+
+def test_archived_messages_are_backfilled(service):
+    index = SearchIndex()
+    inbox = InboxSync(max_results=200, index=index)
+    inbox.sync(service)
+    archived = service.order[:150]
+    service.users().messages().batchModify(userId='me', body={'ids': archived, 'removeLabelIds': ['INBOX']}).execute()
+    service.delete_message(service.order[0])
+
+    emails = inbox.sync(service)
+    assert [m['id'] for m in emails] == inbox_ids(service, 200)
+    assert {row[0] for row in index._connect().execute('SELECT id FROM messages')} == set(inbox_ids(service, 200))
+
+
+def test_a_small_inbox_is_not_relisted():
+    service = FakeGmailService(make_messages(50))
+    inbox = InboxSync(max_results=200)
+    inbox.sync(service)
+    service.users().messages().batchModify(userId='me', body={'ids': service.order[:5],
+                                                              'removeLabelIds': ['INBOX']}).execute()
+    lists = service.calls['messages.list']
+
+    assert len(inbox.sync(service)) == 45
+    assert service.calls['messages.list'] == lists
@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+
+from metrics import EXITED, Metrics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def record_in_exited_process(jobs, ratio):
+    subprocess.run([sys.executable, '-c', 'import metrics; metrics.inc("jobs_total", %d); '
+                    'metrics.set_gauge("ratio", %r); metrics.registry.flush()' % (jobs, ratio)],
+                   check=True, env=dict(os.environ, PYTHONPATH=ROOT, METRICS_DB_PATH='metrics.sqlite3'))
+
+
+def processes(registry):
+    return {row[0] for row in registry._connect().execute('SELECT DISTINCT process FROM samples')}
+
+
+def test_exited_processes_fold_into_one_row_per_sample():
+    registry = Metrics('metrics.sqlite3', fold_interval=0)
+    registry.inc('jobs_total', 2)
+    for jobs, ratio in [(3, 0.5), (4, 0.25)]:
+        record_in_exited_process(jobs, ratio)
+        text = registry.render()
+        assert processes(registry) == {registry._process, EXITED}
+    assert 'jobs_total 9\n' in text
+    assert 'ratio 0.25\n' in text
+    assert registry._connect().execute("SELECT COUNT(*) FROM samples WHERE name = 'ratio'").fetchone() == (1,)
@@ -0,0 +1,26 @@
+import pytest
+
+TOKEN = 'scrape-token'
+
+
+@pytest.fixture
+def token(monkeypatch):
+    monkeypatch.setenv('METRICS_TOKEN', TOKEN)
+
+
+def test_metrics_are_off_without_a_token(production):
+    assert production.get('/metrics').status_code == 404
+
+
+@pytest.mark.parametrize('header', [None, 'Bearer wrong', f'Basic {TOKEN}'])
+def test_metrics_require_the_token(production, token, header):
+    headers = {'Authorization': header} if header else {}
+    response = production.get('/metrics', headers=headers)
+    assert response.status_code == 401
+    assert b'http_' not in response.data
+
+
+def test_metrics_with_the_token(production, token):
+    response = production.get('/metrics', headers={'Authorization': f'Bearer {TOKEN}'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
@@ -0,0 +1,49 @@
+import dedup
+import numpy as np
+import pytest
+import rules
+from dedup import SignatureCache, collapse, near_duplicate_groups
+from fake_gmail import make_messages
+from features import extract_columns
+from online_clustering import OnlineClusterer
+
+
+@pytest.fixture
+def emails():
+    return make_messages(300)
+
+
+def test_cached_signatures_group_like_a_fresh_run(emails):
+    cache = SignatureCache()
+    collapse(emails[100:], extract_columns(emails[100:]), cache)
+    _, _, cached = collapse(emails, extract_columns(emails), cache)
+    _, _, fresh = collapse(emails, extract_columns(emails))
+    assert cached == fresh
+
+
+def test_texts_without_words_stay_apart():
+    groups = near_duplicate_groups(['', '  ', '!!', 'build 1 failed', 'build 2 failed'], ['a.com'] * 5)
+    assert [list(g) for g in groups] == [[0], [1], [2], [3, 4]]
+
+
+def test_rule_buckets_follow_label_changes(emails):
+    cache = {}
+    columns = extract_columns(emails)
+    assert np.array_equal(rules.engine.match(columns, cache), rules.engine.match(columns))
+    promotion = next(m for m in emails if 'CATEGORY_PROMOTIONS' in m['labelIds'])
+    promotion['labelIds'] = ['INBOX']
+    columns = extract_columns(emails)
+    assert np.array_equal(rules.engine.match(columns, cache), rules.engine.match(columns))
+
+
+def test_incremental_sync_only_processes_new_messages(emails, monkeypatch):
+    clusterer = OnlineClusterer()
+    clusterer.cluster(emails[10:])
+    signed, bucketed = [], []
+    text_signatures, bucket = dedup.text_signatures, rules.engine.bucket
+    monkeypatch.setattr(dedup, 'text_signatures', lambda texts: signed.append(len(texts)) or text_signatures(texts))
+    monkeypatch.setattr(rules.engine, 'bucket', lambda *args: bucketed.append(args) or bucket(*args))
+    result = clusterer.cluster(emails)
+    assert signed == [10]
+    assert len(bucketed) <= 10
+    assert result.message_count() == len(emails)
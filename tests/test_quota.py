@@ -0,0 +1,43 @@
+import time
+
+import pytest
+from fake_gmail import make_http_error
+from quota import BACKGROUND, INTERACTIVE, BucketStore, QuotaScheduler
+
+
+def process_schedulers(count, **kwargs):
+    """Schedulers for one account with their own connections, as separate processes would have."""
+    return [QuotaScheduler(store=BucketStore('quota.sqlite3'), **kwargs) for _ in range(count)]
+
+
+class FlakyRequest:
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+
+    def execute(self):
+        if self.statuses:
+            raise make_http_error(self.statuses.pop(0))
+        return {}
+
+
+def test_processes_share_one_budget():
+    first, second = process_schedulers(2, max_rate=100, min_rate=100)
+    assert first._take(100, INTERACTIVE) == 0
+    assert second._take(50, INTERACTIVE) > 0.4
+
+
+def test_waiting_interactive_calls_hold_back_background_calls_elsewhere():
+    web, sync = process_schedulers(2, max_rate=100, min_rate=100)
+    assert web._take(100, INTERACTIVE) == 0
+    assert web._take(100, INTERACTIVE) > 0
+    time.sleep(0.05)
+    # Enough tokens have come back for the background call, but the web worker is first in line.
+    assert sync._take(1, BACKGROUND) > 0
+    assert web._take(1, INTERACTIVE) == 0
+
+
+@pytest.mark.parametrize('status, slowed', [(429, True), (503, False)])
+def test_only_rate_limits_lower_the_rate(status, slowed):
+    scheduler, other = process_schedulers(2, max_rate=100, min_rate=10)
+    scheduler.execute(FlakyRequest(status), 'getProfile')
+    assert (other.stats()['rate'] < 100) == slowed
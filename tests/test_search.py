@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+
+import pytest
+from async_gmail import AsyncGmailClient
+from fake_gmail import FakeGmailService, make_message, make_messages, mock_transport
+from search_index import SearchIndex, parse_query
+
+
+def message(n, subject, sender='alice@example.com', snippet=''):
+    email = make_message(n)
+    email['payload']['headers'] = [{'name': 'Subject', 'value': subject}, {'name': 'From', 'value': sender}]
+    email['snippet'] = snippet
+    return email
+
+
+@pytest.fixture
+def index(stores):
+    import search_index
+    return search_index.index
+
+
+def test_fields_limit_a_word_and_others_match_anywhere():
+    assert parse_query('from:github failed build') == 'sender : "github"* "failed"* "build"*'
+    assert parse_query('SUBJECT:Invoice snippet:paid') == 'subject : "Invoice"* snippet : "paid"*'
+    # Unknown prefixes and a bare prefix are searched for as typed.
+    assert parse_query('to:bob') == '"to:bob"*'
+    assert parse_query('from:') == '"from:"*'
+
+
+def test_quotes_and_operators_are_literal():
+    assert parse_query('say "hi"') == '"say"* """hi"""*'
+    assert parse_query('NOT OR build*') == '"NOT"* "OR"* "build*"*'
+    assert parse_query('- + ( )') is None
+    assert parse_query('from:-') is None
+
+
+def test_matches_are_ordered_by_date_not_indexing_order():
+    index = SearchIndex()
+    index.add('me', [message(3, 'Invoice March'), message(2, 'Invoice February')])
+    # A backfill indexes an older message after the newer ones.
+    index.add('me', [message(1, 'Invoice January')])
+
+    total, emails = index.search('me', 'invoice', limit=2)
+    assert total == 3
+    assert [email['subject'] for email in emails] == ['Invoice March', 'Invoice February']
+    assert index.message_ids('me', 'invoice') == ['msg00000003', 'msg00000002', 'msg00000001']
+
+
+def test_a_search_only_sees_its_own_mailbox():
+    index = SearchIndex()
+    index.add('me', [message(1, 'Invoice')])
+    index.add('alice@example.com', [message(2, 'Invoice')])
+    assert index.message_ids('me', 'invoice') == ['msg00000001']
+
+
+def test_search_route(production, login, index):
+    index.add('me', [message(1, 'Build failed', sender='ci@github.com'), message(2, 'Lunch?'),
+                     message(3, 'Build passed', sender='ci@github.com')])
+    assert production.get('/api/search?q=build').status_code == 401
+    login()
+
+    body = production.get('/api/search?q=from:github build&limit=1').get_json()
+    assert body['query'] == 'from:github build'
+    assert body['total'] == 2
+    assert [email['subject'] for email in body['emails']] == ['Build passed']
+    assert production.get('/api/search?q=').get_json() == {'query': '', 'total': 0, 'emails': []}
+
+
+@pytest.fixture
+def gmail(monkeypatch):
+    """Points the archive route's async client at a fake mailbox."""
+    service = FakeGmailService(make_messages(40))
+    monkeypatch.setattr(AsyncGmailClient, 'for_account', classmethod(
+        lambda cls, account: cls(SimpleNamespace(valid=True, token='token'), account=account,
+                                 transport=mock_transport(service))))
+    return service
+
+
+def test_search_archive_forgets_what_it_archived(production, login, index, gmail):
+    index.add('me', gmail.messages.values())
+    assert production.post('/api/search/archive', data={'q': 'subject:invoice'}).status_code == 401
+    login()
+    matches = index.message_ids('me', 'subject:invoice')
+
+    response = production.post('/api/search/archive', json={'q': 'subject:invoice'})
+    assert response.status_code == 200
+    assert response.get_json()['archived_count'] == len(matches)
+    assert all('INBOX' not in gmail.messages[i]['labelIds'] for i in matches)
+    assert index.message_ids('me', 'subject:invoice') == []
+    assert production.post('/api/search/archive', data={'q': 'subject:invoice'}).status_code == 400
+
+
+def test_a_failed_search_archive_keeps_the_matches(production, login, index, gmail):
+    index.add('me', gmail.messages.values())
+    gmail.modify_failures = [400]
+    login()
+    matches = index.message_ids('me', 'subject:invoice')
+
+    response = production.post('/api/search/archive', data={'q': 'subject:invoice'})
+    assert response.status_code == 502
+    assert response.get_json()['success'] is False
+    assert index.message_ids('me', 'subject:invoice') == matches